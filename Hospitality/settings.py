@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,7 +84,7 @@ WSGI_APPLICATION = 'Hospitality.wsgi.application'
 REST_FRAMEWORK = {
     # Authentication classes
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.ClaimsJWTAuthentication',
     ],
 
     # Permission classes
@@ -105,7 +106,17 @@ REST_FRAMEWORK = {
         "%Y-%m-%dT%H:%M",
         "%Y-%m-%d %H:%M",
     ],
-    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend']
+    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+
+    # Keyset pagination on every list route
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.StableCursorPagination',
+    'PAGE_SIZE': 50,
+
+    # Per-user rates of the views that call the payment provider (patients.throttles)
+    'DEFAULT_THROTTLE_RATES': {
+        'payment-status': '10/min',
+        'checkout': '20/min',
+    },
 }
 
 CORS_ALLOWED_ORIGINS = [
@@ -122,6 +133,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Take the write lock when a transaction starts so concurrent bookings wait
+        # instead of failing with "database is locked" on lock upgrade
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
+        # An in-memory test database fails concurrent writers at once instead of making them wait,
+        # so tests run against a file to exercise the same locking as production
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -170,5 +192,92 @@ AUTH_USER_MODEL = 'core.User'
 
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
-
-STATIC_ROOT = os.path.join(BASE_DIR, 'static')
\ No newline at end of file
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# Point STRIPE_API_BASE at `manage.py fake_stripe` to run checkouts offline. Checkout calls share a
+# pool of STRIPE_POOL_SIZE connections and threads; a request waits at most STRIPE_CHECKOUT_WAIT_SECONDS
+# before answering that the checkout is pending, and STRIPE_BREAKER_FAILURES failures in a row stop
+# calls for STRIPE_BREAKER_RESET_SECONDS
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 3))
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', 10))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+STRIPE_POOL_SIZE = int(os.getenv('STRIPE_POOL_SIZE', 8))
+STRIPE_CHECKOUT_WAIT_SECONDS = float(os.getenv('STRIPE_CHECKOUT_WAIT_SECONDS', 2))
+STRIPE_BREAKER_FAILURES = 5
+STRIPE_BREAKER_RESET_SECONDS = 30
+# Open checkout sessions are reused per prescription until CHECKOUT_SESSION_EXPIRY_MARGIN seconds before
+# Stripe expires them, and for at most CHECKOUT_SESSION_CACHE_SECONDS. The cache only saves the provider
+# call: each reuse is checked against the payment and the doctor's fee in the database
+CHECKOUT_SESSION_CACHE_SECONDS = 60 * 60
+CHECKOUT_SESSION_EXPIRY_MARGIN = 5 * 60
+
+STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+
+# Default length of a bookable appointment slot; doctors can override it with Doctor.slot_minutes.
+# Both should be multiples of APPOINTMENT_GRANULARITY_MINUTES so every listed slot can be booked
+APPOINTMENT_SLOT_MINUTES = int(os.getenv('APPOINTMENT_SLOT_MINUTES', 30))
+
+# Appointments reserve the doctor's time in blocks of this many minutes, and may last at most
+# APPOINTMENT_MAX_MINUTES, which bounds how far back an overlap search has to look
+APPOINTMENT_GRANULARITY_MINUTES = 5
+APPOINTMENT_MAX_MINUTES = 240
+
+# Seconds a worker may serve its doctor directory snapshot before rebuilding it, even without an
+# invalidation; bounds staleness when workers do not share a cache backend
+DOCTOR_DIRECTORY_MAX_AGE = 60
+
+# Expose X-Query-Count / X-SQL-Time-Ms / X-Query-Budget response headers
+QUERY_BUDGET_HEADERS = DEBUG
+
+# Full-text search over medical history and prescriptions. The FTS5 backend needs SQLite; other
+# databases fall back to unranked substring matching until they get a backend of their own
+MEDICAL_SEARCH_BACKEND = os.getenv(
+    'MEDICAL_SEARCH_BACKEND',
+    'patients.search.SQLiteFTSBackend' if DATABASES['default']['ENGINE'].endswith('sqlite3') else 'patients.search.DatabaseSearchBackend',
+)
+
+# Workers poll the revocation log at most this often, which bounds how long a revoked user or token
+# can still be used elsewhere; the Bloom filter of revoked token ids is rebuilt from unexpired rows
+# every REVOCATION_REBUILD_SECONDS. 2**23 bits keeps false positives near 1% up to ~800k tokens
+REVOCATION_SYNC_SECONDS = 2
+REVOCATION_REBUILD_SECONDS = 3600
+REVOCATION_BLOOM_BITS = 2 ** 23
+REVOCATION_BLOOM_HASHES = 7
+
+# The billing analytics arrays (adminpanel.analytics) take new payments and prescriptions on every
+# report, and are reloaded in full this often to pick up edits and deletions
+BILLING_ANALYTICS_REBUILD_SECONDS = 900
+
+# Listing totals (?with_count=1) are cached until a save or delete on a table behind the listing, and
+# for at most this long, which bounds how stale writes that bypass the model signals leave them
+LISTING_COUNT_CACHE_SECONDS = 300
+
+# Hour-of-week utilization reports are cached per (start, end, group) window for this long
+UTILIZATION_CACHE_SECONDS = 300
+
+# Workers read catalogue (Medication) rows saved since their last sync at most this often, and reload
+# the whole catalogue this often to drop deleted rows
+MEDICATION_CATALOGUE_SYNC_SECONDS = 5
+MEDICATION_CATALOGUE_REBUILD_SECONDS = 3600
+
+# Workers rebuild their drug interaction table at most this long after a change they were not told
+# about. Interaction checks on a new prescription also cover what the patient was prescribed in the
+# last INTERACTION_LOOKBACK_DAYS
+INTERACTION_TABLE_MAX_AGE = 300
+INTERACTION_LOOKBACK_DAYS = 30
+
+# Bulk patient imports (adminpanel.imports): uploaded files are kept in PATIENT_IMPORT_DIR and read in
+# batches of PATIENT_IMPORT_BATCH_SIZE rows, one transaction each. Given passwords are hashed on
+# PATIENT_IMPORT_HASH_WORKERS processes; a running job not heard from in PATIENT_IMPORT_STALE_SECONDS
+# may be resumed
+PATIENT_IMPORT_DIR = os.getenv('PATIENT_IMPORT_DIR', os.path.join(BASE_DIR, 'imports'))
+PATIENT_IMPORT_BATCH_SIZE = 500
+PATIENT_IMPORT_HASH_WORKERS = int(os.getenv('PATIENT_IMPORT_HASH_WORKERS', os.cpu_count() or 1))
+PATIENT_IMPORT_STALE_SECONDS = 600
+PATIENT_IMPORT_IN_BACKGROUND = True
+
+# Duplicate patient detection (patients.duplicates): pairs scoring at least DUPLICATE_PATIENT_THRESHOLD
+# are reported. Patients are only compared when they share a blocking key, and a key shared by more
+# than DUPLICATE_PATIENT_MAX_BLOCK patients (a clinic's own phone number, say) is not used
+DUPLICATE_PATIENT_THRESHOLD = 0.8
+DUPLICATE_PATIENT_MAX_BLOCK = 200
@@ -1,7 +1,6 @@
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework_simplejwt.views import TokenRefreshView
-from core.views import CustomTokenObtainPairView
+from core.views import CustomTokenObtainPairView, CustomTokenRefreshView, revoke_tokens
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -9,5 +8,6 @@ urlpatterns = [
     path('api/doctors/', include('doctors.urls')),
     path('api/admin/', include('adminpanel.urls')),
     path('api/token/', CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh')
+    path('api/token/refresh/', CustomTokenRefreshView.as_view(), name='token_refresh'),
+    path('api/token/revoke/', revoke_tokens, name='token_revoke'),
 ]
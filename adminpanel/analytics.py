@@ -0,0 +1,447 @@
+import threading
+import time as time_module
+from datetime import date, timedelta
+from decimal import Decimal
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import BooleanField, ExpressionWrapper, Q
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay, ExtractMinute
+from django.utils import timezone
+from core import querybudget
+from doctors.models import Doctor, Payment, Prescription
+from doctors.slots import day_bounds
+from patients.models import Appointment
+
+GROUPS = ('doctor', 'specialization', 'day', 'week', 'month')
+AGING_GROUPS = ('none', 'doctor', 'specialization')
+# unpaid prescriptions are aged by days since they were written: 0-30, 31-60, 61-90, over 90
+AGING_EDGES = np.array([31, 61, 91])
+AGING_BUCKETS = ('0-30', '31-60', '61-90', '90+')
+EPOCH = date(1970, 1, 1)
+CHUNK_SIZE = 10000
+UTILIZATION_GROUPS = ('doctor', 'specialization')
+# how far before the latest payment update already seen the next incremental read starts
+UPDATE_OVERLAP = timedelta(minutes=1)
+MINUTES_PER_WEEK = 7 * 24 * 60
+# doctors whose per-minute occupancy (MINUTES_PER_WEEK int32 each, about 40 KB) is held at once
+UTILIZATION_DOCTOR_CHUNK = 64
+
+
+def _day_number(value):
+    """Days since 1970-01-01 of a datetime, in the current timezone."""
+    return (timezone.localtime(value).date() - EPOCH).days
+
+
+def _cents(amount):
+    return int(Decimal(amount or 0) * 100)
+
+
+def _money(cents):
+    return Decimal(int(round(cents))) / 100
+
+
+def _column(values, dtype):
+    return np.array(values, dtype=dtype) if values else np.empty(0, dtype=dtype)
+
+
+class BillingFacts:
+    """
+    Columnar, in-process copy of the billing tables. Prescriptions and payments are held as parallel
+    NumPy arrays (one entry per row) so reports are a handful of vectorized passes rather than
+    grouped queries over the whole table. Each request loads the prescriptions with ids above the
+    last one seen, and the payments that are new or were updated since the latest updated_at seen, so
+    a pending payment settling is applied in place; a paid payment marks its prescription paid.
+    Changes this cannot see (an edited fee, a deleted row, is_paid flipped by hand) are picked up by a
+    full reload every BILLING_ANALYTICS_REBUILD_SECONDS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.loaded_at = None
+        self.last_prescription_id = 0
+        self.last_payment_id = 0
+        self.payments_updated_at = None
+        # doctors dimension, sorted by id; specializations are interned as codes into `specializations`
+        self.doctor_ids = np.empty(0, dtype=np.int64)
+        self.doctor_names = []
+        self.doctor_specialization = np.empty(0, dtype=np.int32)
+        self.doctor_fee = np.empty(0, dtype=np.int64)
+        self.specializations = []
+        # prescription facts, in id order; the billed amount is the doctor's fee, as at checkout
+        self.prescription_ids = np.empty(0, dtype=np.int64)
+        self.prescription_doctor = np.empty(0, dtype=np.int32)
+        self.prescription_day = np.empty(0, dtype=np.int32)
+        self.prescription_paid = np.empty(0, dtype=bool)
+        # payment facts, in id order; `payment_prescription` indexes into the prescription arrays
+        self.payment_ids = np.empty(0, dtype=np.int64)
+        self.payment_prescription = np.empty(0, dtype=np.int64)
+        self.payment_day = np.empty(0, dtype=np.int32)
+        self.payment_amount = np.empty(0, dtype=np.int64)
+        self.payment_paid = np.empty(0, dtype=bool)
+
+    def _load_doctors(self):
+        codes = {name: code for code, name in enumerate(self.specializations)}
+        ids, names, specializations, fees = [], [], [], []
+        rows = Doctor.objects.order_by('id').values_list('id', 'user__first_name', 'user__last_name', 'specialization', 'consultation_fee')
+        for doctor_id, first_name, last_name, specialization, fee in rows.iterator(chunk_size=CHUNK_SIZE):
+            ids.append(doctor_id)
+            names.append(f'{first_name} {last_name}'.strip())
+            specializations.append(codes.setdefault(specialization, len(codes)))
+            fees.append(_cents(fee))
+        self.specializations = list(codes)
+        self.doctor_ids = _column(ids, np.int64)
+        self.doctor_names = names
+        self.doctor_specialization = _column(specializations, np.int32)
+        self.doctor_fee = _column(fees, np.int64)
+
+    def _append(self):
+        # payments first: any prescription they point at already exists, so the read below includes it
+        payment_rows = Payment.objects.filter(id__gt=self.last_payment_id)
+        if self.payments_updated_at is not None:
+            # saves from other workers can commit slightly out of updated_at order; re-applying a row is harmless
+            payment_rows |= Payment.objects.filter(updated_at__gte=self.payments_updated_at - UPDATE_OVERLAP)
+        payment_rows = payment_rows.order_by('id').values_list('id', 'prescription_id', 'created_at', 'amount', 'status', 'updated_at')
+        payment_ids, payment_prescriptions, payment_days, amounts, paid = [], [], [], [], []
+        updated_ids, updated_amounts, updated_paid = [], [], []
+        for payment_id, prescription_id, created_at, amount, status, updated_at in payment_rows.iterator(chunk_size=CHUNK_SIZE):
+            if self.payments_updated_at is None or updated_at > self.payments_updated_at:
+                self.payments_updated_at = updated_at
+            if payment_id <= self.last_payment_id:
+                updated_ids.append(payment_id)
+                updated_amounts.append(_cents(amount))
+                updated_paid.append(str(status).lower() == 'paid')
+                continue
+            payment_ids.append(payment_id)
+            payment_prescriptions.append(prescription_id)
+            payment_days.append(_day_number(created_at))
+            amounts.append(_cents(amount))
+            paid.append(str(status).lower() == 'paid')
+
+        prescription_rows = Prescription.objects.filter(id__gt=self.last_prescription_id).order_by('id').values_list('id', 'doctor_id', 'created_at', 'is_paid')
+        prescription_ids, prescription_doctors, prescription_days, prescription_paid = [], [], [], []
+        for prescription_id, doctor_id, created_at, is_paid in prescription_rows.iterator(chunk_size=CHUNK_SIZE):
+            prescription_ids.append(prescription_id)
+            prescription_doctors.append(doctor_id)
+            prescription_days.append(_day_number(created_at))
+            prescription_paid.append(is_paid)
+
+        if prescription_ids:
+            doctors = _column(prescription_doctors, np.int64)
+            if not np.isin(doctors, self.doctor_ids).all():
+                self._load_doctors()
+            self.prescription_ids = np.concatenate([self.prescription_ids, _column(prescription_ids, np.int64)])
+            self.prescription_doctor = np.concatenate([self.prescription_doctor, np.searchsorted(self.doctor_ids, doctors).astype(np.int32)])
+            self.prescription_day = np.concatenate([self.prescription_day, _column(prescription_days, np.int32)])
+            self.prescription_paid = np.concatenate([self.prescription_paid, _column(prescription_paid, bool)])
+            self.last_prescription_id = prescription_ids[-1]
+
+        if updated_ids:
+            ids = _column(updated_ids, np.int64)
+            index = np.searchsorted(self.payment_ids, ids)
+            found = index < len(self.payment_ids)
+            found[found] = self.payment_ids[index[found]] == ids[found]
+            index, updated_paid = index[found], _column(updated_paid, bool)[found]
+            self.payment_amount[index] = _column(updated_amounts, np.int64)[found]
+            self.payment_paid[index] = updated_paid
+            self.prescription_paid[self.payment_prescription[index[updated_paid]]] = True
+
+        if payment_ids:
+            targets = _column(payment_prescriptions, np.int64)
+            index = np.searchsorted(self.prescription_ids, targets)
+            # a payment whose prescription has since been deleted is dropped until the next reload
+            found = index < len(self.prescription_ids)
+            found[found] = self.prescription_ids[index[found]] == targets[found]
+            paid = _column(paid, bool)[found]
+            self.payment_ids = np.concatenate([self.payment_ids, _column(payment_ids, np.int64)[found]])
+            self.payment_prescription = np.concatenate([self.payment_prescription, index[found]])
+            self.payment_day = np.concatenate([self.payment_day, _column(payment_days, np.int32)[found]])
+            self.payment_amount = np.concatenate([self.payment_amount, _column(amounts, np.int64)[found]])
+            self.payment_paid = np.concatenate([self.payment_paid, paid])
+            self.prescription_paid[index[found][paid]] = True
+            self.last_payment_id = payment_ids[-1]
+
+    def _refresh(self):
+        if self.loaded_at is None or time_module.monotonic() - self.loaded_at > settings.BILLING_ANALYTICS_REBUILD_SECONDS:
+            self._clear()
+            with querybudget.unmetered():
+                self._load_doctors()
+                self._append()
+            self.loaded_at = time_module.monotonic()
+        else:
+            self._append()
+
+    def report(self, name, **options):
+        """Bring the arrays up to date, then run the `revenue` or `aging` report on them."""
+        with self._lock:
+            self._refresh()
+            return getattr(self, name)(**options)
+
+    # Grouping
+
+    def _keys(self, group, doctor, day):
+        """Integer group key per row, from the row's doctor index and day number."""
+        if group == 'doctor':
+            return doctor.astype(np.int64)
+        if group == 'specialization':
+            return self.doctor_specialization[doctor].astype(np.int64)
+        if group == 'week':
+            # 1970-01-01 was a Thursday; shifting by 3 makes weeks start on Monday
+            return (day.astype(np.int64) + 3) // 7
+        if group == 'month':
+            return day.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        return day.astype(np.int64)
+
+    def _label(self, group, key):
+        if group == 'doctor':
+            return {'doctor_id': int(self.doctor_ids[key]), 'doctor_name': self.doctor_names[key]}
+        if group == 'specialization':
+            return {'specialization': self.specializations[key]}
+        if group == 'week':
+            return {'period': EPOCH + timedelta(days=int(key) * 7 - 3)}
+        if group == 'month':
+            return {'period': date(1970 + int(key) // 12, int(key) % 12 + 1, 1)}
+        return {'period': EPOCH + timedelta(days=int(key))}
+
+    @staticmethod
+    def _in_range(day, start, end):
+        mask = np.ones(len(day), dtype=bool)
+        if start is not None:
+            mask &= day >= (start - EPOCH).days
+        if end is not None:
+            mask &= day <= (end - EPOCH).days
+        return mask
+
+    # Reports
+
+    def revenue(self, group='day', start=None, end=None):
+        """
+        Per-group billing between start and end (inclusive): prescriptions issued, paid and their
+        billed and outstanding amounts, dated by when they were written; payments and revenue, dated
+        by when they were made; and the collection rate (paid prescriptions / issued).
+        """
+        prescriptions = self._in_range(self.prescription_day, start, end)
+        payments = self._in_range(self.payment_day, start, end) & self.payment_paid
+        payment_doctor = self.prescription_doctor[self.payment_prescription[payments]]
+        prescription_keys = self._keys(group, self.prescription_doctor[prescriptions], self.prescription_day[prescriptions])
+        payment_keys = self._keys(group, payment_doctor, self.payment_day[payments])
+
+        # keys are small dense integers (indexes, or day/week/month numbers), so shifting them to start
+        # at zero lets every aggregate below be a single bincount; groups with no rows are dropped
+        if not len(prescription_keys) and not len(payment_keys):
+            return []
+        low = min(key.min() for key in (prescription_keys, payment_keys) if len(key))
+        high = max(key.max() for key in (prescription_keys, payment_keys) if len(key))
+        prescription_group, payment_group = prescription_keys - low, payment_keys - low
+        size = int(high - low) + 1
+
+        is_paid = self.prescription_paid[prescriptions]
+        billed = self.doctor_fee[self.prescription_doctor[prescriptions]]
+        issued = np.bincount(prescription_group, minlength=size)
+        paid = np.bincount(prescription_group, weights=is_paid, minlength=size)
+        billed_total = np.bincount(prescription_group, weights=billed, minlength=size)
+        outstanding = np.bincount(prescription_group, weights=billed * ~is_paid, minlength=size)
+        payment_count = np.bincount(payment_group, minlength=size)
+        revenue = np.bincount(payment_group, weights=self.payment_amount[payments], minlength=size)
+
+        rows = []
+        for i in np.flatnonzero(issued + payment_count):
+            rows.append({
+                **self._label(group, low + i),
+                'prescriptions': int(issued[i]),
+                'paid_prescriptions': int(paid[i]),
+                'collection_rate': round(paid[i] / issued[i], 4) if issued[i] else None,
+                'billed': _money(billed_total[i]),
+                'outstanding': _money(outstanding[i]),
+                'payments': int(payment_count[i]),
+                'revenue': _money(revenue[i]),
+            })
+        if group in ('doctor', 'specialization'):
+            rows.sort(key=lambda row: row['revenue'], reverse=True)
+        return rows
+
+    def aging(self, group='none', today=None):
+        """Unpaid prescriptions and their outstanding amount per age bucket, optionally per doctor or specialization."""
+        today = (today or timezone.localdate()) - EPOCH
+        unpaid = ~self.prescription_paid
+        doctor = self.prescription_doctor[unpaid]
+        bucket = np.digitize(today.days - self.prescription_day[unpaid], AGING_EDGES)
+        amount = self.doctor_fee[doctor]
+        buckets = len(AGING_BUCKETS)
+
+        if group == 'none':
+            counts = np.bincount(bucket, minlength=buckets)
+            totals = np.bincount(bucket, weights=amount, minlength=buckets)
+            return [
+                {'age': AGING_BUCKETS[b], 'prescriptions': int(counts[b]), 'outstanding': _money(totals[b])}
+                for b in range(buckets)
+            ]
+
+        keys = self._keys(group, doctor, None)
+        # one bincount over (group, bucket) pairs laid out as group * buckets + bucket
+        groups, inverse = np.unique(keys, return_inverse=True)
+        cells = inverse * buckets + bucket
+        counts = np.bincount(cells, minlength=len(groups) * buckets).reshape(-1, buckets)
+        totals = np.bincount(cells, weights=amount, minlength=len(groups) * buckets).reshape(-1, buckets)
+        rows = []
+        for i, key in enumerate(groups):
+            rows.append({
+                **self._label(group, key),
+                'prescriptions': int(counts[i].sum()),
+                'outstanding': _money(totals[i].sum()),
+                'buckets': [
+                    {'age': AGING_BUCKETS[b], 'prescriptions': int(counts[i, b]), 'outstanding': _money(totals[i, b])}
+                    for b in range(buckets)
+                ],
+            })
+        rows.sort(key=lambda row: row['outstanding'], reverse=True)
+        return rows
+
+
+billing_facts = BillingFacts()
+
+
+def _minute_of_day(value):
+    return value.hour * 60 + value.minute if value is not None else 0
+
+
+def _weekday_counts(start, end):
+    """How many Mondays .. Sundays fall between start and end, inclusive."""
+    days = np.arange(np.datetime64(start), np.datetime64(end) + 1)
+    # day 0 (1970-01-01) was a Thursday, ISO weekday 4
+    return np.bincount((days.astype(np.int64) + 3) % 7, minlength=7)
+
+
+def _ratio(numerator, denominator):
+    return round(float(numerator) / float(denominator), 4) if denominator else None
+
+
+def _matrix(values):
+    """Nested lists rounded to 4 places, with None where the value is undefined (NaN)."""
+    return [[None if np.isnan(value) else value for value in row] for row in np.round(values, 4).tolist()]
+
+
+def _booked_minutes(doctor, starts, ends, count):
+    """
+    Booked minutes per doctor and hour of the week, as a (count, 7, 24) array. Each appointment adds
+    +1/-1 at its start/end minute and a running sum gives how many are in progress at every minute; a
+    late-Sunday appointment that runs past midnight wraps to Monday. The per-minute rows are built for
+    UTILIZATION_DOCTOR_CHUNK doctors at a time and reduced to hours before the next chunk, so memory
+    stays flat however many doctors there are.
+    """
+    booked = np.zeros((count, 7, 24), dtype=np.int64)
+    order = np.argsort(doctor, kind='stable')
+    doctor, starts, ends = doctor[order], starts[order], ends[order]
+    for first in range(0, count, UTILIZATION_DOCTOR_CHUNK):
+        last = min(first + UTILIZATION_DOCTOR_CHUNK, count)
+        lo, hi = np.searchsorted(doctor, [first, last])
+        rows, chunk_starts, chunk_ends = doctor[lo:hi] - first, starts[lo:hi], ends[lo:hi]
+        occupancy = np.zeros((last - first, MINUTES_PER_WEEK + 1), dtype=np.int32)
+        np.add.at(occupancy, (rows, chunk_starts), 1)
+        np.add.at(occupancy, (rows, np.minimum(chunk_ends, MINUTES_PER_WEEK)), -1)
+        wraps = chunk_ends > MINUTES_PER_WEEK
+        np.add.at(occupancy, (rows[wraps], 0), 1)
+        np.add.at(occupancy, (rows[wraps], chunk_ends[wraps] - MINUTES_PER_WEEK), -1)
+        booked[first:last] = np.cumsum(occupancy[:, :MINUTES_PER_WEEK], axis=1).reshape(-1, 7, 24, 60).sum(axis=3)
+    return booked
+
+
+def _compute_utilization(start, end, group):
+    doctor_rows = list(Doctor.objects.order_by('id').values_list('id', 'user__first_name', 'user__last_name', 'specialization', 'available_from', 'available_to'))
+    if not doctor_rows:
+        return []
+    doctor_ids = np.array([row[0] for row in doctor_rows], dtype=np.int64)
+
+    # one row per active appointment: doctor, minute of the week it starts (local time), length, outcome
+    window_start, window_end = day_bounds(start)[0], day_bounds(end)[1]
+    rows = list(
+        Appointment.objects.filter(status=True, scheduled_at__gte=window_start, scheduled_at__lt=window_end)
+        .annotate(
+            weekday=ExtractIsoWeekDay('scheduled_at'), hour=ExtractHour('scheduled_at'), minute=ExtractMinute('scheduled_at'),
+            is_past=ExpressionWrapper(Q(ends_at__lte=timezone.now()), output_field=BooleanField()),
+        )
+        .values_list('doctor_id', 'weekday', 'hour', 'minute', 'duration_minutes', 'prescription_given', 'is_past')
+    )
+    facts = np.array(rows, dtype=np.int64).reshape(-1, 7)
+    doctor = np.searchsorted(doctor_ids, facts[:, 0])
+    starts = (facts[:, 1] - 1) * 1440 + facts[:, 2] * 60 + facts[:, 3]
+    ends = starts + facts[:, 4]
+    completed, past = facts[:, 5].astype(bool), facts[:, 6].astype(bool)
+    cell = starts // 60
+
+    count = len(doctor_rows)
+    booked = _booked_minutes(doctor, starts, ends, count)
+
+    # available minutes per hour of the week: the overlap of each doctor's daily window with each
+    # hour, times how many of that weekday the range covers
+    window_from = np.array([_minute_of_day(row[4]) for row in doctor_rows])
+    window_to = np.array([_minute_of_day(row[5]) if row[4] is not None else 0 for row in doctor_rows])  # no window, no capacity
+    hour_starts = np.arange(24) * 60
+    daily = np.clip(np.minimum(window_to[:, None], hour_starts + 60) - np.maximum(window_from[:, None], hour_starts), 0, None)
+    available = _weekday_counts(start, end)[None, :, None] * daily[:, None, :]
+
+    appointments = np.zeros((count, 168), dtype=np.int64)
+    finished = np.zeros((count, 168), dtype=np.int64)
+    done = np.zeros((count, 168), dtype=np.int64)
+    np.add.at(appointments, (doctor, cell), 1)
+    np.add.at(finished, (doctor[past], cell[past]), 1)
+    np.add.at(done, (doctor[past & completed], cell[past & completed]), 1)
+
+    if group == 'specialization':
+        codes = {}
+        keys = np.array([codes.setdefault(row[3], len(codes)) for row in doctor_rows])
+        labels = [{'specialization': name, 'doctors': int((keys == code).sum())} for name, code in codes.items()]
+    else:
+        keys = np.arange(count)
+        labels = [{'doctor_id': row[0], 'doctor_name': f'{row[1]} {row[2]}'.strip(), 'specialization': row[3]} for row in doctor_rows]
+
+    def by_group(values):
+        totals = np.zeros((len(labels), *values.shape[1:]), dtype=values.dtype)
+        np.add.at(totals, keys, values)
+        return totals
+
+    booked, available = by_group(booked), by_group(available)
+    appointments, finished, done = (by_group(values).reshape(-1, 7, 24) for values in (appointments, finished, done))
+
+    results = []
+    for i, label in enumerate(labels):
+        if not available[i].any() and not appointments[i].any():
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            utilization = np.where(available[i] > 0, booked[i] / available[i], np.nan)
+            completion = np.where(finished[i] > 0, done[i] / finished[i], np.nan)
+        results.append({
+            **label,
+            'appointments': int(appointments[i].sum()),
+            'completed': int(done[i].sum()),
+            'no_shows': int(finished[i].sum() - done[i].sum()),
+            'completion_rate': _ratio(done[i].sum(), finished[i].sum()),
+            'no_show_rate': _ratio(finished[i].sum() - done[i].sum(), finished[i].sum()),
+            'utilization': _ratio(booked[i].sum(), available[i].sum()),
+            # 7 x 24 matrices, Monday first, hours in local time; null where the ratio is undefined
+            'booked_minutes': booked[i].tolist(),
+            'available_minutes': available[i].tolist(),
+            'utilization_matrix': _matrix(utilization),
+            'appointment_matrix': appointments[i].tolist(),
+            'completion_matrix': _matrix(completion),
+        })
+    return results
+
+
+def utilization(start, end, group='doctor'):
+    """
+    Hour-of-week utilization per doctor or specialization between start and end (inclusive): booked
+    appointment minutes against the available_from/available_to window, and the completion and
+    no-show ratios of appointments that have already ended (completed = prescription given).
+    Cancelled appointments are left out. Results are cached per window for UTILIZATION_CACHE_SECONDS.
+    """
+    key = f'utilization:{start}:{end}:{group}'
+    results = cache.get(key)
+    if results is None:
+        results = _compute_utilization(start, end, group)
+        cache.set(key, results, settings.UTILIZATION_CACHE_SECONDS)
+    return results
+
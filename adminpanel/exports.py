@@ -0,0 +1,152 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from django.utils import timezone
+from doctors.medications import medications_by_prescription
+from doctors.models import Payment, Prescription
+from patients.models import Appointment
+
+CHUNK_SIZE = 2000
+FORMATS = ('csv', 'ndjson')
+TRUE_VALUES = ('1', 'true', 'True', 'yes')
+FALSE_VALUES = ('0', 'false', 'False', 'no')
+
+
+class ExportError(Exception):
+    pass
+
+
+def _full_name(first_name, last_name):
+    return f'{first_name} {last_name}'.strip()
+
+
+def _boolean(name, value):
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ExportError(f'{name} should be true or false')
+
+
+# Each export reads plain columns with values_list, so related names come from the same
+# joined query instead of a lookup per row. `names` pairs up first/last name columns. A
+# 'medications' column is filled in from the line items, with one query per chunk of rows.
+EXPORTS = {
+    'appointments': {
+        'model': Appointment,
+        'date_field': 'scheduled_at',
+        'columns': ['id', 'scheduled_at', 'ends_at', 'duration_minutes', 'status', 'prescription_given', 'patient_id', 'doctor_id'],
+        'names': {
+            'patient_name': ('patient__user__first_name', 'patient__user__last_name'),
+            'doctor_name': ('doctor__user__first_name', 'doctor__user__last_name'),
+        },
+        'filters': {'status': 'status', 'is_paid': 'prescription__is_paid'},
+    },
+    'prescriptions': {
+        'model': Prescription,
+        'date_field': 'created_at',
+        'columns': ['id', 'created_at', 'appointment_id', 'patient_id', 'doctor_id', 'diagnosis', 'medications', 'is_paid'],
+        'names': {
+            'patient_name': ('patient__user__first_name', 'patient__user__last_name'),
+            'doctor_name': ('doctor__user__first_name', 'doctor__user__last_name'),
+        },
+        'filters': {'is_paid': 'is_paid'},
+    },
+    'payments': {
+        'model': Payment,
+        'date_field': 'created_at',
+        'columns': ['id', 'created_at', 'amount', 'status', 'prescription_id', 'prescription__is_paid'],
+        'names': {
+            'patient_name': ('prescription__patient__user__first_name', 'prescription__patient__user__last_name'),
+            'doctor_name': ('prescription__doctor__user__first_name', 'prescription__doctor__user__last_name'),
+        },
+        'filters': {'status': 'status', 'is_paid': 'prescription__is_paid'},
+    },
+}
+
+
+def header(resource):
+    spec = EXPORTS[resource]
+    return [column.replace('prescription__', '') for column in spec['columns']] + list(spec['names'])
+
+
+def export_queryset(resource, start=None, end=None, status=None, is_paid=None):
+    """Validate the filters and build the values_list query for an export."""
+    if resource not in EXPORTS:
+        raise ExportError(f'Unknown export "{resource}", expected one of {", ".join(EXPORTS)}')
+    spec = EXPORTS[resource]
+    queryset = spec['model'].objects.order_by('id')
+
+    if start:
+        queryset = queryset.filter(**{f'{spec["date_field"]}__gte': timezone.make_aware(datetime.combine(start, time.min))})
+    if end:
+        queryset = queryset.filter(**{f'{spec["date_field"]}__lt': timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min))})
+    if status not in (None, ''):
+        if 'status' not in spec['filters']:
+            raise ExportError(f'{resource} cannot be filtered by status')
+        if resource == 'appointments':
+            status = _boolean('status', status)
+        queryset = queryset.filter(**{spec['filters']['status']: status})
+    if is_paid not in (None, ''):
+        queryset = queryset.filter(**{spec['filters']['is_paid']: _boolean('is_paid', is_paid)})
+
+    name_columns = [column for pair in spec['names'].values() for column in pair]
+    return queryset.values_list(*[column for column in spec['columns'] if column != 'medications'], *name_columns)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def rows(resource, queryset):
+    """Yield export rows as lists, reading the table in chunks so memory stays flat."""
+    columns = EXPORTS[resource]['columns']
+    medications_at = columns.index('medications') if 'medications' in columns else None
+    width = len(columns) - (medications_at is not None)
+    for chunk in _chunks(queryset.iterator(chunk_size=CHUNK_SIZE), CHUNK_SIZE):
+        medications = medications_by_prescription([values[0] for values in chunk]) if medications_at is not None else {}
+        for values in chunk:
+            names = values[width:]
+            row = list(values[:width])
+            if medications_at is not None:
+                row.insert(medications_at, json.dumps(medications.get(values[0], [])))
+            yield row + [_full_name(names[i], names[i + 1]) for i in range(0, len(names), 2)]
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def render(resource, queryset, output='csv'):
+    """Return an iterator over the export as CSV or newline-delimited JSON, one line at a time."""
+    if output not in FORMATS:
+        raise ExportError(f'output should be one of {", ".join(FORMATS)}')
+    return _render(header(resource), rows(resource, queryset), output)
+
+
+def _render(columns, row_iter, output):
+    if output == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(columns)
+        for row in row_iter:
+            yield writer.writerow([_json_value(value) for value in row])
+    else:
+        for row in row_iter:
+            yield json.dumps(dict(zip(columns, map(_json_value, row)))) + '\n'
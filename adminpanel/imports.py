@@ -0,0 +1,261 @@
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import islice
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from rest_framework import serializers
+from core.models import User
+from patients.models import Patient
+from patients.serializers import RegisterPatientSerializer
+from patients.signals import patients_bulk_created
+from .exports import FORMATS, _chunks, _render
+from .models import PatientImport, PatientImportError
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = ('username', 'email', 'first_name', 'last_name')
+ERROR_COLUMNS = ['row', 'username', 'field', 'error']
+
+
+class ImportFileError(Exception):
+    pass
+
+
+class PatientRowSerializer(RegisterPatientSerializer):
+    """One row of an import file: the registration fields, with the password optional."""
+    username = serializers.CharField(write_only=True, max_length=150, validators=[UnicodeUsernameValidator()])
+    password = serializers.CharField(write_only=True, required=False, allow_blank=True)
+
+
+def format_for(filename, requested=None):
+    """The import format asked for, or the one the file name suggests."""
+    fmt = requested or ('ndjson' if os.path.splitext(filename)[1].lower() in ('.ndjson', '.jsonl') else 'csv')
+    if fmt not in FORMATS:
+        raise ImportFileError(f'format should be one of {", ".join(FORMATS)}')
+    return fmt
+
+
+def read_rows(path, fmt):
+    """
+    Yield (row number, dict) for each data row, numbered from 1, reading the file as a stream. A
+    row that cannot be parsed comes through as (row number, error message) so it can be reported.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            if not reader.fieldnames or 'username' not in reader.fieldnames:
+                raise ImportFileError('The file needs a header row with at least a "username" column')
+            for number, row in enumerate(reader, start=1):
+                yield number, {name: value for name, value in row.items() if name}
+        else:
+            for number, line in enumerate((line for line in f if line.strip()), start=1):
+                try:
+                    value = json.loads(line)
+                except ValueError as e:
+                    yield number, f'Not valid JSON: {e}'
+                    continue
+                yield number, value if isinstance(value, dict) else 'Each line should be a JSON object'
+
+
+def _clean(data):
+    # blank cells mean "not given", so optional fields fall back to their defaults
+    cleaned = {}
+    for name, value in data.items():
+        if isinstance(value, str):
+            value = value.strip()
+        if value not in ('', None):
+            cleaned[name] = value
+    return cleaned
+
+
+def _messages(errors):
+    return {field: [str(message) for message in messages] for field, messages in errors.items()}
+
+
+@contextmanager
+def password_hasher(workers):
+    """
+    A function hashing a list of passwords. PBKDF2 is deliberately slow, so with more than one worker
+    the hashes are computed in a process pool. Workers are spawned, as the caller may be a threaded
+    web worker, and set Django up themselves before their first hash.
+    """
+    if workers <= 1:
+        yield lambda passwords: [make_password(password) for password in passwords]
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup) as pool:
+        yield lambda passwords: list(pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def claim(job_id):
+    """Mark a job running if nothing else is working on it; a running job gone quiet counts as abandoned."""
+    stale = timezone.now() - timedelta(seconds=settings.PATIENT_IMPORT_STALE_SECONDS)
+    return bool(
+        PatientImport.objects.filter(Q(status__in=[PatientImport.PENDING, PatientImport.FAILED]) | Q(status=PatientImport.RUNNING, updated_at__lt=stale), id=job_id)
+        .update(status=PatientImport.RUNNING, message='', updated_at=timezone.now())
+    )
+
+
+def _accounts(valid, hashes):
+    users, patients = [], []
+    for number, data in valid:
+        data = dict(data)
+        password = data.pop('password', '')
+        user = User(role='patient', password=hashes[number] if password else make_password(None), **{field: data.pop(field) for field in USER_FIELDS})
+        users.append(user)
+        patients.append(Patient(user=user, **data))
+    return users, patients
+
+
+def _untaken(job, valid, errors):
+    """The valid rows whose username is still free; the others are added to `errors`."""
+    taken = set(User.objects.filter(username__in=[data['username'] for _, data in valid]).values_list('username', flat=True))
+    errors += [
+        PatientImportError(job=job, row=number, username=data['username'], errors={'username': ['A user with that username already exists.']})
+        for number, data in valid if data['username'] in taken
+    ]
+    return [(number, data) for number, data in valid if data['username'] not in taken]
+
+
+def _import_batch(job, batch, seen, hash_passwords):
+    errors, valid = [], []
+    # one serializer validates the whole batch, so its fields are built once rather than per row
+    serializer = PatientRowSerializer()
+    for number, data in batch:
+        if isinstance(data, str):
+            errors.append(PatientImportError(job=job, row=number, errors={'row': [data]}))
+            continue
+        try:
+            validated = serializer.run_validation(_clean(data))
+        except serializers.ValidationError as e:
+            errors.append(PatientImportError(job=job, row=number, username=str(data.get('username') or '')[:150], errors=_messages(e.detail)))
+            continue
+        if validated['username'] in seen:
+            errors.append(PatientImportError(job=job, row=number, username=validated['username'], errors={'username': ['Appears earlier in the file.']}))
+        else:
+            seen.add(validated['username'])
+            valid.append((number, validated))
+
+    # hashing happens before the transaction, which then only holds the inserts
+    valid = _untaken(job, valid, errors)
+    hashes = dict(zip(
+        [number for number, data in valid if data.get('password')],
+        hash_passwords([data['password'] for _, data in valid if data.get('password')]),
+    ))
+    for attempt in range(2):
+        users, patients = _accounts(valid, hashes)
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                Patient.objects.bulk_create(patients)
+                PatientImportError.objects.bulk_create(errors)
+                PatientImport.objects.filter(id=job.id).update(
+                    processed_rows=batch[-1][0], created_count=F('created_count') + len(patients),
+                    error_count=F('error_count') + len(errors), updated_at=timezone.now(),
+                )
+                patients_bulk_created.send(sender=Patient, patients=patients)
+            break
+        except IntegrityError:
+            # another registration took one of the usernames after the check; look again once
+            if attempt:
+                raise
+            valid = _untaken(job, valid, errors)
+    job.processed_rows = batch[-1][0]
+    job.created_count += len(patients)
+    job.error_count += len(errors)
+
+
+def run(job, batch_size=None, workers=None, progress=None):
+    """
+    Import a claimed job's file from where it left off, one batch of rows per transaction. Calls
+    `progress(job)` after each batch. The job ends up done, or failed with the reason in `message`.
+    """
+    batch_size = batch_size or settings.PATIENT_IMPORT_BATCH_SIZE
+    workers = settings.PATIENT_IMPORT_HASH_WORKERS if workers is None else workers
+    try:
+        if job.total_rows is None:
+            job.total_rows = sum(1 for _ in read_rows(job.file, job.format))
+            job.save(update_fields=['total_rows', 'updated_at'])
+        # usernames of the rows before a resume point are in the user table by now, if they were valid
+        seen = set()
+        with password_hasher(workers) as hash_passwords:
+            for batch in _chunks(islice(read_rows(job.file, job.format), job.processed_rows, None), batch_size):
+                _import_batch(job, batch, seen, hash_passwords)
+                if progress:
+                    progress(job)
+    except Exception as e:
+        job.status, job.message = PatientImport.FAILED, str(e) or e.__class__.__name__
+        job.save(update_fields=['status', 'message', 'updated_at'])
+        raise
+    job.status, job.finished_at = PatientImport.DONE, timezone.now()
+    job.save(update_fields=['status', 'finished_at', 'updated_at'])
+    return job
+
+
+def _run_in_background(job_id):
+    try:
+        run(PatientImport.objects.get(id=job_id))
+    except Exception:
+        logger.exception('Patient import %s failed', job_id)
+    finally:
+        connection.close()
+
+
+def start(job):
+    """Claim a job and run it, on a background thread unless PATIENT_IMPORT_IN_BACKGROUND is off."""
+    if not claim(job.id):
+        return False
+    if settings.PATIENT_IMPORT_IN_BACKGROUND:
+        threading.Thread(target=_run_in_background, args=(job.id,), name=f'patient-import-{job.id}', daemon=True).start()
+    else:
+        try:
+            run(PatientImport.objects.get(id=job.id))
+        except Exception:
+            logger.exception('Patient import %s failed', job.id)
+    return True
+
+
+def create_job(source, filename, fmt=None, user_id=None):
+    """Copy an uploaded file (an iterable of byte chunks) into PATIENT_IMPORT_DIR and make a job for it."""
+    fmt = format_for(filename, fmt)
+    os.makedirs(settings.PATIENT_IMPORT_DIR, exist_ok=True)
+    path = os.path.join(settings.PATIENT_IMPORT_DIR, f'{uuid.uuid4().hex}.{fmt}')
+    with open(path, 'wb') as f:
+        for chunk in source:
+            f.write(chunk)
+    return PatientImport.objects.create(file=path, format=fmt, created_by_id=user_id)
+
+
+def summary(job):
+    return {
+        'id': job.id, 'status': job.status, 'format': job.format, 'total_rows': job.total_rows,
+        'processed_rows': job.processed_rows, 'created': job.created_count, 'errors': job.error_count,
+        'percent': round(100 * job.processed_rows / job.total_rows, 1) if job.total_rows else None,
+        'message': job.message, 'created_at': job.created_at, 'updated_at': job.updated_at, 'finished_at': job.finished_at,
+    }
+
+
+def error_rows(job):
+    """One report row per field error of the job's rejected rows, in file order."""
+    for error in job.errors.order_by('row').iterator(chunk_size=2000):
+        for field, messages in error.errors.items():
+            for message in messages:
+                yield [error.row, error.username, field, message]
+
+
+def error_report(job, output='csv'):
+    if output not in FORMATS:
+        raise ImportFileError(f'output should be one of {", ".join(FORMATS)}')
+    return _render(ERROR_COLUMNS, error_rows(job), output)
@@ -0,0 +1,42 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from adminpanel import exports
+
+
+class Command(BaseCommand):
+    help = 'Stream appointments, prescriptions or payments to a CSV or NDJSON file (or stdout) in constant memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', choices=list(exports.EXPORTS))
+        parser.add_argument('--output', choices=exports.FORMATS, default='csv')
+        parser.add_argument('--file', help='Write to this path instead of stdout')
+        parser.add_argument('--start', help='First date to include (YYYY-MM-DD)')
+        parser.add_argument('--end', help='Last date to include (YYYY-MM-DD)')
+        parser.add_argument('--status', help='Appointment status (true/false) or payment status (pending/paid)')
+        parser.add_argument('--is-paid', choices=['true', 'false'])
+
+    def handle(self, *args, **options):
+        start = parse_date(options['start']) if options['start'] else None
+        end = parse_date(options['end']) if options['end'] else None
+        if (options['start'] and not start) or (options['end'] and not end):
+            raise CommandError('--start and --end should be dates in YYYY-MM-DD format')
+
+        try:
+            queryset = exports.export_queryset(options['resource'], start, end, options['status'], options['is_paid'])
+            lines = exports.render(options['resource'], queryset, options['output'])
+        except exports.ExportError as e:
+            raise CommandError(str(e))
+
+        out = open(options['file'], 'w', newline='') if options['file'] else sys.stdout
+        written = -1 if options['output'] == 'csv' else 0
+        try:
+            for line in lines:
+                out.write(line)
+                written += 1
+        finally:
+            if options['file']:
+                out.close()
+
+        if options['file']:
+            self.stderr.write(self.style.SUCCESS(f'Exported {written} {options["resource"]} to {options["file"]}'))
@@ -0,0 +1,59 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from adminpanel import imports
+from adminpanel.models import PatientImport
+
+
+class Command(BaseCommand):
+    help = (
+        'Register patients in bulk from a CSV or NDJSON file with the registration fields (username, email, '
+        'first_name, last_name, gender, address, phone, ...). Rows with a password get it hashed on a process '
+        'pool; rows without one get an account that waits for `patient_invitations`. Rows are committed in '
+        'batches, so an interrupted import continues with --resume.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?')
+        parser.add_argument('--format', choices=imports.FORMATS, help='Defaults to ndjson for .ndjson/.jsonl files and csv otherwise')
+        parser.add_argument('--resume', type=int, metavar='JOB_ID', help='Continue an earlier import instead of starting one')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--workers', type=int, help='Password hashing processes (PATIENT_IMPORT_HASH_WORKERS)')
+        parser.add_argument('--errors', help='Write the rejected rows to this CSV file')
+
+    def _progress(self, job):
+        total = f' of {job.total_rows}' if job.total_rows is not None else ''
+        self.stdout.write(f'Row {job.processed_rows}{total}: {job.created_count} created, {job.error_count} rejected')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size should be at least 1')
+        if options['resume']:
+            job = PatientImport.objects.filter(id=options['resume']).first()
+            if job is None:
+                raise CommandError(f'There is no import #{options["resume"]}')
+        elif options['file']:
+            try:
+                with open(options['file'], 'rb') as f:
+                    job = imports.create_job(iter(lambda: f.read(1024 * 1024), b''), os.path.basename(options['file']), options['format'])
+            except OSError as e:
+                raise CommandError(f'Cannot read {options["file"]}: {e}')
+            except imports.ImportFileError as e:
+                raise CommandError(str(e))
+        else:
+            raise CommandError('Give a file to import or --resume JOB_ID')
+
+        if not imports.claim(job.id):
+            raise CommandError(f'Import #{job.id} is {job.status} and cannot be run now')
+        job.refresh_from_db()
+        self.stdout.write(f'Import #{job.id}, starting after row {job.processed_rows}')
+        try:
+            imports.run(job, options['batch_size'], options['workers'], progress=self._progress)
+        except (imports.ImportFileError, OSError) as e:
+            raise CommandError(f'Import #{job.id} stopped: {e}')
+        finally:
+            if options['errors']:
+                with open(options['errors'], 'w', newline='') as out:
+                    for line in imports.error_report(job):
+                        out.write(line)
+
+        self.stdout.write(self.style.SUCCESS(f'Import #{job.id} done: {job.created_count} created, {job.error_count} rejected'))
@@ -0,0 +1,31 @@
+import csv
+from django.contrib.auth.tokens import default_token_generator
+from django.core.management.base import BaseCommand
+from core.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'List patients who were imported without a password and have not set one yet, with the token '
+        'each needs to set it at /api/patients/set-password/. Tokens expire after PASSWORD_RESET_TIMEOUT; '
+        'run this again for fresh ones.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='Write the CSV to this path instead of stdout')
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(role='patient', password__startswith='!', last_login__isnull=True).order_by('id')
+        out = open(options['file'], 'w', newline='') if options['file'] else self.stdout
+        count = 0
+        try:
+            writer = csv.writer(out)
+            writer.writerow(['username', 'email', 'token'])
+            for user in users.iterator(chunk_size=2000):
+                writer.writerow([user.username, user.email, default_token_generator.make_token(user)])
+                count += 1
+        finally:
+            if options['file']:
+                out.close()
+        if options['file']:
+            self.stderr.write(self.style.SUCCESS(f'Wrote {count} invitations to {options["file"]}'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from adminpanel import stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the dashboard counters and daily rollups from the source tables and repair any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it')
+
+    def handle(self, *args, **options):
+        corrections = stats.reconcile(dry_run=options['dry_run'])
+        for name, day, stored, expected in corrections:
+            where = f' on {day}' if day else ''
+            self.stdout.write(f'{name}{where}: {stored} -> {expected}')
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(corrections)} drifted values'))
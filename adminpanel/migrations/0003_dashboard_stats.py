@@ -0,0 +1,79 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:29
+
+from collections import defaultdict
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+# What the dashboard statistics counted as of this migration: (model, date field, {DailyStat column: aggregate})
+SOURCES = [
+    ('patients.Patient', 'user__date_joined', {'new_patients': Count('id')}),
+    ('doctors.Doctor', 'user__date_joined', {'new_doctors': Count('id')}),
+    ('patients.Appointment', 'scheduled_at', {
+        'appointments': Count('id'),
+        'appointments_active': Count('id', filter=Q(status=True)),
+        'appointments_completed': Count('id', filter=Q(prescription_given=True)),
+    }),
+    ('doctors.Prescription', 'created_at', {'prescriptions': Count('id'), 'prescriptions_paid': Count('id', filter=Q(is_paid=True))}),
+    ('doctors.Payment', 'created_at', {'revenue': Sum('amount', filter=Q(status__iexact='paid'))}),
+]
+# StatCounter name -> DailyStat column; every source row has a date, so the totals are the sums of the days
+COUNTERS = {
+    'patients': 'new_patients', 'doctors': 'new_doctors', 'appointments': 'appointments',
+    'appointments_active': 'appointments_active', 'appointments_completed': 'appointments_completed',
+    'prescriptions': 'prescriptions', 'prescriptions_paid': 'prescriptions_paid', 'revenue': 'revenue',
+}
+
+
+def fill_stats(apps, schema_editor):
+    daily = defaultdict(dict)
+    for model, date_field, aggregates in SOURCES:
+        day = TruncDate(date_field, tzinfo=timezone.get_current_timezone())
+        for row in apps.get_model(model).objects.annotate(day=day).values('day').annotate(**aggregates).order_by():
+            daily[row.pop('day')].update({column: value or 0 for column, value in row.items()})
+    DailyStat = apps.get_model('adminpanel', 'DailyStat')
+    DailyStat.objects.bulk_create([DailyStat(date=day, **values) for day, values in daily.items()], batch_size=500)
+    StatCounter = apps.get_model('adminpanel', 'StatCounter')
+    StatCounter.objects.bulk_create([
+        StatCounter(name=name, value=sum(values.get(column, 0) for values in daily.values()))
+        for name, column in COUNTERS.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adminpanel', '0002_initial'),
+        ('doctors', '0011_careteammember'),
+        ('patients', '0010_medical_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('new_patients', models.IntegerField(default=0)),
+                ('new_doctors', models.IntegerField(default=0)),
+                ('appointments', models.IntegerField(default=0)),
+                ('appointments_active', models.IntegerField(default=0)),
+                ('appointments_completed', models.IntegerField(default=0)),
+                ('prescriptions', models.IntegerField(default=0)),
+                ('prescriptions_paid', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.4 on 2026-10-18 08:10
+
+from decimal import ROUND_HALF_UP, Decimal
+from django.db import migrations, models
+
+
+def to_cents(amount):
+    return int((Decimal(str(amount)) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def revenue_to_cents(apps, schema_editor):
+    DailyStat = apps.get_model('adminpanel', 'DailyStat')
+    for stat in DailyStat.objects.exclude(revenue=0).only('id', 'revenue'):
+        DailyStat.objects.filter(id=stat.id).update(revenue_cents=to_cents(stat.revenue))
+    StatCounter = apps.get_model('adminpanel', 'StatCounter')
+    for counter in StatCounter.objects.filter(name='revenue'):
+        StatCounter.objects.filter(id=counter.id).update(name='revenue_cents', value=to_cents(counter.value))
+
+
+def revenue_from_cents(apps, schema_editor):
+    DailyStat = apps.get_model('adminpanel', 'DailyStat')
+    for stat in DailyStat.objects.exclude(revenue_cents=0).only('id', 'revenue_cents'):
+        DailyStat.objects.filter(id=stat.id).update(revenue=Decimal(stat.revenue_cents).scaleb(-2))
+    StatCounter = apps.get_model('adminpanel', 'StatCounter')
+    for counter in StatCounter.objects.filter(name='revenue_cents'):
+        StatCounter.objects.filter(id=counter.id).update(name='revenue', value=Decimal(int(counter.value)).scaleb(-2))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adminpanel', '0004_patient_import'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailystat',
+            name='revenue_cents',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(revenue_to_cents, revenue_from_cents),
+        migrations.RemoveField(
+            model_name='dailystat',
+            name='revenue',
+        ),
+        migrations.AlterField(
+            model_name='statcounter',
+            name='value',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -8,4 +8,70 @@ class Admin(models.Model):
 
     def __str__(self):
         return f'{self.user.get_full_name()}'
-    
\ No newline at end of file
+    
+
+class StatCounter(models.Model):
+    # Running totals behind the dashboard, kept in sync by adminpanel.signals and repaired by reconcile_stats;
+    # money is counted in cents (revenue_cents) so the database adds integers
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class DailyStat(models.Model):
+    # Per-day rollup of the same activity, for date-range breakdowns without scanning the source tables
+    date = models.DateField(unique=True)
+    new_patients = models.IntegerField(default=0)
+    new_doctors = models.IntegerField(default=0)
+    appointments = models.IntegerField(default=0)
+    appointments_active = models.IntegerField(default=0)
+    appointments_completed = models.IntegerField(default=0)
+    prescriptions = models.IntegerField(default=0)
+    prescriptions_paid = models.IntegerField(default=0)
+    revenue_cents = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Stats for {self.date}'
+
+
+class PatientImport(models.Model):
+    # A bulk patient import (adminpanel.imports). `processed_rows` advances in the same transaction as
+    # each batch's inserts, so a job that stopped part way resumes after the last committed batch
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+    file = models.CharField(max_length=500)
+    format = models.CharField(max_length=10, choices=[('csv', 'CSV'), ('ndjson', 'NDJSON')])
+    status = models.CharField(max_length=10, choices=[(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')], default=PENDING)
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    processed_rows = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    message = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Patient import #{self.id} ({self.status}, {self.processed_rows} rows)'
+
+
+class PatientImportError(models.Model):
+    # One rejected row of an import: its 1-based position among the file's data rows and the errors per field
+    job = models.ForeignKey(PatientImport, on_delete=models.CASCADE, related_name='errors')
+    row = models.PositiveIntegerField()
+    username = models.CharField(max_length=150, blank=True)
+    errors = models.JSONField(default=dict)
+
+    class Meta:
+        ordering = ['row']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'row'], name='unique_patient_import_error_row'),
+        ]
+
+    def __str__(self):
+        return f'Import #{self.job_id} row {self.row}'
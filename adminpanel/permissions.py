@@ -1,9 +1,12 @@
 from rest_framework.permissions import BasePermission
+from core.principal import get_principal
 
 class IsAdminUser(BasePermission):
     def has_permission(self, request, view):
-        return request.user.is_authenticated and getattr(request.user, 'role', None) == 'admin'
+        return get_principal(request).role == 'admin'
 
 class IsSuperUser(BasePermission):
+    # Read from the access token's is_superuser claim. Taking the flag away revokes the user's
+    # tokens (core.signals), which other workers apply within REVOCATION_SYNC_SECONDS
     def has_permission(self, request, view):
-        return request.user and request.user.is_authenticated and request.user.is_superuser
\ No newline at end of file
+        return get_principal(request).is_superuser
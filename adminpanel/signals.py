@@ -0,0 +1,48 @@
+from collections import Counter
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from doctors.models import Doctor, Payment, Prescription
+from patients.models import Appointment, Patient
+from patients.signals import appointments_bulk_created, patients_bulk_created
+from . import stats
+
+FACTS = {
+    Appointment: stats.appointment_facts,
+    Prescription: stats.prescription_facts,
+    Payment: stats.payment_facts,
+}
+PROFILES = {Patient: 'patients', Doctor: 'doctors'}
+
+
+@receiver(post_save)
+def count_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if sender in FACTS:
+        stats.apply(stats.changes_for_save(instance, FACTS[sender], created))
+    elif sender in PROFILES and created:
+        stats.apply(stats.profile_changes(instance, PROFILES[sender], 1))
+
+
+@receiver(post_delete)
+def count_on_delete(sender, instance, **kwargs):
+    if sender in FACTS:
+        stats.apply(stats.changes_for_delete(instance, FACTS[sender]))
+    elif sender in PROFILES:
+        stats.apply(stats.profile_changes(instance, PROFILES[sender], -1))
+
+
+@receiver(appointments_bulk_created)
+def count_on_bulk_create(sender, appointments, **kwargs):
+    deltas = Counter()
+    for appointment in appointments:
+        deltas.update(stats.changes_for_save(appointment, stats.appointment_facts, created=True))
+    stats.apply(deltas)
+
+
+@receiver(patients_bulk_created)
+def count_on_patient_import(sender, patients, **kwargs):
+    deltas = Counter()
+    for patient in patients:
+        deltas.update(stats.profile_changes(patient, 'patients', 1))
+    stats.apply(deltas)
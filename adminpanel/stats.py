@@ -0,0 +1,223 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from core.models import User
+from doctors.models import Doctor, Payment, Prescription
+from patients.models import Appointment, Patient
+from .models import DailyStat, StatCounter
+
+# counter name -> DailyStat column
+METRICS = {
+    'patients': 'new_patients',
+    'doctors': 'new_doctors',
+    'appointments': 'appointments',
+    'appointments_active': 'appointments_active',
+    'appointments_completed': 'appointments_completed',
+    'prescriptions': 'prescriptions',
+    'prescriptions_paid': 'prescriptions_paid',
+    'revenue_cents': 'revenue_cents',
+}
+GROUPS = ('day', 'week', 'month')
+
+
+def to_cents(amount):
+    # money is counted in integer cents: SQLite keeps decimals as REAL, so adding Decimals in the upsert drifts
+    return int((Decimal(str(amount)) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def _day(value):
+    return timezone.localtime(value).date() if value else None
+
+
+def _is_paid_status(status):
+    return str(status).lower() == 'paid'
+
+
+def appointment_facts(values):
+    return _day(values['scheduled_at']), {
+        'appointments': 1,
+        'appointments_active': int(bool(values['status'])),
+        'appointments_completed': int(bool(values['prescription_given'])),
+    }
+
+
+def prescription_facts(values):
+    return _day(values['created_at']), {'prescriptions': 1, 'prescriptions_paid': int(bool(values['is_paid']))}
+
+
+def payment_facts(values):
+    return _day(values['created_at']), {'revenue_cents': to_cents(values['amount']) if _is_paid_status(values['status']) else 0}
+
+
+def profile_changes(instance, metric, sign):
+    """Delta for a patient or doctor profile, dated by when its user joined."""
+    try:
+        day = _day(instance.user.date_joined)
+    except User.DoesNotExist:
+        day = None
+    return Counter({(day, metric): sign})
+
+
+def _current_values(instance):
+    return {field.attname: instance.__dict__.get(field.attname) for field in instance._meta.concrete_fields}
+
+
+def changes_for_save(instance, facts, created):
+    """Counter of (day, metric) -> delta between the row as loaded and as saved."""
+    current = _current_values(instance)
+    deltas = Counter()
+    day, amounts = facts(current)
+    for metric, amount in amounts.items():
+        deltas[(day, metric)] += amount
+    if not created:
+        # fields missing from the snapshot (deferred, or never loaded) count as unchanged
+        previous = {**current, **getattr(instance, '_loaded_values', {})}
+        day, amounts = facts(previous)
+        for metric, amount in amounts.items():
+            deltas[(day, metric)] -= amount
+    return deltas
+
+
+def changes_for_delete(instance, facts):
+    day, amounts = facts(_current_values(instance))
+    return Counter({(day, metric): -amount for metric, amount in amounts.items()})
+
+
+def _increment(model, key_field, columns, rows):
+    """
+    Add {key: {column: amount}} to `model` rows in a single upsert, creating missing rows. The sums are
+    done by the database (ON CONFLICT ... DO UPDATE SET column = column + excluded.column), so
+    concurrent writers never overwrite each other.
+    """
+    if not rows:
+        return
+    table = model._meta.db_table
+    ops = connection.ops
+    now = ops.adapt_datetimefield_value(timezone.now())
+    values, params = [], []
+    for key, amounts in rows.items():
+        values.append(f'({", ".join(["%s"] * (len(columns) + 2))})')
+        key = ops.adapt_datefield_value(key) if key_field == 'date' else key
+        params.extend([key, *(amounts.get(column, 0) for column in columns), now])
+    updates = ', '.join(f'{column} = {table}.{column} + excluded.{column}' for column in columns)
+    sql = (
+        f'INSERT INTO {table} ({key_field}, {", ".join(columns)}, updated_at) VALUES {", ".join(values)} '
+        f'ON CONFLICT ({key_field}) DO UPDATE SET {updates}, updated_at = excluded.updated_at'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def apply(deltas):
+    """Add a Counter of (day, metric) deltas to the running totals and the daily rollups, one statement each."""
+    totals = Counter()
+    daily = defaultdict(Counter)
+    for (day, metric), amount in deltas.items():
+        if not amount:
+            continue
+        totals[metric] += amount
+        if day is not None:
+            daily[day][METRICS[metric]] += amount
+
+    _increment(StatCounter, 'name', ['value'], {metric: {'value': amount} for metric, amount in totals.items() if amount})
+    _increment(DailyStat, 'date', list(METRICS.values()), {day: amounts for day, amounts in daily.items() if any(amounts.values())})
+
+
+def compute():
+    """Recompute (totals, {day: {column: value}}) from the source tables with grouped queries."""
+    totals = dict.fromkeys(METRICS, 0)
+    daily = defaultdict(lambda: dict.fromkeys(METRICS.values(), 0))
+
+    def by_day(queryset, date_field, **aggregates):
+        return queryset.annotate(day=TruncDate(date_field, tzinfo=timezone.get_current_timezone())).values('day').annotate(**aggregates).order_by()
+
+    for model, metric in ((Patient, 'patients'), (Doctor, 'doctors')):
+        for row in by_day(model.objects.all(), 'user__date_joined', n=Count('id')):
+            totals[metric] += row['n']
+            daily[row['day']][METRICS[metric]] = row['n']
+
+    for row in by_day(Appointment.objects.all(), 'scheduled_at', n=Count('id'), active=Count('id', filter=Q(status=True)), completed=Count('id', filter=Q(prescription_given=True))):
+        for metric, key in (('appointments', 'n'), ('appointments_active', 'active'), ('appointments_completed', 'completed')):
+            totals[metric] += row[key]
+            daily[row['day']][metric] = row[key]
+
+    for row in by_day(Prescription.objects.all(), 'created_at', n=Count('id'), paid=Count('id', filter=Q(is_paid=True))):
+        for metric, key in (('prescriptions', 'n'), ('prescriptions_paid', 'paid')):
+            totals[metric] += row[key]
+            daily[row['day']][metric] = row[key]
+
+    for row in by_day(Payment.objects.filter(status__iexact='paid'), 'created_at', revenue=Sum('amount')):
+        totals['revenue_cents'] += to_cents(row['revenue'])
+        daily[row['day']]['revenue_cents'] = to_cents(row['revenue'])
+    return totals, daily
+
+
+def reconcile(dry_run=False):
+    """Rewrite the counters and daily rows from the source tables; returns the list of corrections."""
+    corrections = []
+    with transaction.atomic():
+        totals, daily = compute()
+        stored = dict(StatCounter.objects.values_list('name', 'value'))
+        for metric, value in totals.items():
+            if stored.get(metric, 0) != value:
+                corrections.append((metric, None, stored.get(metric, 0), value))
+        columns = list(METRICS.values())
+        stored_days = {row['date']: row for row in DailyStat.objects.values('date', *columns)}
+        for day in set(stored_days) | set(daily):
+            expected = daily.get(day, dict.fromkeys(columns, 0))
+            actual = stored_days.get(day, dict.fromkeys(columns, 0))
+            for column in columns:
+                if actual[column] != expected[column]:
+                    corrections.append((column, day, actual[column], expected[column]))
+        if dry_run or not corrections:
+            return corrections
+
+        StatCounter.objects.bulk_create(
+            [StatCounter(name=metric, value=value) for metric, value in totals.items()],
+            update_conflicts=True, unique_fields=['name'], update_fields=['value', 'updated_at'],
+        )
+        DailyStat.objects.exclude(date__in=list(daily)).delete()
+        DailyStat.objects.bulk_create(
+            [DailyStat(date=day, **values) for day, values in daily.items()],
+            update_conflicts=True, unique_fields=['date'], update_fields=[*columns, 'updated_at'], batch_size=500,
+        )
+    return corrections
+
+
+def _with_revenue(values):
+    """Replace `revenue_cents` with the Decimal `revenue`."""
+    values['revenue'] = from_cents(values.pop('revenue_cents'))
+    return values
+
+
+def current_totals():
+    values = dict.fromkeys(METRICS, 0)
+    values.update(StatCounter.objects.filter(name__in=list(METRICS)).values_list('name', 'value'))
+    return _with_revenue(values)
+
+
+def _period_start(day, group):
+    if group == 'week':
+        return day - timedelta(days=day.weekday())
+    if group == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def breakdown(start, end, group='day'):
+    """Daily rows between start and end (inclusive), summed per day, week or month."""
+    columns = list(METRICS.values())
+    periods = {}
+    for row in DailyStat.objects.filter(date__gte=start, date__lte=end).order_by('date').values('date', *columns):
+        period = periods.setdefault(_period_start(row['date'], group), dict.fromkeys(columns, 0))
+        for column in columns:
+            period[column] += row[column]
+    return [{'period': period, **_with_revenue(values)} for period, values in periods.items()]
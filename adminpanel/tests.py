@@ -1,3 +1,276 @@
-from django.test import TestCase
+import csv
+import json
+import math
+import os
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from core.factories import QueryBudgetChecks, client_for, seed
+from core.models import User
+from doctors.medications import set_medications
+from doctors.models import Payment, Prescription
+from patients import payments
+from patients.models import Appointment, Patient
+from . import analytics, exports, stats
+from .models import Admin, PatientImport, StatCounter
 
-# Create your tests here.
+
+class AdminQueryBudgetTests(QueryBudgetChecks, TestCase):
+    """The admin listings and reports stay within their query budgets, also as the tables grow."""
+
+    def endpoints(self):
+        admin = self.admin.user
+        return [
+            (admin, reverse('admin-appointments-list')),
+            (admin, reverse('admin-prescriptions-list')),
+            (admin, reverse('admin-prescriptions-list') + '?medication=Paracetamol'),
+            (admin, reverse('admin-patients-list')),
+            (admin, reverse('admin-patients-duplicates')),
+            (admin, reverse('admin-doctors-list')),
+            (admin, reverse('logged-admin')),
+            (admin, reverse('dashboard-stats')),
+            (admin, reverse('query-stats')),
+            (admin, reverse('billing-analytics', args=['revenue']) + '?group=specialization'),
+            (admin, reverse('billing-analytics', args=['aging']) + '?group=doctor'),
+            (admin, reverse('utilization') + '?group=specialization'),
+        ]
+
+
+class DashboardStatsTests(TestCase):
+    """Signal-maintained counters and rollups match a recount from the source tables."""
+
+    def test_counters_track_changes_without_drift(self):
+        doctor = seed(doctors=2, patients_per_doctor=2)[0]
+        appointment = Appointment.objects.filter(doctor=doctor).first()
+        appointment.scheduled_at += timedelta(days=3)
+        appointment.status = False
+        appointment.save()
+        prescription = Prescription.objects.filter(is_paid=False).first()
+        prescription.is_paid = True
+        prescription.save()
+        Payment.objects.create(prescription=prescription, amount=250, status='paid')
+        Appointment.objects.filter(doctor=doctor).last().delete()
+
+        self.assertEqual(stats.reconcile(dry_run=True), [])
+
+        admin_user = User.objects.create_superuser(username='admin', password=None, role='admin')
+        Admin.objects.create(user=admin_user)
+        client = client_for(admin_user)
+        data = client.get(reverse('dashboard-stats'), {'start': str(timezone.localdate() - timedelta(days=365)), 'end': str(timezone.localdate() + timedelta(days=30)), 'group': 'month'}).data
+        self.assertEqual(data['totalAppointments'], Appointment.objects.count())
+        self.assertEqual(data['paidPrescriptions'], Prescription.objects.filter(is_paid=True).count())
+        self.assertEqual(sum(period['appointments'] for period in data['breakdown']['periods']), Appointment.objects.count())
+
+    def test_revenue_is_counted_in_cents(self):
+        seed(doctors=1, patients_per_doctor=3)
+        before = stats.current_totals()['revenue']
+        prescriptions = Prescription.objects.filter(is_paid=False)
+        for prescription in prescriptions:
+            Payment.objects.create(prescription=prescription, amount='0.10', status='paid')
+            Payment.objects.create(prescription=prescription, amount='1234567.89', status='duplicate')
+
+        self.assertEqual(stats.current_totals()['revenue'], before + Decimal('0.10') * len(prescriptions))
+        self.assertIsInstance(StatCounter.objects.get(name='revenue_cents').value, int)
+        self.assertEqual(stats.reconcile(dry_run=True), [])
+
+
+class ExportTests(TestCase):
+    """Exports stream every matching row as CSV or NDJSON, reading line items a chunk at a time."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed(doctors=1, patients_per_doctor=2, appointments_per_patient=3)
+        cls.tricky = Prescription.objects.first()
+        cls.tricky.diagnosis = 'Flu, "severe"\nsecond line'
+        cls.tricky.save()
+        set_medications(cls.tricky, [{'name': 'Paracetamol', 'dosage': '500mg'}, {'name': 'Ibuprofen, extra', 'dosage': '200mg'}])
+        cls.admin = User.objects.create_superuser(username='admin', password=None, role='admin')
+        Admin.objects.create(user=cls.admin)
+
+    def export(self, resource, **params):
+        response = client_for(self.admin).get(reverse('export-records', args=[resource]), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_and_ndjson_rows(self):
+        rows = list(csv.DictReader(StringIO(self.export('prescriptions'))))
+        self.assertEqual(len(rows), Prescription.objects.count())
+        row = next(row for row in rows if row['id'] == str(self.tricky.id))
+        self.assertEqual(row['diagnosis'], 'Flu, "severe"\nsecond line')
+        self.assertEqual([item['name'] for item in json.loads(row['medications'])], ['Paracetamol', 'Ibuprofen, extra'])
+
+        lines = self.export('appointments', output='ndjson').splitlines()
+        self.assertEqual(len(lines), Appointment.objects.count())
+        self.assertEqual(set(json.loads(lines[0])), set(exports.header('appointments')))
+        self.assertEqual(len(self.export('payments', is_paid='true').splitlines()), Payment.objects.filter(prescription__is_paid=True).count() + 1)
+
+    def test_line_items_are_read_once_per_chunk(self):
+        queryset = exports.export_queryset('prescriptions')
+        # one query for the rows, then one for the line items of each chunk of two
+        with patch.object(exports, 'CHUNK_SIZE', 2), self.assertNumQueries(1 + math.ceil(Prescription.objects.count() / 2)):
+            rows = list(exports.rows('prescriptions', queryset))
+        self.assertEqual([row[0] for row in rows], list(Prescription.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_invalid_parameters_are_rejected(self):
+        url = reverse('export-records', args=['prescriptions'])
+        for params in ({'start': '2024-02-30'}, {'end': 'later'}, {'output': 'xml'}, {'is_paid': 'maybe'}, {'status': 'paid'}):
+            with self.subTest(params=params):
+                self.assertEqual(client_for(self.admin).get(url, params).status_code, 400)
+
+
+@override_settings(
+    PATIENT_IMPORT_IN_BACKGROUND=False, PATIENT_IMPORT_HASH_WORKERS=1, PATIENT_IMPORT_BATCH_SIZE=2,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class PatientImportTests(TestCase):
+    """Bulk imports create patients in batches, report rejected rows and pick up where they stopped."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_override = override_settings(PATIENT_IMPORT_DIR=directory.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.rows = [
+            'username,password,email,first_name,last_name,gender,address,phone,blood_group',
+            'ana,s3cret-Pass,ana@example.com,Ana,Lee,female,1 Road,900,O+',
+            'ben,,ben@example.com,Ben,Ray,male,2 Road,901,',
+            'ana,,dup@example.com,Ana,Again,female,3 Road,902,',
+            'taken,,t@example.com,Tom,Ken,male,4 Road,903,',
+            'cy,,cy@example.com,Cy,Park,robot,5 Road,904,',
+        ]
+        User.objects.create_user(username='taken', password='pass', role='patient')
+
+    def test_endpoint_import_report_and_invitation(self):
+        admin = User.objects.create_superuser(username='admin', password=None, role='admin')
+        Admin.objects.create(user=admin)
+        client = client_for(admin)
+        patients_before = stats.current_totals()['patients']
+
+        upload = StringIO('\n'.join(self.rows) + '\n')
+        upload.name = 'clinic.csv'
+        response = client.post(reverse('import-patients'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual({key: response.data[key] for key in ('status', 'total_rows', 'processed_rows', 'created', 'errors')}, {
+            'status': 'done', 'total_rows': 5, 'processed_rows': 5, 'created': 2, 'errors': 3,
+        })
+        self.assertTrue(User.objects.get(username='ana').check_password('s3cret-Pass'))
+        self.assertEqual(Patient.objects.get(user__username='ben').blood_group, None)
+        self.assertEqual(stats.current_totals()['patients'], patients_before + 2)
+        self.assertEqual(stats.reconcile(dry_run=True), [])
+
+        report = b''.join(client.get(reverse('patient-import-errors', args=[response.data['id']])).streaming_content).decode()
+        self.assertEqual(report.splitlines(), [
+            'row,username,field,error',
+            '3,ana,username,Appears earlier in the file.',
+            '4,taken,username,A user with that username already exists.',
+            '5,cy,gender,"""robot"" is not a valid choice."',
+        ])
+
+        # ben was imported without a password and sets one with the invitation token
+        out = StringIO()
+        call_command('patient_invitations', stdout=out)
+        invitations = {line.split(',')[0]: line.split(',')[2] for line in out.getvalue().splitlines()[1:]}
+        self.assertEqual(set(invitations), {'ben'})
+        set_password = {'username': 'ben', 'token': invitations['ben'], 'password': 'a-Long-enough-pass'}
+        self.assertEqual(APIClient().post(reverse('set-initial-password'), set_password, format='json').status_code, 200)
+        self.assertTrue(User.objects.get(username='ben').check_password('a-Long-enough-pass'))
+        self.assertEqual(APIClient().post(reverse('set-initial-password'), set_password, format='json').status_code, 400)
+
+    def test_command_resumes_after_last_committed_batch(self):
+        path = os.path.join(settings.PATIENT_IMPORT_DIR, 'clinic.ndjson')
+        os.makedirs(settings.PATIENT_IMPORT_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            header = self.rows[0].split(',')
+            for line in self.rows[1:]:
+                f.write(json.dumps(dict(zip(header, line.split(',')))) + '\n')
+            f.write('not json\n')
+            f.write(json.dumps({'username': 'dee', 'email': 'd@example.com', 'first_name': 'Dee', 'last_name': 'Fox', 'gender': 'other', 'address': '6 Road', 'phone': '905'}) + '\n')
+        # an earlier run committed the first batch of two rows and then died
+        for username in ('ana', 'ben'):
+            User.objects.create_user(username=username, password=None, role='patient')
+        job = PatientImport.objects.create(file=path, format='ndjson', status=PatientImport.FAILED, total_rows=7, processed_rows=2, created_count=2)
+        call_command('import_patients', resume=job.id, stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed_rows, job.created_count, job.error_count), ('done', 7, 3, 4))
+        self.assertEqual(list(job.errors.values_list('row', 'username')), [(3, 'ana'), (4, 'taken'), (5, 'cy'), (6, '')])
+        self.assertTrue(Patient.objects.filter(user__username='dee').exists())
+
+
+class BillingAnalyticsTests(TestCase):
+    """The columnar billing reports agree with the ORM, and pick up new rows incrementally."""
+
+    def test_reports_match_the_database(self):
+        doctors = seed(doctors=2, patients_per_doctor=2)
+        facts = analytics.BillingFacts()
+        facts.report('revenue')
+
+        prescription = Prescription.objects.filter(doctor=doctors[1], is_paid=False).first()
+        Payment.objects.create(prescription=prescription, amount=500, status='Paid')
+        rows = facts.report('revenue', group='doctor')
+
+        by_doctor = {row['doctor_id']: row for row in rows}
+        for doctor in doctors:
+            row = by_doctor[doctor.id]
+            self.assertEqual(row['prescriptions'], Prescription.objects.filter(doctor=doctor).count())
+            self.assertEqual(row['revenue'], sum(p.amount for p in Payment.objects.filter(prescription__doctor=doctor)))
+        self.assertEqual(by_doctor[doctors[1].id]['paid_prescriptions'], Prescription.objects.filter(doctor=doctors[1], is_paid=True).count() + 1)
+
+        months = facts.report('revenue', group='month')
+        self.assertEqual(sum(row['payments'] for row in months), Payment.objects.count())
+        self.assertTrue(all(row['period'].day == 1 for row in months))
+
+        aging = facts.report('aging')
+        unpaid = Prescription.objects.filter(is_paid=False).exclude(id=prescription.id).count()
+        self.assertEqual(sum(row['prescriptions'] for row in aging), unpaid)
+        self.assertEqual(sum(row['outstanding'] for row in aging), unpaid * 500)
+
+    def test_settled_checkout_is_picked_up(self):
+        seed(doctors=1, patients_per_doctor=1)
+        prescription = Prescription.objects.filter(is_paid=False).first()
+        facts = analytics.BillingFacts()
+        payment = payments.start_checkout(prescription, prescription.doctor.consultation_fee)
+        payments.record_checkout(payment, {'id': 'cs_test_settle'})
+        before = facts.report('revenue', group='doctor')[0]
+
+        payments.apply_sessions([({'id': 'cs_test_settle'}, Payment.PAID)])
+        after = facts.report('revenue', group='doctor')[0]
+        self.assertEqual(after['payments'], before['payments'] + 1)
+        self.assertEqual(after['revenue'], before['revenue'] + prescription.doctor.consultation_fee)
+        self.assertEqual(after['paid_prescriptions'], before['paid_prescriptions'] + 1)
+        self.assertEqual(after['outstanding'], before['outstanding'] - prescription.doctor.consultation_fee)
+
+    def test_impossible_dates_are_rejected(self):
+        admin = User.objects.create_superuser(username='admin', password=None, role='admin')
+        Admin.objects.create(user=admin)
+        url = reverse('billing-analytics', args=['revenue'])
+        self.assertEqual(client_for(admin).get(url, {'start': '2024-02-01', 'end': '2024-02-29'}).status_code, 200)
+        self.assertEqual(client_for(admin).get(url, {'start': '2024-02-01', 'end': '2024-02-30'}).status_code, 400)
+
+    def test_utilization_matrix(self):
+        doctor = seed(doctors=1, patients_per_doctor=2)[0]
+        cache.clear()
+        start = timezone.localdate() - timedelta(days=35)
+        end = timezone.localdate()
+        rows = analytics.utilization(start, end, 'doctor')
+
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        appointments = Appointment.objects.filter(doctor=doctor)
+        self.assertEqual(row['appointments'], appointments.count())
+        self.assertEqual(sum(map(sum, row['booked_minutes'])), sum(a.duration_minutes for a in appointments))
+        self.assertEqual(row['completed'], appointments.filter(prescription_given=True).count())
+        self.assertEqual(row['completion_rate'], round(row['completed'] / row['appointments'], 4))
+        # 09:00-17:00 every day of the range
+        self.assertEqual(sum(map(sum, row['available_minutes'])), 8 * 60 * ((end - start).days + 1))
+        self.assertIsNone(row['utilization_matrix'][0][3])
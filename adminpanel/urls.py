@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AdminDoctorViewSet, AllAppointmentViewSet, AllPatientsViewSet, AllPrescriptionViewSet, get_dashboard_stats, get_logged_in_admin, grant_access_doctor, grant_access_patient, revoke_access_doctor, revoke_access_patient
-from patients.views import MedicalHistoryViewSet
+from .views import AdminDoctorViewSet, AllAppointmentViewSet, AllPatientsViewSet, AllPrescriptionViewSet, billing_analytics, export_records, get_dashboard_stats, get_logged_in_admin, get_query_stats, get_utilization, grant_access_doctor, grant_access_patient, import_patients, patient_import_errors, patient_import_status, resume_patient_import, revoke_access_doctor, revoke_access_patient
+from patients.views import MedicalHistoryViewSet, search_records
 
 router = DefaultRouter()
 router.register(r'doctor', AdminDoctorViewSet, basename='admin-doctors')
@@ -11,8 +11,17 @@ router.register(r'prescription', AllPrescriptionViewSet, basename='admin-prescri
 router.register(r'medicalhistory', MedicalHistoryViewSet, basename='admin-medicalhistory')
 
 urlpatterns = [
+    path('search/', search_records, name='admin-search-records'),
     path('me/', get_logged_in_admin, name='logged-admin'),
     path('dashboard/stats/', get_dashboard_stats, name='dashboard-stats'),
+    path('query-stats/', get_query_stats, name='query-stats'),
+    path('analytics/utilization/', get_utilization, name='utilization'),
+    path('analytics/<str:report>/', billing_analytics, name='billing-analytics'),
+    path('export/<str:resource>/', export_records, name='export-records'),
+    path('import/patients/', import_patients, name='import-patients'),
+    path('import/patients/<int:job_id>/', patient_import_status, name='patient-import'),
+    path('import/patients/<int:job_id>/resume/', resume_patient_import, name='resume-patient-import'),
+    path('import/patients/<int:job_id>/errors/', patient_import_errors, name='patient-import-errors'),
     path('revoke_access_patient/<int:patient_id>/', revoke_access_patient, name='revoke-patient'),
     path('grant_access_patient/<int:patient_id>/', grant_access_patient, name='grant-patient'),
     path('revoke_access_doctor/<int:doctor_id>/', revoke_access_doctor, name='revoke-doctor'),
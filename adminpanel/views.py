@@ -1,4 +1,8 @@
+from datetime import timedelta
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from rest_framework.generics import CreateAPIView
 from rest_framework.viewsets import ReadOnlyModelViewSet, ModelViewSet
 from rest_framework import filters
@@ -7,12 +11,20 @@ from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
-from adminpanel.models import Admin
+from adminpanel.models import Admin, PatientImport
+from doctors import medications
 from doctors.models import Doctor, Prescription
 from doctors.serializers import AppointmentSerializer, DoctorRegistrationSerializer, DoctorSerializer, PrescriptionSerializer
-from patients.models import Appointment, Patient
-from patients.serializers import PatientSerializer
+from patients.booking import InvalidDuration, InvalidStart, SlotUnavailable, reschedule_appointment
+from patients.models import Appointment, Patient, PossibleDuplicate
+from patients.serializers import PatientSerializer, PossibleDuplicateSerializer
+from core import querybudget
+from core.pagination import StableCursorPagination
+from core.principal import get_principal
+from core.querybudget import query_budget
+from . import analytics, exports, imports, stats
 from .permissions import IsAdminUser, IsSuperUser
 from .serializers import AdminRegistrationSerializer, AdminSerializer
 from rest_framework.permissions import AllowAny
@@ -20,23 +32,45 @@ from rest_framework.permissions import AllowAny
 # Create your views here.
 
 class AllAppointmentViewSet(ModelViewSet):
-    queryset = Appointment.objects.select_related('doctor', 'patient').all()
+    queryset = Appointment.objects.select_related('doctor__user', 'patient__user').all()
     serializer_class = AppointmentSerializer
     permission_classes = [IsAuthenticated, IsSuperUser]
+    query_budget = {'list': 1, 'retrieve': 1}
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['patient__user__username', 'doctor__user__username', 'scheduled_at']
 
+    def perform_update(self, serializer):
+        scheduled_at = serializer.validated_data.pop('scheduled_at', None)
+        duration_minutes = serializer.validated_data.pop('duration_minutes', None)
+        instance = serializer.save()
+        if (scheduled_at and scheduled_at != instance.scheduled_at) or (duration_minutes and duration_minutes != instance.duration_minutes):
+            try:
+                reschedule_appointment(instance, scheduled_at or instance.scheduled_at, duration_minutes)
+            except (InvalidDuration, InvalidStart) as e:
+                raise ValidationError(str(e))
+            except SlotUnavailable:
+                raise ValidationError('Doctor unavailable at that time')
+
 class AllPrescriptionViewSet(ReadOnlyModelViewSet):
-    queryset = Prescription.objects.all()
+    queryset = Prescription.objects.select_related('doctor__user', 'patient__user').prefetch_related('items')
     serializer_class = PrescriptionSerializer
     permission_classes = [IsAuthenticated, IsSuperUser]
+    query_budget = {'list': 2, 'retrieve': 2}
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['doctor', 'patient', 'is_paid']
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # ?medication=<name> keeps prescriptions containing that medication
+        if self.request.query_params.get('medication'):
+            queryset = medications.containing(queryset, self.request.query_params['medication'])
+        return queryset
+
 class AdminDoctorViewSet(ModelViewSet):
-    queryset = Doctor.objects.all()
+    queryset = Doctor.objects.select_related('user')
     serializer_class = DoctorSerializer
     permission_classes = [IsAuthenticated, IsSuperUser]
+    query_budget = {'list': 1, 'retrieve': 1}
     
     @action(detail=True, methods=['post'], url_path='revoke_access')
     def revoke_access(self, request, pk=None):
@@ -59,39 +93,234 @@ class AdminDoctorViewSet(ModelViewSet):
         return Response({'message': f'Access granted for doctor: {doctor.user.get_full_name()}'})
         
 class AllPatientsViewSet(ModelViewSet):
-    queryset = Patient.objects.all()
+    queryset = Patient.objects.select_related('user')
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated, IsSuperUser]
+    query_budget = {'list': 1, 'retrieve': 1, 'duplicates': 2}
 
+    @action(detail=False, methods=['get'])
+    def duplicates(self, request):
+        """Pairs of patients that may be the same person, newest first; ?min_score= narrows them down."""
+        pairs = PossibleDuplicate.objects.select_related('patient__user', 'other__user')
+        if 'min_score' in request.query_params:
+            try:
+                pairs = pairs.filter(score__gte=float(request.query_params['min_score']))
+            except ValueError:
+                return Response({'message': 'min_score should be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        paginator = StableCursorPagination()
+        page = paginator.paginate_queryset(pairs, request, view=self)
+        return paginator.get_paginated_response(PossibleDuplicateSerializer(page, many=True).data)
 
+
+@query_budget(1)
 @api_view(["GET"])
 @permission_classes([IsAuthenticated, IsSuperUser])
 def get_logged_in_admin(request):
     try:
-        admin = Admin.objects.get(user=request.user)
+        admin = Admin.objects.select_related('user').get(user_id=get_principal(request).user_id)
     except Admin.DoesNotExist:
         return Response({'error': 'Admin not found'}, status=404) 
 
     serializer = AdminSerializer(admin)
     return Response(serializer.data)
 
+MAX_STATS_DAYS = 3 * 366
+
+
+@query_budget(2)
 @api_view(["GET"])
 @permission_classes([IsAuthenticated, IsSuperUser])
 def get_dashboard_stats(request):
+    """
+    Totals from the running counters, plus a breakdown of the daily rollups between `start` and `end`
+    (default: the last 30 days) grouped by `group` (day, week or month).
+    """
     try:
-        total_patients = Patient.objects.count()
-        total_doctors = Doctor.objects.count()
-        total_appointments = Appointment.objects.count()
-        
-        return Response({
-            'totalPatients': total_patients,
-            'totalDoctors': total_doctors,
-            'totalAppointments': total_appointments
-        })
+        end = parse_date(request.GET['end']) if request.GET.get('end') else timezone.localdate()
+        start = parse_date(request.GET['start']) if request.GET.get('start') else (end and end - timedelta(days=29))
+    except ValueError:
+        start = end = None
+    group = request.GET.get('group', 'day')
+    if not start or not end or start > end:
+        return Response({'message': 'start and end should be dates in YYYY-MM-DD format, start first'}, status=status.HTTP_400_BAD_REQUEST)
+    if (end - start).days >= MAX_STATS_DAYS:
+        return Response({'message': f'The range can span at most {MAX_STATS_DAYS} days'}, status=status.HTTP_400_BAD_REQUEST)
+    if group not in stats.GROUPS:
+        return Response({'message': f'group should be one of {", ".join(stats.GROUPS)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        totals = stats.current_totals()
+        periods = stats.breakdown(start, end, group)
     except Exception as e:
         return Response({'error': 'Failed to fetch stats'}, status=500)
+
+    return Response({
+        'totalPatients': int(totals['patients']),
+        'totalDoctors': int(totals['doctors']),
+        'totalAppointments': int(totals['appointments']),
+        'appointmentsByStatus': {
+            'active': int(totals['appointments_active']),
+            'inactive': int(totals['appointments'] - totals['appointments_active']),
+            'completed': int(totals['appointments_completed']),
+        },
+        'totalPrescriptions': int(totals['prescriptions']),
+        'paidPrescriptions': int(totals['prescriptions_paid']),
+        'unpaidPrescriptions': int(totals['prescriptions'] - totals['prescriptions_paid']),
+        'totalRevenue': totals['revenue'],
+        'breakdown': {'start': start, 'end': end, 'group': group, 'periods': periods},
+    })
     
     
+MAX_UTILIZATION_DAYS = 366
+
+
+@query_budget(2)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def get_utilization(request):
+    """
+    Hour-of-week utilization matrices per doctor or specialization (`group`) between `start` and `end`
+    (default: the last 28 days), with completion and no-show ratios.
+    """
+    try:
+        end = parse_date(request.GET['end']) if request.GET.get('end') else timezone.localdate()
+        start = parse_date(request.GET['start']) if request.GET.get('start') else (end and end - timedelta(days=27))
+    except ValueError:
+        start = end = None
+    group = request.GET.get('group', 'doctor')
+    if not start or not end or start > end:
+        return Response({'message': 'start and end should be dates in YYYY-MM-DD format, start first'}, status=status.HTTP_400_BAD_REQUEST)
+    if (end - start).days >= MAX_UTILIZATION_DAYS:
+        return Response({'message': f'The range can span at most {MAX_UTILIZATION_DAYS} days'}, status=status.HTTP_400_BAD_REQUEST)
+    if group not in analytics.UTILIZATION_GROUPS:
+        return Response({'message': f'group should be one of {", ".join(analytics.UTILIZATION_GROUPS)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({'start': start, 'end': end, 'group': group, 'results': analytics.utilization(start, end, group)})
+
+
+@query_budget(3)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def billing_analytics(request, report):
+    """
+    Billing reports from the in-memory payment and prescription arrays (adminpanel.analytics).
+    `revenue`: per `group` (doctor, specialization, day, week or month) between optional `start` and `end`.
+    `aging`: unpaid prescriptions by age, overall or per `group` (doctor or specialization).
+    """
+    if report == 'revenue':
+        group = request.GET.get('group', 'day')
+        try:
+            start = parse_date(request.GET['start']) if request.GET.get('start') else None
+            end = parse_date(request.GET['end']) if request.GET.get('end') else None
+        except ValueError:
+            start = end = None
+        if (request.GET.get('start') and not start) or (request.GET.get('end') and not end):
+            return Response({'message': 'start and end should be dates in YYYY-MM-DD format'}, status=status.HTTP_400_BAD_REQUEST)
+        if group not in analytics.GROUPS:
+            return Response({'message': f'group should be one of {", ".join(analytics.GROUPS)}'}, status=status.HTTP_400_BAD_REQUEST)
+        rows = analytics.billing_facts.report('revenue', group=group, start=start, end=end)
+        return Response({'group': group, 'start': start, 'end': end, 'results': rows})
+
+    if report == 'aging':
+        group = request.GET.get('group', 'none')
+        if group not in analytics.AGING_GROUPS:
+            return Response({'message': f'group should be one of {", ".join(analytics.AGING_GROUPS)}'}, status=status.HTTP_400_BAD_REQUEST)
+        rows = analytics.billing_facts.report('aging', group=group)
+        return Response({'group': group, 'results': rows})
+
+    return Response({'message': 'report should be revenue or aging'}, status=status.HTTP_404_NOT_FOUND)
+
+
+@query_budget(0)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def get_query_stats(request):
+    return Response(querybudget.snapshot())
+
+
+@query_budget(1)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def export_records(request, resource):
+    """
+    Stream appointments, prescriptions or payments as CSV (default) or NDJSON (`?output=ndjson`),
+    optionally filtered by `start`/`end` dates (YYYY-MM-DD), `status` and `is_paid`.
+    """
+    output = request.GET.get('output', 'csv')
+    try:
+        start = parse_date(request.GET['start']) if request.GET.get('start') else None
+        end = parse_date(request.GET['end']) if request.GET.get('end') else None
+    except ValueError:
+        start = end = None
+    if (request.GET.get('start') and not start) or (request.GET.get('end') and not end):
+        return Response({'message': 'start and end should be dates in YYYY-MM-DD format'}, status=400)
+
+    try:
+        queryset = exports.export_queryset(resource, start, end, request.GET.get('status'), request.GET.get('is_paid'))
+        lines = exports.render(resource, queryset, output)
+    except exports.ExportError as e:
+        return Response({'message': str(e)}, status=400)
+
+    content_type = 'text/csv' if output == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{resource}.{output}"'
+    return response
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def import_patients(request):
+    """
+    Start a bulk patient import from an uploaded CSV or NDJSON `file` (`format` is taken from the file
+    name unless given). The import runs in the background; follow it at the returned job's URL.
+    """
+    upload = request.FILES.get('file')
+    if upload is None:
+        return Response({'message': 'Upload the rows as "file"'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        job = imports.create_job(upload.chunks(), upload.name, request.data.get('format') or None, get_principal(request).user_id)
+    except imports.ImportFileError as e:
+        return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    imports.start(job)
+    job.refresh_from_db()
+    return Response(imports.summary(job), status=status.HTTP_202_ACCEPTED)
+
+
+@query_budget(1)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def patient_import_status(request, job_id):
+    job = get_object_or_404(PatientImport, id=job_id)
+    return Response(imports.summary(job))
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def resume_patient_import(request, job_id):
+    """Continue a failed import, or one whose worker stopped reporting progress, after its last committed batch."""
+    job = get_object_or_404(PatientImport, id=job_id)
+    if not imports.start(job):
+        return Response({'message': f'Import #{job.id} is {job.status} and cannot be resumed now'}, status=status.HTTP_409_CONFLICT)
+    job.refresh_from_db()
+    return Response(imports.summary(job), status=status.HTTP_202_ACCEPTED)
+
+
+@query_budget(2)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsSuperUser])
+def patient_import_errors(request, job_id):
+    """The rejected rows of an import, one line per field error, as CSV (default) or NDJSON (`?output=ndjson`)."""
+    job = get_object_or_404(PatientImport, id=job_id)
+    output = request.GET.get('output', 'csv')
+    try:
+        lines = imports.error_report(job, output)
+    except imports.ImportFileError as e:
+        return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    response = StreamingHttpResponse(lines, content_type='text/csv' if output == 'csv' else 'application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="patient-import-{job.id}-errors.{output}"'
+    return response
+
+
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated, IsSuperUser])
 def revoke_access_doctor(request, doctor_id):
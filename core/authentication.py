@@ -0,0 +1,46 @@
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from .principal import Principal
+from .revocation import issued_at, revocations
+
+PROFILE_CLAIMS = ('patient_id', 'doctor_id', 'admin_id')
+
+
+class ClaimsUser(TokenUser):
+    """A request user built from the signed token claims; it has no database row behind it."""
+
+    @cached_property
+    def role(self):
+        return self.token.get('role')
+
+    @cached_property
+    def is_active(self):
+        return self.token.get('is_active', True)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    Trusts the role and profile ids signed into the access token instead of loading the user on every
+    request. Tokens issued before those claims existed fall back to the database lookup. Revoked users
+    and tokens are caught by the in-memory revocation list (core.revocation).
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if revocations.is_revoked(user_id, issued_at(validated_token), validated_token.get(api_settings.JTI_CLAIM)):
+            raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+
+        if any(claim not in validated_token for claim in ('role', *PROFILE_CLAIMS)):
+            return super().get_user(validated_token)
+
+        user = ClaimsUser(validated_token)
+        if not user.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        user._principal = Principal(
+            user.id, user.role, user.is_active, user.is_superuser,
+            profiles={claim[:-3]: validated_token[claim] for claim in PROFILE_CLAIMS},
+        )
+        return user
@@ -0,0 +1,100 @@
+"""Fixtures shared by the apps' tests."""
+from datetime import time, timedelta
+from django.utils import timezone
+from django.test import override_settings
+from rest_framework.test import APIClient
+from adminpanel.models import Admin
+from core.models import User
+from core.serializers import CustomTokenObtainPairSerializer
+from doctors.medications import set_medications
+from doctors.models import Doctor, Payment, Prescription
+from patients.models import Appointment, MedicalHistory, Patient
+
+
+def client_for(user):
+    """An API client sending an access token for `user`."""
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {CustomTokenObtainPairSerializer.get_token(user).access_token}')
+    return client
+
+
+def seed(doctors=3, patients_per_doctor=4, appointments_per_patient=3, offset=0):
+    """Create doctors with patients, appointments, prescriptions, payments and medical history."""
+    start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=30)
+    created = []
+    for d in range(offset, offset + doctors):
+        doctor_user = User.objects.create_user(username=f'doctor{d}', password=None, first_name='Doc', last_name=str(d), role='doctor')
+        doctor = Doctor.objects.create(
+            user=doctor_user, specialization='Cardiology', phone='1', license_number=f'LIC{d}',
+            consultation_fee=500, available_from=time(9), available_to=time(17),
+        )
+        created.append(doctor)
+        for p in range(patients_per_doctor):
+            patient_user = User.objects.create_user(username=f'patient{d}_{p}', password=None, first_name='Pat', last_name=f'{d}{p}', role='patient')
+            patient = Patient.objects.create(user=patient_user, gender='female', address='Street', phone='9000000000')
+            for a in range(appointments_per_patient):
+                appointment = Appointment.objects.create(
+                    patient=patient, doctor=doctor,
+                    scheduled_at=start + timedelta(days=a, hours=p),
+                    prescription_given=a % 2 == 0,
+                )
+                if a % 2 == 0:
+                    prescription = Prescription.objects.create(appointment=appointment, doctor=doctor, patient=patient, diagnosis='Flu', is_paid=a == 0)
+                    set_medications(prescription, [{'name': 'Paracetamol', 'dosage': '500mg'}])
+                    MedicalHistory.objects.create(patient=patient, diagnosis='Flu', medications='Paracetamol', allergies='None', recorded_by=doctor)
+                    if prescription.is_paid:
+                        Payment.objects.create(prescription=prescription, amount=500, status='paid')
+    return created
+
+
+class QueryBudgetChecks:
+    """
+    Mixed into an app's TestCase next to an `endpoints()` listing (user, url) pairs of that app's
+    views: every endpoint must answer within the query budget declared on its view, and with as many
+    queries however many rows there are.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctors = seed()
+        cls.doctor = cls.doctors[0]
+        cls.patient = Patient.objects.filter(appointment__doctor=cls.doctor).first()
+        admin_user = User.objects.create_superuser(username='admin', password=None, role='admin')
+        cls.admin = Admin.objects.create(user=admin_user)
+
+    def setUp(self):
+        super().setUp()
+        # responses carry the query count and budget
+        headers = override_settings(QUERY_BUDGET_HEADERS=True)
+        headers.enable()
+        self.addCleanup(headers.disable)
+
+    def endpoints(self):
+        raise NotImplementedError
+
+    def measure(self):
+        counts = {}
+        for user, url in self.endpoints():
+            response = client_for(user).get(url)
+            self.assertEqual(response.status_code, 200, f'{url} as {user.role}: {response.status_code}')
+            self.assertIn('X-Query-Budget', response, f'{url} does not declare a query budget')
+            counts[(user.role, url)] = (int(response['X-Query-Count']), int(response['X-Query-Budget']))
+        return counts
+
+    def test_endpoints_stay_within_budget(self):
+        for (role, url), (count, budget) in self.measure().items():
+            with self.subTest(url=url, role=role):
+                self.assertLessEqual(count, budget, f'{url} as {role} ran {count} queries, budget is {budget}')
+
+    def test_query_count_does_not_grow_with_rows(self):
+        # the first pass after data changes also rebuilds in-process caches, so compare warm passes
+        self.measure()
+        before = self.measure()
+        seed(doctors=2, offset=10)
+        # give the measured doctor and patient more rows of their own as well
+        Appointment.objects.create(patient=self.patient, doctor=self.doctor, scheduled_at=timezone.now() + timedelta(days=3))
+        self.measure()
+        after = self.measure()
+        for key, (count, _) in after.items():
+            with self.subTest(url=key[1], role=key[0]):
+                self.assertEqual(count, before[key][0])
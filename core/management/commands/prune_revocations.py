@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from core.models import Revocation
+
+
+class Command(BaseCommand):
+    help = 'Delete revocation log rows that no longer apply to any token that could still be valid.'
+
+    def handle(self, *args, **options):
+        deleted, _ = Revocation.objects.filter(expires_at__lte=timezone.now()).delete()
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} expired revocations'))
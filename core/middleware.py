@@ -0,0 +1,43 @@
+import re
+from django.conf import settings
+from . import querybudget
+
+# a named group of a regex route, such as the DRF routers' (?P<pk>[^/.]+)
+NAMED_GROUP = re.compile(r'\(\?P<(\w+)>[^)]*\)')
+
+
+def route_name(route):
+    """A route as written for path(), and a regex route without its anchors and with groups shown as <name>."""
+    return NAMED_GROUP.sub(r'<\1>', route).replace('^', '').replace('$', '')
+
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts the SQL queries and SQL time of every request, aggregates them per view and logs
+    requests that go over the view's declared query budget.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response, recorder = querybudget.measure(self.get_response, request)
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return response
+
+        budget = querybudget.budget_for(match, request.method)
+        view_name = f'{request.method} /{route_name(match.route)}'
+        querybudget.record(view_name, recorder.count, recorder.duration, budget)
+
+        if budget is not None and recorder.count > budget:
+            querybudget.logger.warning('%s ran %d queries, over its budget of %d', view_name, recorder.count, budget)
+
+        if getattr(settings, 'QUERY_BUDGET_HEADERS', settings.DEBUG):
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-SQL-Time-Ms'] = f'{recorder.duration * 1000:.2f}'
+            if budget is not None:
+                response['X-Query-Budget'] = str(budget)
+        return response
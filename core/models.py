@@ -1,9 +1,28 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 # Create your models here.
 
-class User(AbstractUser):
+class LoadedValuesMixin:
+    """
+    Keeps the column values a row was loaded or last saved with in `_loaded_values`, so post_save
+    handlers can tell what an update changed (a reschedule, a payment being marked paid).
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # deferred fields are left out rather than loaded
+        self._loaded_values = {field.attname: self.__dict__[field.attname] for field in self._meta.concrete_fields if field.attname in self.__dict__}
+
+
+class User(LoadedValuesMixin, AbstractUser):
     ROLE_CHOICES = (
         ('patient', 'Patient'),
         ('doctor', 'Doctor'),
@@ -11,5 +30,25 @@ class User(AbstractUser):
     )
     
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
-    
-    
\ No newline at end of file
+
+
+class Revocation(models.Model):
+    # Append-only log read by core.revocation; for a user, the latest revoke/restore row wins
+    REVOKE_USER = 'revoke_user'
+    RESTORE_USER = 'restore_user'
+    REVOKE_TOKEN = 'revoke_token'
+    KIND_CHOICES = (
+        (REVOKE_USER, 'Revoke user'),
+        (RESTORE_USER, 'Restore user'),
+        (REVOKE_TOKEN, 'Revoke token'),
+    )
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='revocations')
+    jti = models.CharField(max_length=255, blank=True, db_index=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # after this no token the row applies to can still be valid, so the row can be pruned
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.kind} of user #{self.user_id}'
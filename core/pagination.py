@@ -0,0 +1,90 @@
+import hashlib
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+COUNT_VERSION_KEY = 'listing-count-version:{table}'
+
+
+def table_versions(tables):
+    """The current count version of each table, creating the missing ones, with one cache round trip."""
+    keys = {COUNT_VERSION_KEY.format(table=table): table for table in tables}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, uuid.uuid4().hex, None)
+        versions[key] = cache.get(key)
+    return [versions[key] for key in sorted(keys)]
+
+
+def invalidate_counts(model):
+    """Retire the cached listing counts over `model`'s table; called from the model signals on writes."""
+    cache.set(COUNT_VERSION_KEY.format(table=model._meta.db_table), uuid.uuid4().hex, None)
+
+
+def cached_count(queryset):
+    """
+    queryset.count(), cached under the query and the count versions of the tables it joins, so a save
+    or delete on any of them (core.signals) retires the counts built on it. Writes that bypass the
+    model signals (queryset.update, bulk_create without a signal of its own) are picked up after
+    LISTING_COUNT_CACHE_SECONDS.
+    """
+    query = queryset.query
+    tables = {queryset.model._meta.db_table, *(alias.table_name for alias in query.alias_map.values())}
+    sql, params = query.sql_with_params()
+    digest = hashlib.sha1(repr((sql, params)).encode()).hexdigest()
+    key = f'listing-count:{digest}:{hashlib.sha1(":".join(table_versions(tables)).encode()).hexdigest()}'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, settings.LISTING_COUNT_CACHE_SECONDS)
+    return count
+
+
+class StableCursorPagination(CursorPagination):
+    """
+    Keyset pagination in the listing's own order: the view's `cursor_ordering`, else its queryset's
+    order_by, else the model's Meta.ordering, else newest id first. The id is appended as a
+    tiebreaker, so rows sharing a timestamp keep a fixed order and inserts made while a client pages
+    through never shift or repeat rows on later pages.
+
+    `?with_count=1` adds the total row count, from cached_count(): a COUNT(*) only when the tables
+    behind the listing changed since the last count.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = '-id'
+    count_query_param = 'with_count'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', None) or queryset.query.order_by or queryset.query.get_meta().ordering
+        if not ordering or not all(isinstance(field, str) for field in ordering):
+            return super().get_ordering(request, queryset, view)
+        ordering = (ordering,) if isinstance(ordering, str) else tuple(ordering)
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            ordering += ('-id' if ordering[0].startswith('-') else 'id',)
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true', 'True'):
+            self.count = cached_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data = {'count': self.count, **response.data}
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema['properties']['count'] = {'type': 'integer', 'example': 123}
+        return schema
+
+
+class ListPagination(LimitOffsetPagination):
+    """`limit`/`offset` pages over a list already held in memory, such as the doctor directory."""
+    default_limit = 50
+    max_limit = 500
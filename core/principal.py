@@ -0,0 +1,61 @@
+from .models import User
+
+
+def profile_ids(user_id):
+    """{'patient': id, 'doctor': id, 'admin': id} for a user, None where they have no such profile."""
+    row = User.objects.filter(pk=user_id).values('patient__id', 'doctor__id', 'admin__id').first() or {}
+    return {'patient': row.get('patient__id'), 'doctor': row.get('doctor__id'), 'admin': row.get('admin__id')}
+
+
+class Principal:
+    """
+    Who is making a request: their role, the ids of their patient/doctor/admin profiles and whether
+    the account is active. Views and permissions read this instead of probing `user.doctor`,
+    `user.patient` and `user.admin` one query at a time. Profile ids that were not supplied up front
+    are loaded together, with one query, the first time any of them is needed.
+    """
+
+    def __init__(self, user_id=None, role=None, is_active=False, is_superuser=False, profiles=None):
+        self.user_id = user_id
+        self.role = role
+        self.is_active = is_active
+        self.is_superuser = is_superuser
+        self._profiles = profiles
+
+    @property
+    def is_authenticated(self):
+        return self.user_id is not None
+
+    @property
+    def patient_id(self):
+        return self._profile('patient')
+
+    @property
+    def doctor_id(self):
+        return self._profile('doctor')
+
+    @property
+    def admin_id(self):
+        return self._profile('admin')
+
+    def _profile(self, name):
+        if self._profiles is None:
+            self._profiles = profile_ids(self.user_id)
+        return self._profiles[name]
+
+    def __repr__(self):
+        return f'<Principal user={self.user_id} role={self.role}>'
+
+
+ANONYMOUS = Principal(profiles={'patient': None, 'doctor': None, 'admin': None})
+
+
+def get_principal(request):
+    """The principal of `request`, built on first use and kept on the request's user object."""
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return ANONYMOUS
+    principal = getattr(user, '_principal', None)
+    if principal is None:
+        principal = user._principal = Principal(user.pk, user.role, user.is_active, user.is_superuser)
+    return principal
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_stats = {}
+_stats_lock = threading.Lock()
+_local = threading.local()
+
+
+def query_budget(budget):
+    """
+    Declare the most queries a function view may run per request. Apply it above @api_view.
+    Viewsets declare a `query_budget` attribute instead, either an int or a dict keyed by action.
+    """
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def budget_for(resolver_match, method):
+    if resolver_match is None:
+        return None
+    func = resolver_match.func
+    budget = getattr(func, 'query_budget', None)
+    if budget is None:
+        budget = getattr(getattr(func, 'cls', None), 'query_budget', None)
+    if isinstance(budget, dict):
+        action = (getattr(func, 'actions', None) or {}).get(method.lower())
+        budget = budget.get(action)
+    return budget
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.paused = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.paused:
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+def record(view_name, queries, duration, budget):
+    with _stats_lock:
+        entry = _stats.setdefault(view_name, {'requests': 0, 'queries': 0, 'sql_ms': 0.0, 'max_queries': 0, 'over_budget': 0, 'budget': budget})
+        entry['requests'] += 1
+        entry['queries'] += queries
+        entry['sql_ms'] += duration * 1000
+        entry['max_queries'] = max(entry['max_queries'], queries)
+        entry['budget'] = budget
+        if budget is not None and queries > budget:
+            entry['over_budget'] += 1
+
+
+def snapshot():
+    with _stats_lock:
+        return {
+            name: dict(entry, avg_queries=entry['queries'] / entry['requests'], avg_sql_ms=entry['sql_ms'] / entry['requests'])
+            for name, entry in _stats.items()
+        }
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
+
+
+def measure(func, *args, **kwargs):
+    """Run func while counting the queries it issues on every database connection."""
+    recorder = QueryRecorder()
+    previous, _local.recorder = getattr(_local, 'recorder', None), recorder
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            result = func(*args, **kwargs)
+    finally:
+        _local.recorder = previous
+    return result, recorder
+
+
+@contextmanager
+def unmetered():
+    """
+    Leave the queries run inside the block out of the current request's count. Meant for periodic
+    per-process upkeep (such as syncing the revocation list) that happens to run on whichever request
+    comes along, and would otherwise make that request look over budget.
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        yield
+        return
+    recorder.paused += 1
+    try:
+        yield
+    finally:
+        recorder.paused -= 1
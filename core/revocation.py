@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time as time_module
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from . import querybudget
+from .models import Revocation
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings: never a false negative, false positives at a rate set by its size."""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray(bits // 8 + 1)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, step = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class RevocationList:
+    """
+    In-process view of the Revocation log. Each worker applies new rows by polling for ids above the
+    last one it has seen, at most every REVOCATION_SYNC_SECONDS, so a revocation reaches every worker
+    within that interval while checks stay in memory. Revoked users are kept exactly; revoked token ids
+    go into a Bloom filter and only a hit is confirmed against the table. The filter cannot forget, so
+    it is rebuilt from the unexpired rows every REVOCATION_REBUILD_SECONDS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.users = {}
+        self.tokens = BloomFilter(settings.REVOCATION_BLOOM_BITS, settings.REVOCATION_BLOOM_HASHES)
+        self.last_id = 0
+        self.synced_at = None
+        self.built_at = time_module.monotonic()
+
+    def _apply(self, kind, user_id, jti, created_at):
+        if kind == Revocation.REVOKE_USER:
+            self.users[user_id] = created_at.timestamp()
+        elif kind == Revocation.RESTORE_USER:
+            self.users.pop(user_id, None)
+        elif jti:
+            self.tokens.add(jti)
+
+    def _is_fresh(self):
+        return self.synced_at is not None and time_module.monotonic() - self.synced_at < settings.REVOCATION_SYNC_SECONDS
+
+    def sync(self, force=False):
+        if not force and self._is_fresh():
+            return
+        with self._lock:
+            if not force and self._is_fresh():
+                return
+            if time_module.monotonic() - self.built_at > settings.REVOCATION_REBUILD_SECONDS:
+                self._clear()
+            with querybudget.unmetered():
+                rows = list(
+                    Revocation.objects.filter(id__gt=self.last_id, expires_at__gt=timezone.now())
+                    .order_by('id').values_list('id', 'kind', 'user_id', 'jti', 'created_at')
+                )
+            for row_id, kind, user_id, jti, created_at in rows:
+                self._apply(kind, user_id, jti, created_at)
+                self.last_id = row_id
+            self.synced_at = time_module.monotonic()
+
+    def append(self, kind, user_id, expires_at, jti=''):
+        row = Revocation.objects.create(kind=kind, user_id=user_id, jti=jti, expires_at=expires_at)
+        # the writing worker sees its own revocation at once; the others on their next poll
+        with self._lock:
+            self._apply(kind, user_id, jti, row.created_at)
+
+    def is_revoked(self, user_id, issued_at=None, jti=None):
+        """True if the user was revoked after the token was issued, or the token itself was revoked."""
+        self.sync()
+        revoked_at = self.users.get(user_id)
+        if revoked_at is not None and (issued_at is None or issued_at <= revoked_at):
+            return True
+        if jti and jti in self.tokens:
+            return Revocation.objects.filter(kind=Revocation.REVOKE_TOKEN, jti=jti).exists()
+        return False
+
+
+revocations = RevocationList()
+
+
+def issued_at(token):
+    """
+    When a token's session began: the sub-second `auth_time` claim where the token has one, as `iat`
+    is whole seconds and cannot tell a token signed just after a revocation from one signed just before.
+    """
+    return token.get('auth_time', token.get('iat'))
+
+
+def revoke_user(user_id):
+    """Reject every token of `user_id` issued up to now. Nothing issued earlier outlives a refresh token."""
+    revocations.append(Revocation.REVOKE_USER, user_id, timezone.now() + api_settings.REFRESH_TOKEN_LIFETIME)
+
+
+def restore_user(user_id):
+    revocations.append(Revocation.RESTORE_USER, user_id, timezone.now() + api_settings.REFRESH_TOKEN_LIFETIME)
+
+
+def revoke_token(token):
+    """Reject one access or refresh token until it would have expired anyway."""
+    expires_at = datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+    revocations.append(Revocation.REVOKE_TOKEN, token[api_settings.USER_ID_CLAIM], expires_at, jti=token[api_settings.JTI_CLAIM])
@@ -1,4 +1,10 @@
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+import time
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from .principal import profile_ids
+from .revocation import issued_at, revocations
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
@@ -7,6 +13,12 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         token['role'] = user.role
         token['username'] = user.username
         token['is_active'] = user.is_active
+        # lets ClaimsJWTAuthentication build the request principal without reading the database
+        token['is_superuser'] = user.is_superuser
+        # copied into the access tokens refreshed from it; see core.revocation.issued_at
+        token['auth_time'] = time.time()
+        for name, profile_id in profile_ids(user.pk).items():
+            token[f'{name}_id'] = profile_id
         return token
 
     def validate(self, attrs):
@@ -15,4 +27,11 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         data['username'] = self.user.username
         data['is_active'] = self.user.is_active
         return data
-        
+
+
+class CustomTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        if revocations.is_revoked(refresh.get(api_settings.USER_ID_CLAIM), issued_at(refresh), refresh.get(api_settings.JTI_CLAIM)):
+            raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+        return super().validate(attrs)
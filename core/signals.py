@@ -0,0 +1,48 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import User
+from .pagination import invalidate_counts
+from .revocation import restore_user, revocations, revoke_user
+
+# fields signed into access tokens, or that should end the sessions built on them
+TOKEN_FIELDS = ('is_active', 'password', 'role', 'is_superuser')
+PRIVILEGE_FIELDS = ('role', 'is_superuser')
+LISTED_MODELS = (
+    'patients.Appointment', 'patients.MedicalHistory', 'patients.Patient', 'patients.PossibleDuplicate',
+    'doctors.Doctor', 'doctors.Prescription', 'doctors.Payment',
+)
+
+
+@receiver(post_save, sender=User)
+def track_revoked_users(sender, instance, created, update_fields=None, **kwargs):
+    # access tokens carry is_active, role and is_superuser, so a change to them has to reach the
+    # tokens through the revocation list; saves touching nothing else (last_login) are left alone
+    if created or (update_fields is not None and not set(update_fields) & set(TOKEN_FIELDS)):
+        return
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded is None:
+        # nothing to compare with, so only reconcile the active state
+        changed = {'is_active'}
+    else:
+        changed = {field for field in TOKEN_FIELDS if field in loaded and loaded[field] != getattr(instance, field)}
+    if not changed:
+        return
+    revocations.sync(force=True)
+    if not instance.is_active:
+        if instance.pk not in revocations.users:
+            revoke_user(instance.pk)
+    elif changed & set(PRIVILEGE_FIELDS):
+        # tokens issued so far claim the old role; the user signs in again to get the new one
+        revoke_user(instance.pk)
+    elif 'is_active' in changed and instance.pk in revocations.users:
+        restore_user(instance.pk)
+
+
+def invalidate_listing_counts(sender, **kwargs):
+    invalidate_counts(sender)
+
+
+# the models behind the paginated listings and their filters; bulk writes to them invalidate on their own
+for label in LISTED_MODELS:
+    post_save.connect(invalidate_listing_counts, sender=label, dispatch_uid=f'listing-counts-save-{label}')
+    post_delete.connect(invalidate_listing_counts, sender=label, dispatch_uid=f'listing-counts-delete-{label}')
@@ -1,3 +1,176 @@
+from datetime import timedelta
+from unittest.mock import patch
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from adminpanel.models import Admin
+from core import querybudget
+from core.factories import QueryBudgetChecks, client_for, seed
+from core.models import User
+from core.revocation import revocations
+from core.serializers import CustomTokenObtainPairSerializer
+from patients.models import Appointment, MedicalHistory, Patient
 
-# Create your tests here.
+
+class QueryBudgetTests(QueryBudgetChecks, TestCase):
+    """The middleware counts queries per view and keys its statistics by readable routes."""
+
+    def endpoints(self):
+        history = MedicalHistory.objects.filter(patient=self.patient).first()
+        return [
+            (self.patient.user, reverse('admin-appointment-list')),
+            (self.doctor.user, reverse('medical-history-detail', args=[history.id])),
+            (self.admin.user, reverse('query-stats')),
+        ]
+
+    def test_stats_are_keyed_by_readable_routes(self):
+        querybudget.reset()
+        self.measure()
+        names = querybudget.snapshot().keys()
+        self.assertIn('GET /api/patients/appointments/', names)
+        self.assertIn('GET /api/doctors/medicalhistory/<pk>/', names)
+        for name in names:
+            with self.subTest(name=name):
+                self.assertNotRegex(name, r'[$^]|\(\?P')
+
+
+class ClaimsAuthenticationTests(TestCase):
+    """Access tokens are trusted without a user lookup, but revoked users and tokens are locked out at once."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=1)[0]
+        cls.patient = Patient.objects.get(appointment__doctor=cls.doctor)
+        admin_user = User.objects.create_superuser(username='admin', password=None, role='admin')
+        cls.admin = Admin.objects.create(user=admin_user)
+
+    def setUp(self):
+        # the in-process list outlives the rollback of each test's Revocation rows
+        self.addCleanup(revocations._clear)
+
+    def client_with(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        return client
+
+    def test_revoked_patient_is_rejected(self):
+        patient_client = self.client_with(CustomTokenObtainPairSerializer.get_token(self.patient.user).access_token)
+        self.assertEqual(patient_client.get(reverse('logged-patient')).status_code, 200)
+
+        admin_client = self.client_with(CustomTokenObtainPairSerializer.get_token(self.admin.user).access_token)
+        self.assertEqual(admin_client.put(reverse('revoke-patient', args=[self.patient.id])).status_code, 200)
+        self.assertEqual(patient_client.get(reverse('logged-patient')).status_code, 401)
+
+        admin_client.put(reverse('grant-patient', args=[self.patient.id]))
+        self.assertEqual(patient_client.get(reverse('logged-patient')).status_code, 200)
+
+    def test_revoked_tokens_are_rejected(self):
+        refresh = CustomTokenObtainPairSerializer.get_token(self.patient.user)
+        client = self.client_with(refresh.access_token)
+        self.assertEqual(client.post(reverse('token_revoke'), {'refresh': str(refresh)}).status_code, 200)
+
+        self.assertEqual(client.get(reverse('logged-patient')).status_code, 401)
+        self.assertEqual(APIClient().post(reverse('token_refresh'), {'refresh': str(refresh)}).status_code, 401)
+        # other sessions of the same user are unaffected
+        other = self.client_with(CustomTokenObtainPairSerializer.get_token(self.patient.user).access_token)
+        self.assertEqual(other.get(reverse('logged-patient')).status_code, 200)
+
+    def test_tokens_without_profile_claims_fall_back_to_the_database(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.doctor.user).access_token
+        for claim in ('patient_id', 'doctor_id', 'admin_id'):
+            del token[claim]
+        response = self.client_with(token).get(reverse('doctor-schedule'))
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_tokens_without_a_role_fall_back_to_the_database(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.doctor.user).access_token
+        del token['role']
+        self.assertEqual(self.client_with(token).get(reverse('doctor-schedule')).status_code, 200)
+
+    def test_extra_claims_grant_nothing(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.patient.user).access_token
+        token['scope'] = 'admin'
+        token['groups'] = ['admin']
+        client = self.client_with(token)
+        self.assertEqual(client.get(reverse('logged-patient')).status_code, 200)
+        self.assertEqual(client.get(reverse('dashboard-stats')).status_code, 403)
+
+    def test_role_change_needs_a_new_token(self):
+        before = client_for(self.doctor.user)
+        self.assertEqual(before.get(reverse('doctor-schedule')).status_code, 200)
+        user = User.objects.get(pk=self.doctor.user.pk)
+        user.role = 'patient'
+        user.save()
+        self.assertEqual(before.get(reverse('doctor-schedule')).status_code, 401)
+        after = client_for(user)
+        self.assertEqual(after.get(reverse('logged-doctor')).status_code, 200)
+        # the new token claims the new role, which the schedule refuses
+        self.assertEqual(after.get(reverse('doctor-schedule')).status_code, 401)
+
+    def test_only_token_fields_sync_the_revocation_list(self):
+        user = User.objects.get(pk=self.patient.user.pk)
+        with patch('core.signals.revocations.sync') as sync:
+            user.last_login = timezone.now()
+            user.save(update_fields=['last_login'])
+            user.first_name = 'Renamed'
+            user.save()
+            sync.assert_not_called()
+            user.is_active = False
+            user.save()
+            sync.assert_called_once_with(force=True)
+
+    def test_losing_superuser_rejects_earlier_tokens(self):
+        client = client_for(self.admin.user)
+        self.assertEqual(client.get(reverse('dashboard-stats')).status_code, 200)
+        user = User.objects.get(pk=self.admin.user.pk)
+        user.is_superuser = False
+        user.save()
+        self.assertEqual(client.get(reverse('dashboard-stats')).status_code, 401)
+        self.assertEqual(client_for(user).get(reverse('dashboard-stats')).status_code, 403)
+
+class CursorPaginationTests(TestCase):
+    """Listings keep their own order across pages, with the id breaking ties, and counts follow writes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = seed(doctors=1, patients_per_doctor=3, appointments_per_patient=2)[0]
+        cls.patient = Patient.objects.filter(appointment__doctor=cls.doctor).first()
+        # an appointment booked later for an earlier time, and one sharing its time
+        first = Appointment.objects.filter(doctor=cls.doctor).order_by('scheduled_at').first()
+        Appointment.objects.create(patient=cls.patient, doctor=cls.doctor, scheduled_at=first.scheduled_at - timedelta(hours=1))
+        Appointment.objects.create(patient=cls.patient, doctor=cls.doctor, scheduled_at=first.scheduled_at)
+
+    def walk(self, client, url):
+        rows = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            rows += response.data['results']
+            url = response.data['next']
+        return rows
+
+    def test_schedule_pages_are_chronological(self):
+        rows = self.walk(client_for(self.doctor.user), reverse('doctor-schedule') + '?page_size=2')
+        expected = list(Appointment.objects.filter(doctor=self.doctor).order_by('scheduled_at', 'id').values_list('id', flat=True))
+        self.assertEqual([row['id'] for row in rows], expected)
+
+    def test_medical_history_keeps_newest_record_first(self):
+        older = MedicalHistory.objects.filter(patient=self.patient).first()
+        MedicalHistory.objects.filter(id=older.id).update(recorded_at=timezone.localdate() + timedelta(days=1))
+        rows = self.walk(client_for(self.patient.user), '/api/patients/medicalhistory/?page_size=1')
+        expected = list(MedicalHistory.objects.filter(patient=self.patient).order_by('-recorded_at', '-id').values_list('id', flat=True))
+        self.assertEqual([row['id'] for row in rows], expected)
+        self.assertEqual(rows[0]['id'], older.id)
+
+    def test_count_is_cached_until_a_write(self):
+        client, url = client_for(self.doctor.user), reverse('doctor-schedule') + '?with_count=1'
+        before = client.get(url).data['count']
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(url).data['count'], before)
+
+        appointment = Appointment.objects.create(patient=self.patient, doctor=self.doctor, scheduled_at=timezone.now() + timedelta(days=5))
+        self.assertEqual(client.get(url).data['count'], before + 1)
+        appointment.delete()
+        self.assertEqual(client.get(url).data['count'], before)
@@ -1,8 +1,41 @@
 from django.shortcuts import render
-from .serializers import CustomTokenObtainPairSerializer
-from rest_framework_simplejwt.views import TokenObtainPairView
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from .principal import get_principal
+from .querybudget import query_budget
+from .revocation import revoke_token
+from .serializers import CustomTokenObtainPairSerializer, CustomTokenRefreshSerializer
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 # Create your views here.
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
-    
+
+
+class CustomTokenRefreshView(TokenRefreshView):
+    serializer_class = CustomTokenRefreshSerializer
+
+
+@query_budget(2)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def revoke_tokens(request):
+    """Log out: revoke the access token of this request and, if given, the `refresh` token it came from."""
+    refresh = None
+    if request.data.get('refresh'):
+        try:
+            refresh = RefreshToken(request.data['refresh'])
+        except TokenError:
+            return Response({'message': 'Invalid refresh token'}, status=status.HTTP_400_BAD_REQUEST)
+        if refresh.get(api_settings.USER_ID_CLAIM) != get_principal(request).user_id:
+            return Response({'message': 'The refresh token belongs to another user'}, status=status.HTTP_403_FORBIDDEN)
+
+    revoke_token(request.auth)
+    if refresh is not None:
+        revoke_token(refresh)
+    return Response({'message': 'Tokens revoked'})
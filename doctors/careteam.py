@@ -0,0 +1,53 @@
+from django.db.models import Count, Q
+from core.pagination import invalidate_counts
+from patients.models import Appointment
+from .models import CareTeamMember
+
+
+def appointment_pairs(instance, created=False):
+    """The (doctor_id, patient_id) pairs whose care-team row a save or delete of `instance` may change."""
+    pair = (instance.doctor_id, instance.patient_id)
+    loaded = getattr(instance, '_loaded_values', None)
+    if created or not loaded or 'doctor_id' not in loaded or 'patient_id' not in loaded:
+        return {pair}
+    previous = (loaded['doctor_id'], loaded['patient_id'])
+    return set() if previous == pair else {pair, previous}
+
+
+def refresh_pairs(pairs):
+    """Recount appointments for the given pairs with one grouped read, then upsert or drop their rows."""
+    pairs = set(pairs)
+    if not pairs:
+        return
+    pair_filter = Q()
+    for doctor_id, patient_id in pairs:
+        pair_filter |= Q(doctor_id=doctor_id, patient_id=patient_id)
+    counts = {
+        (row['doctor_id'], row['patient_id']): row['count']
+        for row in Appointment.objects.filter(pair_filter).values('doctor_id', 'patient_id').annotate(count=Count('id')).order_by()
+    }
+
+    if counts:
+        CareTeamMember.objects.bulk_create(
+            [CareTeamMember(doctor_id=doctor_id, patient_id=patient_id, appointment_count=count) for (doctor_id, patient_id), count in counts.items()],
+            update_conflicts=True,
+            unique_fields=['doctor', 'patient'],
+            update_fields=['appointment_count', 'updated_at'],
+        )
+    removed = Q()
+    for doctor_id, patient_id in pairs - counts.keys():
+        removed |= Q(doctor_id=doctor_id, patient_id=patient_id)
+    if removed:
+        CareTeamMember.objects.filter(removed).delete()
+    # doctors' listings filter on the care team, and these writes bypass the model signals
+    invalidate_counts(CareTeamMember)
+
+
+def rebuild(batch_size=1000):
+    """Recompute the whole care-team table from the appointment history; returns the number of pairs."""
+    rows = Appointment.objects.values('doctor_id', 'patient_id').annotate(count=Count('id')).order_by()
+    members = [CareTeamMember(doctor_id=row['doctor_id'], patient_id=row['patient_id'], appointment_count=row['count']) for row in rows.iterator()]
+    CareTeamMember.objects.all().delete()
+    CareTeamMember.objects.bulk_create(members, batch_size=batch_size)
+    invalidate_counts(CareTeamMember)
+    return len(members)
@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time as time_module
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from core import querybudget
+from .medications import normalize
+from .models import Medication
+
+FIELDS = ('id', 'name', 'generic_name', 'form', 'strength')
+# rows saved this long before a sync are read again by the next one, in case their transaction
+# committed after that sync ran
+SYNC_OVERLAP = timedelta(seconds=10)
+# fuzzy matching starts at this many typed characters; shorter prefixes match too much to be useful
+MIN_FUZZY_LENGTH = 3
+# a sync that changes more entries than this re-sorts the index instead of splicing each one in
+REBUILD_CHANGES = 200
+
+
+def _search_keys(entry):
+    """Every word-start suffix of the brand and generic names, so 'clav' finds 'amoxicillin clavulanate'."""
+    keys = set()
+    for name in (entry['name'], entry['generic_name']):
+        words = normalize(name).split(' ')
+        for start in range(len(words)):
+            key = ' '.join(words[start:])
+            if key:
+                keys.add((key, start == 0))
+    return keys
+
+
+class Index:
+    """
+    An immutable snapshot: the search keys of the active entries in one sorted array, with the entry
+    id and whether the key starts the name in parallel arrays. Prefix lookup is a binary search.
+    """
+
+    def __init__(self, entries, by_name, keys, starts, ids):
+        self.entries = entries
+        self.by_name = by_name
+        self.keys = keys
+        self.starts = starts
+        self.ids = ids
+
+    @classmethod
+    def build(cls, entries):
+        ordered = sorted((key, not start, entry_id) for entry_id, entry in entries.items() for key, start in _search_keys(entry))
+        return cls(
+            entries, {normalize(entry['name']): entry for entry in entries.values()},
+            [key for key, _, _ in ordered], [not inner for _, inner, _ in ordered], [entry_id for _, _, entry_id in ordered],
+        )
+
+    def changed(self, rows):
+        """
+        A new index with `rows` (Medication values) applied, or None if none of them changes anything.
+        A few changed rows are spliced into copies of the arrays; more than REBUILD_CHANGES re-sort them.
+        """
+        rows = [row for row in rows if self.entries.get(row['id']) != (_entry(row) if row['is_active'] else None)]
+        if not rows:
+            return None
+        entries = dict(self.entries)
+        if len(rows) > REBUILD_CHANGES:
+            for row in rows:
+                entries.pop(row['id'], None)
+                if row['is_active']:
+                    entries[row['id']] = _entry(row)
+            return Index.build(entries)
+
+        index = Index(entries, dict(self.by_name), list(self.keys), list(self.starts), list(self.ids))
+        for row in rows:
+            old = entries.pop(row['id'], None)
+            if old is not None:
+                index.by_name.pop(normalize(old['name']), None)
+                for key, start in _search_keys(old):
+                    index._remove(key, row['id'])
+            if row['is_active']:
+                entry = entries[row['id']] = _entry(row)
+                index.by_name[normalize(entry['name'])] = entry
+                for key, start in _search_keys(entry):
+                    index._insert(key, start, row['id'])
+        return index
+
+    def _position(self, key, start, entry_id):
+        # equal keys are ordered name-starting first, then by id, as in build()
+        position = bisect.bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position] == key and (not self.starts[position], self.ids[position]) < (not start, entry_id):
+            position += 1
+        return position
+
+    def _insert(self, key, start, entry_id):
+        position = self._position(key, start, entry_id)
+        self.keys.insert(position, key)
+        self.starts.insert(position, start)
+        self.ids.insert(position, entry_id)
+
+    def _remove(self, key, entry_id):
+        position = bisect.bisect_left(self.keys, key)
+        while self.ids[position] != entry_id:
+            position += 1
+        del self.keys[position], self.starts[position], self.ids[position]
+
+    def has_prefix(self, prefix):
+        position = bisect.bisect_left(self.keys, prefix)
+        return position < len(self.keys) and self.keys[position].startswith(prefix)
+
+    def prefix_positions(self, prefix, scan):
+        """Positions of up to `scan` keys starting with `prefix`, in key order."""
+        position = bisect.bisect_left(self.keys, prefix)
+        end = min(len(self.keys), position + scan)
+        while position < end and self.keys[position].startswith(prefix):
+            yield position
+            position += 1
+
+    def next_chars(self, prefix):
+        """The characters that follow `prefix` in some key, found by skipping from one to the next."""
+        depth = len(prefix)
+        position = bisect.bisect_left(self.keys, prefix)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            key = self.keys[position]
+            if len(key) == depth:
+                position += 1
+                continue
+            char = key[depth]
+            yield char
+            position = bisect.bisect_left(self.keys, prefix + chr(ord(char) + 1), position)
+
+    def near_prefixes(self, query):
+        """
+        Prefixes one edit away from `query` that some key starts with: swapped neighbours and dropped
+        characters first, then substituted and inserted ones. Substitutes and insertions are only tried
+        from the characters that actually follow in the catalogue, which keeps this to a few hundred
+        binary searches rather than one per letter of the alphabet at every position.
+        """
+        seen = {query}
+        candidates = [query[:i] + query[i + 1] + query[i] + query[i + 2:] for i in range(len(query) - 1)]
+        candidates += [query[:i] + query[i + 1:] for i in range(len(query))]
+        for candidate in candidates:
+            if candidate and candidate not in seen:
+                seen.add(candidate)
+                if self.has_prefix(candidate):
+                    yield candidate
+        for i in range(len(query) + 1):
+            head = query[:i]
+            for char in self.next_chars(head):
+                for candidate in (head + char + query[i + 1:], head + char + query[i:]):
+                    if candidate not in seen:
+                        seen.add(candidate)
+                        if self.has_prefix(candidate):
+                            yield candidate
+
+
+def _entry(row):
+    return {field: row[field] for field in FIELDS}
+
+
+class Catalogue:
+    """
+    In-process copy of the active Medication rows for autocomplete. The first lookup in a worker
+    loads the table; after that the worker reads the rows saved since its last sync, at most every
+    MEDICATION_CATALOGUE_SYNC_SECONDS, and swaps in a new index with just those rows replaced, so
+    lookups never wait on the database. Deleted rows are dropped by a full reload every
+    MEDICATION_CATALOGUE_REBUILD_SECONDS (retiring an entry with is_active is seen on the next sync).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.index = None
+        self.synced_at = None
+        self.synced_from = None
+        self.built_at = None
+
+    def _is_fresh(self):
+        return self.synced_at is not None and time_module.monotonic() - self.synced_at < settings.MEDICATION_CATALOGUE_SYNC_SECONDS
+
+    def sync(self, force=False):
+        index = self.index
+        if not force and index is not None and self._is_fresh():
+            return index
+        # while one request syncs, the others carry on with the current index instead of queueing
+        if not self._lock.acquire(blocking=force or index is None):
+            return index
+        try:
+            if not force and self.index is not None and self._is_fresh():
+                return self.index
+            rebuild = self.index is None or time_module.monotonic() - self.built_at > settings.MEDICATION_CATALOGUE_REBUILD_SECONDS
+            started = timezone.now()
+            rows = Medication.objects.order_by()
+            if not rebuild:
+                rows = rows.filter(updated_at__gte=self.synced_from - SYNC_OVERLAP)
+            with querybudget.unmetered():
+                rows = list(rows.values(*FIELDS, 'is_active'))
+            if rebuild:
+                self.index = Index.build({row['id']: _entry(row) for row in rows if row['is_active']})
+                self.built_at = time_module.monotonic()
+            else:
+                self.index = self.index.changed(rows) or self.index
+            self.synced_from = started
+            self.synced_at = time_module.monotonic()
+            return self.index
+        finally:
+            self._lock.release()
+
+    def expire(self):
+        """Sync on the next lookup in this worker, so it sees its own writes at once."""
+        self.synced_at = None
+
+    def invalidate(self):
+        """Reload everything on the next lookup in this worker."""
+        with self._lock:
+            self.index = None
+            self.synced_at = None
+
+    def search(self, query, limit=10):
+        """
+        Up to `limit` entries for what has been typed so far: names starting with it first, then
+        names with a later word starting with it, then (when that leaves room) names one typo away.
+        """
+        index = self.sync()
+        query = normalize(query)
+        if not query:
+            return []
+        found, inner = {}, {}
+        for position in index.prefix_positions(query, limit * 20):
+            (found if index.starts[position] else inner).setdefault(index.ids[position], 'prefix')
+        for entry_id in inner:
+            found.setdefault(entry_id, 'prefix')
+        if len(found) < limit and len(query) >= MIN_FUZZY_LENGTH:
+            # every near prefix is one edit away; prefer names starting with it, then keys about as long as the query
+            near = {}
+            for prefix in index.near_prefixes(query):
+                for position in index.prefix_positions(prefix, limit):
+                    entry_id = index.ids[position]
+                    rank = (not index.starts[position], abs(len(index.keys[position]) - len(query)), index.keys[position])
+                    if entry_id not in found and rank < near.get(entry_id, rank + (0,)):
+                        near[entry_id] = rank
+            for entry_id in sorted(near, key=near.get):
+                found[entry_id] = 'fuzzy'
+        return [dict(index.entries[entry_id], match=match) for entry_id, match in list(found.items())[:limit]]
+
+    def canonical(self, name):
+        """The catalogue spelling of `name` when it names an active entry, otherwise `name` unchanged."""
+        entry = self.sync().by_name.get(normalize(name))
+        return entry['name'] if entry else name
+
+
+catalogue = Catalogue()
@@ -0,0 +1,168 @@
+import bisect
+import hashlib
+import json
+import threading
+import time as time_module
+import uuid
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_time
+from .models import Doctor
+from .serializers import DoctorSerializer
+
+VERSION_KEY = 'doctor-directory-version'
+
+
+class DirectoryFilterError(Exception):
+    pass
+
+
+class Snapshot:
+    """
+    Serialized doctors plus the sorted name keys used for prefix search. The digest is taken over the
+    serialized doctors, so every worker holding the same data hands out the same ETag.
+    """
+
+    def __init__(self, version, doctors):
+        self.version = version
+        self.built_at = time_module.monotonic()
+        self.entries = []
+        self.name_keys = []
+        for doctor in doctors:
+            data = DoctorSerializer(doctor).data
+            self.entries.append({
+                'data': data,
+                'specialization': doctor.specialization.lower(),
+                'fee': doctor.consultation_fee,
+                'experience': doctor.experience_years,
+                'available_from': doctor.available_from,
+                'available_to': doctor.available_to,
+            })
+            index = len(self.entries) - 1
+            first, last = doctor.user.first_name.lower(), doctor.user.last_name.lower()
+            for key in {first, last, f'{first} {last}'.strip()}:
+                if key:
+                    self.name_keys.append((key, index))
+        self.name_keys.sort()
+        content = json.dumps([entry['data'] for entry in self.entries], cls=DjangoJSONEncoder, sort_keys=True)
+        self.digest = hashlib.sha1(content.encode()).hexdigest()[:16]
+
+    def prefix_matches(self, prefix):
+        start = bisect.bisect_left(self.name_keys, (prefix,))
+        matches = set()
+        for key, index in self.name_keys[start:]:
+            if not key.startswith(prefix):
+                break
+            matches.add(index)
+        return matches
+
+
+class DoctorDirectory:
+    """
+    Process-wide snapshot of the doctor list. Model signals bump a version stored in the cache;
+    each worker rebuilds its snapshot when it sees a new version, or after DOCTOR_DIRECTORY_MAX_AGE
+    seconds so workers that do not share a cache backend still converge.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def current_version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            version = uuid.uuid4().hex
+            cache.add(VERSION_KEY, version, None)
+            version = cache.get(VERSION_KEY, version)
+        return version
+
+    def _is_stale(self, snapshot, version):
+        if snapshot is None or snapshot.version != version:
+            return True
+        return time_module.monotonic() - snapshot.built_at > settings.DOCTOR_DIRECTORY_MAX_AGE
+
+    def snapshot(self):
+        version = self.current_version()
+        snapshot = self._snapshot
+        if self._is_stale(snapshot, version):
+            with self._lock:
+                snapshot = self._snapshot
+                if self._is_stale(snapshot, version):
+                    doctors = Doctor.objects.select_related('user').order_by('user__first_name', 'user__last_name', 'id')
+                    snapshot = self._snapshot = Snapshot(version, doctors)
+        return snapshot
+
+    def invalidate(self):
+        cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+        self._snapshot = None
+
+    def search(self, params):
+        """Return (snapshot, matching serialized doctors) for the given query parameters."""
+        snapshot = self.snapshot()
+        specialization = params.get('specialization', '').strip().lower()
+        min_fee, max_fee = _decimal(params, 'min_fee'), _decimal(params, 'max_fee')
+        min_experience = _integer(params, 'min_experience')
+        available_from, available_to = _time(params, 'available_from'), _time(params, 'available_to')
+        query = params.get('q', '').strip().lower()
+
+        candidates = sorted(snapshot.prefix_matches(query)) if query else range(len(snapshot.entries))
+        results = []
+        for index in candidates:
+            entry = snapshot.entries[index]
+            if specialization and entry['specialization'] != specialization:
+                continue
+            if min_fee is not None and entry['fee'] < min_fee:
+                continue
+            if max_fee is not None and entry['fee'] > max_fee:
+                continue
+            if min_experience is not None and entry['experience'] < min_experience:
+                continue
+            # the doctor's availability window has to cover the requested one
+            if available_from and (not entry['available_from'] or entry['available_from'] > available_from):
+                continue
+            if available_to and (not entry['available_to'] or entry['available_to'] < available_to):
+                continue
+            results.append(entry['data'])
+        return snapshot, results
+
+    def headers(self, snapshot, query_string):
+        return {'ETag': f'"{snapshot.digest}-{uuid.uuid5(uuid.NAMESPACE_URL, query_string).hex[:12]}"'}
+
+
+def _decimal(params, name):
+    if not params.get(name):
+        return None
+    try:
+        value = Decimal(params[name])
+    except InvalidOperation:
+        value = None
+    # NaN and Infinity parse, but cannot be compared with a fee
+    if value is None or not value.is_finite():
+        raise DirectoryFilterError(f'{name} should be a number')
+    return value
+
+
+def _integer(params, name):
+    if not params.get(name):
+        return None
+    try:
+        return int(params[name])
+    except ValueError:
+        raise DirectoryFilterError(f'{name} should be a whole number')
+
+
+def _time(params, name):
+    if not params.get(name):
+        return None
+    try:
+        value = parse_time(params[name])
+    except ValueError:
+        value = None
+    if value is None:
+        raise DirectoryFilterError(f'{name} should be a time in HH:MM format')
+    return value
+
+
+directory = DoctorDirectory()
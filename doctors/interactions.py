@@ -0,0 +1,146 @@
+import threading
+import time as time_module
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from core import querybudget
+from patients.allergies import patient_allergens
+from .catalogue import catalogue
+from .medications import normalize
+from .models import DrugInteraction, PrescriptionMedication
+
+VERSION_KEY = 'drug-interactions-version'
+SEVERITY_ORDER = {DrugInteraction.MAJOR: 0, DrugInteraction.MODERATE: 1, DrugInteraction.MINOR: 2}
+
+
+def _pair(a, b):
+    return (a << 32) | b if a < b else (b << 32) | a
+
+
+class InteractionTable:
+    """
+    The interaction table precomputed for lookups: every drug name is interned to a small integer
+    code, and each interacting pair of codes is packed into one int that keys the rule. Checking a
+    prescription is then a dict lookup per pair of its drugs, however large the table is.
+    """
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.built_at = time_module.monotonic()
+        self.codes = {}
+        self.rules = []
+        self.pairs = {}
+        for drug_a, drug_b, severity, description in rows:
+            a = self.codes.setdefault(drug_a, len(self.codes))
+            b = self.codes.setdefault(drug_b, len(self.codes))
+            self.pairs[_pair(a, b)] = len(self.rules)
+            self.rules.append((drug_a, drug_b, severity, description))
+
+    def between(self, first, second):
+        """The rules between any name in `first` and any name in `second` (sets of normalized names)."""
+        found = []
+        for a in first:
+            code_a = self.codes.get(a)
+            if code_a is None:
+                continue
+            for b in second:
+                code_b = self.codes.get(b)
+                if code_b is not None and code_a != code_b and _pair(code_a, code_b) in self.pairs:
+                    found.append(self.rules[self.pairs[_pair(code_a, code_b)]])
+        return found
+
+
+class Interactions:
+    """
+    Process-wide InteractionTable. Changes to DrugInteraction bump a version in the cache; a worker
+    rebuilds its table when it sees a new version, or after INTERACTION_TABLE_MAX_AGE seconds so
+    workers that do not share a cache backend still converge.
+    """
+
+    def __init__(self):
+        self._table = None
+        self._lock = threading.Lock()
+
+    def current_version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(VERSION_KEY)
+        return version
+
+    def _is_stale(self, table, version):
+        if table is None or table.version != version:
+            return True
+        return time_module.monotonic() - table.built_at > settings.INTERACTION_TABLE_MAX_AGE
+
+    def table(self):
+        version = self.current_version()
+        table = self._table
+        if self._is_stale(table, version):
+            with self._lock:
+                table = self._table
+                if self._is_stale(table, version):
+                    with querybudget.unmetered():
+                        rows = list(DrugInteraction.objects.values_list('drug_a', 'drug_b', 'severity', 'description'))
+                    table = self._table = InteractionTable(version, rows)
+        return table
+
+    def invalidate(self):
+        cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+        self._table = None
+
+
+interactions = Interactions()
+
+
+def _names(medication_name, index):
+    """The normalized names a medication goes by: as written, plus its generic name if the catalogue knows it."""
+    name = normalize(medication_name)
+    entry = index.by_name.get(name)
+    names = {name}
+    if entry and entry['generic_name']:
+        names.add(normalize(entry['generic_name']))
+    return names
+
+
+def check(patient_id, medications):
+    """
+    Warnings for prescribing `medications` (dicts with a 'name') to a patient: a medication whose name
+    or generic name contains an allergen recorded for the patient, and interactions among the
+    medications or with those the patient was prescribed in the last INTERACTION_LOOKBACK_DAYS.
+    Most severe first. Two indexed queries; everything else is in memory.
+    """
+    table = interactions.table()
+    index = catalogue.sync()
+    drugs = [(medication['name'], _names(medication['name'], index)) for medication in medications]
+    warnings = []
+
+    allergens = patient_allergens(patient_id)
+    for name, names in drugs:
+        padded = [f' {drug} ' for drug in names]
+        for allergen in sorted(allergens):
+            if any(f' {allergen} ' in drug for drug in padded):
+                warnings.append({
+                    'type': 'allergy', 'severity': DrugInteraction.MAJOR, 'medications': [name], 'allergen': allergen,
+                    'message': f'The patient has a recorded allergy to {allergen}',
+                })
+
+    since = timezone.now() - timedelta(days=settings.INTERACTION_LOOKBACK_DAYS)
+    recent = PrescriptionMedication.objects.filter(prescription__patient_id=patient_id, prescription__created_at__gte=since)
+    recent = [(name, _names(name, index)) for name in set(recent.values_list('name', flat=True))]
+    prescribed = set().union(*(names for _, names in drugs))
+    recent = [(name, names) for name, names in recent if not names & prescribed]
+
+    for position, (name, names) in enumerate(drugs):
+        others = [(other, other_names, False) for other, other_names in drugs[position + 1:]]
+        others += [(other, other_names, True) for other, other_names in recent]
+        for other, other_names, is_recent in others:
+            for drug_a, drug_b, severity, description in table.between(names, other_names):
+                warnings.append({
+                    'type': 'interaction', 'severity': severity, 'medications': [name, other], 'recent': is_recent,
+                    'message': description or f'{drug_a} interacts with {drug_b}',
+                })
+    warnings.sort(key=lambda warning: SEVERITY_ORDER.get(warning['severity'], len(SEVERITY_ORDER)))
+    return warnings
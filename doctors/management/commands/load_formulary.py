@@ -0,0 +1,77 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from doctors.medications import normalize
+from doctors.models import Medication
+
+COLUMNS = ('name', 'generic_name', 'form', 'strength')
+
+
+class Command(BaseCommand):
+    help = (
+        'Load a formulary CSV (columns: name, and optionally generic_name, form, strength) into the '
+        'medication catalogue. Rows are matched on the normalized name and upserted in batches; '
+        'running it again with the same file changes nothing.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--retire-missing', action='store_true', help='Mark catalogue entries that are not in the file inactive')
+
+    def _rows(self, path):
+        """{name key: Medication} from the file; a later row for the same name wins."""
+        medications = {}
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                if not reader.fieldnames or 'name' not in reader.fieldnames:
+                    raise CommandError('The file needs a header row with at least a "name" column')
+                for line, row in enumerate(reader, start=2):
+                    name = ' '.join((row.get('name') or '').split())
+                    if not name:
+                        self.stderr.write(f'Line {line}: no name, skipped')
+                        continue
+                    values = {column: ' '.join((row.get(column) or '').split()) for column in COLUMNS}
+                    medications[normalize(name)[:200]] = Medication(
+                        name=name[:200], name_key=normalize(name)[:200], generic_name=values['generic_name'][:200],
+                        form=values['form'][:50], strength=values['strength'][:50], is_active=True,
+                    )
+        except OSError as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+        return medications
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size should be at least 1')
+        medications = self._rows(options['file'])
+
+        # only rows that are new or differ are written, so unchanged entries keep their updated_at
+        # and workers do not re-read them
+        existing = {
+            row[0]: row[1:] for row in
+            Medication.objects.values_list('name_key', 'name', 'generic_name', 'form', 'strength', 'is_active').iterator(chunk_size=options['batch_size'])
+        }
+        changed = [
+            medication for key, medication in medications.items()
+            if existing.get(key) != (medication.name, medication.generic_name, medication.form, medication.strength, True)
+        ]
+        created = sum(1 for medication in changed if medication.name_key not in existing)
+        with transaction.atomic():
+            Medication.objects.bulk_create(
+                changed, batch_size=options['batch_size'], update_conflicts=True, unique_fields=['name_key'],
+                update_fields=['name', 'generic_name', 'form', 'strength', 'is_active', 'updated_at'],
+            )
+            retired = 0
+            if options['retire_missing']:
+                missing = [key for key, row in existing.items() if row[-1] and key not in medications]
+                for start in range(0, len(missing), options['batch_size']):
+                    retired += Medication.objects.filter(name_key__in=missing[start:start + options['batch_size']]).update(
+                        is_active=False, updated_at=timezone.now(),
+                    )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {len(medications)} medications: {created} added, {len(changed) - created} updated, '
+            f'{len(medications) - len(changed)} unchanged, {retired} retired'
+        ))
@@ -0,0 +1,53 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from doctors.interactions import interactions
+from doctors.medications import normalize
+from doctors.models import DrugInteraction
+
+SEVERITIES = {DrugInteraction.MINOR, DrugInteraction.MODERATE, DrugInteraction.MAJOR}
+
+
+class Command(BaseCommand):
+    help = (
+        'Load drug-drug interactions from a CSV (columns: drug_a, drug_b, severity, description) into the '
+        'interaction table checked when prescriptions are written. Pairs are matched in either order and upserted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--replace', action='store_true', help='Delete interactions that are not in the file')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size should be at least 1')
+        rules = {}
+        try:
+            with open(options['file'], newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                if not reader.fieldnames or not {'drug_a', 'drug_b'} <= set(reader.fieldnames):
+                    raise CommandError('The file needs a header row with "drug_a" and "drug_b" columns')
+                for line, row in enumerate(reader, start=2):
+                    drug_a, drug_b = sorted((normalize(row['drug_a'] or '')[:200], normalize(row['drug_b'] or '')[:200]))
+                    severity = normalize(row.get('severity') or DrugInteraction.MODERATE)
+                    if not drug_a or drug_a == drug_b or severity not in SEVERITIES:
+                        self.stderr.write(f'Line {line}: needs two different drugs and a severity of {", ".join(sorted(SEVERITIES))}, skipped')
+                        continue
+                    rules[drug_a, drug_b] = DrugInteraction(drug_a=drug_a, drug_b=drug_b, severity=severity, description=(row.get('description') or '').strip())
+        except OSError as e:
+            raise CommandError(f'Cannot read {options["file"]}: {e}')
+
+        with transaction.atomic():
+            removed = 0
+            if options['replace']:
+                stale = [pk for pk, drug_a, drug_b in DrugInteraction.objects.values_list('id', 'drug_a', 'drug_b') if (drug_a, drug_b) not in rules]
+                for start in range(0, len(stale), options['batch_size']):
+                    removed += DrugInteraction.objects.filter(id__in=stale[start:start + options['batch_size']]).delete()[0]
+            DrugInteraction.objects.bulk_create(
+                list(rules.values()), batch_size=options['batch_size'], update_conflicts=True,
+                unique_fields=['drug_a', 'drug_b'], update_fields=['severity', 'description'],
+            )
+        # bulk writes send no signals
+        interactions.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Loaded {len(rules)} interactions, removed {removed}'))
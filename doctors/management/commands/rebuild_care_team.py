@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from doctors import careteam
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the doctor/patient care-team table from the appointment history.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = careteam.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the care team with {count} doctor/patient pairs'))
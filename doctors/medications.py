@@ -0,0 +1,60 @@
+from collections import defaultdict
+from django.db import transaction
+from django.dispatch import Signal
+
+# Sent with `prescription` after its line items were replaced; post_save fires before they exist
+medications_changed = Signal()
+
+
+def normalize(name):
+    """The form medication names are matched in: trimmed, single-spaced, lower case."""
+    return ' '.join(str(name).split()).lower()
+
+
+def line_items(prescription_id, medications):
+    """Unsaved PrescriptionMedication rows for a list of {'name', 'dosage', ...} dicts, in the order given."""
+    from .models import PrescriptionMedication
+
+    items = []
+    for position, medication in enumerate(medications):
+        details = {key: value for key, value in medication.items() if key not in ('name', 'dosage')}
+        name = str(medication.get('name', '')).strip()[:200]
+        items.append(PrescriptionMedication(
+            prescription_id=prescription_id, position=position, name=name, name_key=normalize(name)[:200],
+            dosage=str(medication.get('dosage', '')).strip()[:100], details=details,
+        ))
+    return items
+
+
+def set_medications(prescription, medications):
+    """Replace a prescription's line items with `medications` and let listeners (the search index) know."""
+    from .models import PrescriptionMedication
+
+    with transaction.atomic():
+        prescription.items.all().delete()
+        PrescriptionMedication.objects.bulk_create(line_items(prescription.id, medications))
+    getattr(prescription, '_prefetched_objects_cache', {}).pop('items', None)
+    medications_changed.send(sender=type(prescription), prescription=prescription)
+
+
+def medications_by_prescription(prescription_ids):
+    """{prescription id: [medication dicts]} for many prescriptions with one query."""
+    from .models import PrescriptionMedication
+
+    result = defaultdict(list)
+    rows = PrescriptionMedication.objects.filter(prescription_id__in=prescription_ids).order_by('prescription_id', 'position')
+    for item in rows:
+        result[item.prescription_id].append(item.as_dict())
+    return result
+
+
+def as_text(medications):
+    """'name dosage, name dosage' for medical history records and the search index."""
+    return ', '.join(f'{medication.get("name", "")} {medication.get("dosage", "")}'.strip() for medication in medications)
+
+
+def containing(queryset, name):
+    """Prescriptions in `queryset` with a line item named `name`, answered from the name index."""
+    from .models import PrescriptionMedication
+
+    return queryset.filter(id__in=PrescriptionMedication.objects.filter(name_key=normalize(name)).values('prescription_id'))
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:05
+
+import django.db.models.deletion
+from collections import defaultdict
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def build_slot_index(apps, schema_editor):
+    Appointment = apps.get_model('patients', 'Appointment')
+    DoctorDaySchedule = apps.get_model('doctors', 'DoctorDaySchedule')
+    length = settings.APPOINTMENT_SLOT_MINUTES
+
+    booked = defaultdict(list)
+    for doctor_id, scheduled_at in Appointment.objects.values_list('doctor_id', 'scheduled_at').iterator():
+        local = timezone.localtime(scheduled_at)
+        start = local.hour * 60 + local.minute
+        booked[(doctor_id, local.date())].append([start, start + length])
+
+    DoctorDaySchedule.objects.bulk_create(
+        [DoctorDaySchedule(doctor_id=doctor_id, date=day, booked_slots=sorted(slots)) for (doctor_id, day), slots in booked.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0007_remove_doctor_is_active'),
+        ('patients', '0007_appointment_doctor_time_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorDaySchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('booked_slots', models.JSONField(default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='day_schedules', to='doctors.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'date'), name='unique_doctor_day_schedule')],
+            },
+        ),
+        migrations.RunPython(build_slot_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:16
+
+from collections import Counter
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_rollups(apps, schema_editor):
+    Appointment = apps.get_model('patients', 'Appointment')
+    DoctorDaySchedule = apps.get_model('doctors', 'DoctorDaySchedule')
+
+    booked, completed = Counter(), Counter()
+    for doctor_id, scheduled_at, prescription_given in Appointment.objects.values_list('doctor_id', 'scheduled_at', 'prescription_given').iterator():
+        key = (doctor_id, timezone.localtime(scheduled_at).date())
+        booked[key] += 1
+        completed[key] += prescription_given
+
+    schedules = list(DoctorDaySchedule.objects.all())
+    for schedule in schedules:
+        schedule.booked_count = booked[(schedule.doctor_id, schedule.date)]
+        schedule.completed_count = completed[(schedule.doctor_id, schedule.date)]
+    DoctorDaySchedule.objects.bulk_update(schedules, ['booked_count', 'completed_count'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0009_doctor_slot_minutes'),
+        ('patients', '0009_appointment_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doctordayschedule',
+            name='booked_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='doctordayschedule',
+            name='completed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
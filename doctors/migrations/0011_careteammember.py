@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_care_team(apps, schema_editor):
+    Appointment = apps.get_model('patients', 'Appointment')
+    CareTeamMember = apps.get_model('doctors', 'CareTeamMember')
+    rows = Appointment.objects.values('doctor_id', 'patient_id').annotate(count=Count('id')).order_by()
+    CareTeamMember.objects.bulk_create(
+        [CareTeamMember(doctor_id=row['doctor_id'], patient_id=row['patient_id'], appointment_count=row['count']) for row in rows.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0010_dayschedule_rollups'),
+        ('patients', '0010_medical_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CareTeamMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('appointment_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='care_team', to='doctors.doctor')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='care_team', to='patients.patient')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'patient'), name='unique_care_team_member')],
+            },
+        ),
+        migrations.RunPython(fill_care_team, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:37
+
+from collections import defaultdict
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+# the dashboard statistics of adminpanel.stats as of this migration: counter name -> DailyStat column
+METRICS = {
+    'patients': 'new_patients',
+    'doctors': 'new_doctors',
+    'appointments': 'appointments',
+    'appointments_active': 'appointments_active',
+    'appointments_completed': 'appointments_completed',
+    'prescriptions': 'prescriptions',
+    'prescriptions_paid': 'prescriptions_paid',
+    'revenue': 'revenue',
+}
+
+
+def compute_stats(apps):
+    totals = dict.fromkeys(METRICS, 0)
+    daily = defaultdict(lambda: dict.fromkeys(METRICS.values(), 0))
+
+    def by_day(queryset, date_field, **aggregates):
+        return queryset.annotate(day=TruncDate(date_field, tzinfo=timezone.get_current_timezone())).values('day').annotate(**aggregates).order_by()
+
+    for model, metric in (('patients.Patient', 'patients'), ('doctors.Doctor', 'doctors')):
+        for row in by_day(apps.get_model(model).objects.all(), 'user__date_joined', n=Count('id')):
+            totals[metric] += row['n']
+            daily[row['day']][METRICS[metric]] = row['n']
+
+    Appointment = apps.get_model('patients', 'Appointment')
+    for row in by_day(Appointment.objects.all(), 'scheduled_at', n=Count('id'), active=Count('id', filter=Q(status=True)), completed=Count('id', filter=Q(prescription_given=True))):
+        for metric, key in (('appointments', 'n'), ('appointments_active', 'active'), ('appointments_completed', 'completed')):
+            totals[metric] += row[key]
+            daily[row['day']][metric] = row[key]
+
+    Prescription = apps.get_model('doctors', 'Prescription')
+    for row in by_day(Prescription.objects.all(), 'created_at', n=Count('id'), paid=Count('id', filter=Q(is_paid=True))):
+        for metric, key in (('prescriptions', 'n'), ('prescriptions_paid', 'paid')):
+            totals[metric] += row[key]
+            daily[row['day']][metric] = row[key]
+
+    Payment = apps.get_model('doctors', 'Payment')
+    for row in by_day(Payment.objects.filter(status='paid'), 'created_at', revenue=Sum('amount')):
+        totals['revenue'] += row['revenue']
+        daily[row['day']]['revenue'] = row['revenue']
+    return totals, daily
+
+
+def normalize_payments(apps, schema_editor):
+    """
+    Lower-case the 'Paid' status written by the old payment_success view, and flag the extra paid rows
+    that refreshing it created as duplicate, keeping each prescription's first payment paid. The rows
+    stay for someone to check against the provider and refund or remove. The dashboard statistics
+    counted them as revenue, so they are recomputed when any were flagged.
+    """
+    Payment = apps.get_model('doctors', 'Payment')
+    Payment.objects.filter(status__iexact='paid').exclude(status='paid').update(status='paid')
+
+    seen, duplicates = set(), []
+    for payment_id, prescription_id in Payment.objects.filter(status='paid').order_by('prescription_id', 'id').values_list('id', 'prescription_id').iterator():
+        if prescription_id in seen:
+            duplicates.append(payment_id)
+        seen.add(prescription_id)
+    if not duplicates:
+        return
+    for start in range(0, len(duplicates), 500):
+        Payment.objects.filter(id__in=duplicates[start:start + 500]).update(status='duplicate')
+
+    totals, daily = compute_stats(apps)
+    StatCounter = apps.get_model('adminpanel', 'StatCounter')
+    StatCounter.objects.all().delete()
+    StatCounter.objects.bulk_create([StatCounter(name=name, value=value) for name, value in totals.items()])
+    DailyStat = apps.get_model('adminpanel', 'DailyStat')
+    DailyStat.objects.all().delete()
+    DailyStat.objects.bulk_create([DailyStat(date=day, **values) for day, values in daily.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0011_careteammember'),
+        ('adminpanel', '0003_dashboard_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='stripe_session_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('paid', 'Paid'), ('failed', 'Failed'), ('duplicate', 'Duplicate')], default='pending', max_length=20),
+        ),
+        migrations.RunPython(normalize_payments, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'paid')), fields=('prescription',), name='unique_paid_payment'),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:42
+
+import json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def parse_medications(text):
+    """The medications column: a JSON list of dicts, or (rarely) free text."""
+    try:
+        value = json.loads(text)
+    except (TypeError, ValueError):
+        value = None
+    if isinstance(value, list):
+        return [item if isinstance(item, dict) else {'name': str(item)} for item in value]
+    return [{'name': text.strip()}] if text and text.strip() else []
+
+
+def line_items(prescription_id, medications, item_model):
+    items = []
+    for position, medication in enumerate(medications):
+        details = {key: value for key, value in medication.items() if key not in ('name', 'dosage')}
+        name = str(medication.get('name', '')).strip()[:200]
+        items.append(item_model(
+            prescription_id=prescription_id, position=position, name=name, name_key=' '.join(name.split()).lower()[:200],
+            dosage=str(medication.get('dosage', '')).strip()[:100], details=details,
+        ))
+    return items
+
+
+def split_medications(apps, schema_editor):
+    Prescription = apps.get_model('doctors', 'Prescription')
+    PrescriptionMedication = apps.get_model('doctors', 'PrescriptionMedication')
+    batch = []
+    for prescription_id, medications in Prescription.objects.values_list('id', 'medications').iterator(chunk_size=2000):
+        batch.extend(line_items(prescription_id, parse_medications(medications), PrescriptionMedication))
+        if len(batch) >= 2000:
+            PrescriptionMedication.objects.bulk_create(batch)
+            batch = []
+    PrescriptionMedication.objects.bulk_create(batch)
+
+
+def join_medications(apps, schema_editor):
+    Prescription = apps.get_model('doctors', 'Prescription')
+    PrescriptionMedication = apps.get_model('doctors', 'PrescriptionMedication')
+    medications = {}
+    for item in PrescriptionMedication.objects.order_by('prescription_id', 'position').iterator(chunk_size=2000):
+        medications.setdefault(item.prescription_id, []).append({'name': item.name, 'dosage': item.dosage, **item.details})
+    prescriptions = [Prescription(id=prescription_id, medications=json.dumps(items)) for prescription_id, items in medications.items()]
+    Prescription.objects.bulk_update(prescriptions, ['medications'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0012_payment_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrescriptionMedication',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('name', models.CharField(max_length=200)),
+                ('name_key', models.CharField(max_length=200)),
+                ('dosage', models.CharField(blank=True, max_length=100)),
+                ('details', models.JSONField(blank=True, default=dict)),
+                ('prescription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='doctors.prescription')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['name_key', 'prescription'], name='prescription_item_name_idx')],
+                'constraints': [models.UniqueConstraint(fields=('prescription', 'position'), name='unique_prescription_item_position')],
+            },
+        ),
+        # a default lets the column be re-added, empty, when this migration is reversed
+        migrations.AlterField(
+            model_name='prescription',
+            name='medications',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.RunPython(split_medications, join_medications),
+        migrations.RemoveField(
+            model_name='prescription',
+            name='medications',
+        ),
+    ]
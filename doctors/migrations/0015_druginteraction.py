@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0014_medication'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrugInteraction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('drug_a', models.CharField(max_length=200)),
+                ('drug_b', models.CharField(max_length=200)),
+                ('severity', models.CharField(choices=[('minor', 'Minor'), ('moderate', 'Moderate'), ('major', 'Major')], default='moderate', max_length=10)),
+                ('description', models.TextField(blank=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('drug_a', 'drug_b'), name='unique_drug_interaction'), models.CheckConstraint(condition=models.Q(('drug_a__lt', models.F('drug_b'))), name='drug_interaction_ordered')],
+            },
+        ),
+    ]
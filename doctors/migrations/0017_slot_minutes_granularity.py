@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:45
+
+import doctors.models
+from django.db import migrations, models
+
+# APPOINTMENT_GRANULARITY_MINUTES and APPOINTMENT_MAX_MINUTES as of this migration
+STEP = 5
+MAX_MINUTES = 240
+
+
+def round_slot_minutes(apps, schema_editor):
+    # slots that bookings would reject are rounded to the nearest block multiple the validator accepts
+    Doctor = apps.get_model('doctors', 'Doctor')
+    for doctor in Doctor.objects.filter(slot_minutes__isnull=False).only('id', 'slot_minutes'):
+        rounded = min(max(round(doctor.slot_minutes / STEP) * STEP, STEP), MAX_MINUTES)
+        if rounded != doctor.slot_minutes:
+            Doctor.objects.filter(id=doctor.id).update(slot_minutes=rounded)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0016_payment_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='doctor',
+            name='slot_minutes',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[doctors.models.validate_slot_minutes]),
+        ),
+        migrations.RunPython(round_slot_minutes, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,19 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import JSONField
 from patients.models import Appointment, Patient
-from core.models import User
+from core.models import LoadedValuesMixin, User
 # Create your models here.
 
 
+def validate_slot_minutes(value):
+    # listed slots have to be bookable, and bookings start on reservation block boundaries
+    step = settings.APPOINTMENT_GRANULARITY_MINUTES
+    if value % step or not step <= value <= settings.APPOINTMENT_MAX_MINUTES:
+        raise ValidationError(f'slot_minutes should be a multiple of {step} between {step} and {settings.APPOINTMENT_MAX_MINUTES}')
+
+
 class Doctor(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     specialization = models.CharField(max_length=100)
@@ -15,30 +24,148 @@ class Doctor(models.Model):
     consultation_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
     available_from = models.TimeField(null=True, blank=True)
     available_to = models.TimeField(null=True, blank=True)
+    slot_minutes = models.PositiveSmallIntegerField(null=True, blank=True, validators=[validate_slot_minutes])
     
     def __str__(self):
         return f'Dr. {self.user.get_full_name()} - {self.specialization}'
 
 
 
-class Prescription(models.Model):
+class Prescription(LoadedValuesMixin, models.Model):
     appointment = models.OneToOneField(Appointment, on_delete=models.CASCADE)
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE)
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     diagnosis = models.TextField(default='Not Specified')
-    medications = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     is_paid = models.BooleanField(default=False)
     
+    @property
+    def medication_list(self):
+        # served from prefetch_related('items') when the queryset has it
+        return [item.as_dict() for item in self.items.all()]
+
     def __str__(self):
         return f'Meds prescribed for {self.patient.user.get_full_name()} by Dr. {self.doctor.user.get_full_name()}'
         
 
-class Payment(models.Model):
+class PrescriptionMedication(models.Model):
+    # One medication line of a prescription. `name_key` is the normalized name (doctors.medications.normalize),
+    # indexed so "prescriptions containing drug X" is an index lookup; keys other than name and dosage go to `details`
+    prescription = models.ForeignKey(Prescription, on_delete=models.CASCADE, related_name='items')
+    position = models.PositiveSmallIntegerField()
+    name = models.CharField(max_length=200)
+    name_key = models.CharField(max_length=200)
+    dosage = models.CharField(max_length=100, blank=True)
+    details = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['prescription', 'position'], name='unique_prescription_item_position'),
+        ]
+        indexes = [
+            models.Index(fields=['name_key', 'prescription'], name='prescription_item_name_idx'),
+        ]
+
+    def as_dict(self):
+        return {'name': self.name, 'dosage': self.dosage, **self.details}
+
+    def __str__(self):
+        return f'{self.name} {self.dosage}'.strip()
+
+
+class Medication(models.Model):
+    # The drug catalogue (formulary), loaded with `manage.py load_formulary` and served to prescription
+    # autocomplete from doctors.catalogue. Entries are retired with is_active rather than deleted
+    name = models.CharField(max_length=200)
+    name_key = models.CharField(max_length=200, unique=True)
+    generic_name = models.CharField(max_length=200, blank=True)
+    form = models.CharField(max_length=50, blank=True)
+    strength = models.CharField(max_length=50, blank=True)
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return ' '.join(part for part in (self.name, self.strength, self.form) if part)
+
+
+class DrugInteraction(models.Model):
+    # A known interaction between two drugs, by normalized name (brand or generic), stored with drug_a < drug_b.
+    # Loaded with `manage.py load_interactions` and checked in memory by doctors.interactions
+    MINOR, MODERATE, MAJOR = 'minor', 'moderate', 'major'
+
+    drug_a = models.CharField(max_length=200)
+    drug_b = models.CharField(max_length=200)
+    severity = models.CharField(max_length=10, choices=[(MINOR, 'Minor'), (MODERATE, 'Moderate'), (MAJOR, 'Major')], default=MODERATE)
+    description = models.TextField(blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['drug_a', 'drug_b'], name='unique_drug_interaction'),
+            models.CheckConstraint(condition=models.Q(drug_a__lt=models.F('drug_b')), name='drug_interaction_ordered'),
+        ]
+
+    def save(self, *args, **kwargs):
+        from .medications import normalize
+
+        self.drug_a, self.drug_b = sorted((normalize(self.drug_a), normalize(self.drug_b)))
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f'{self.drug_a} + {self.drug_b} ({self.severity})'
+
+
+class Payment(LoadedValuesMixin, models.Model):
+    # pending -> paid or failed; failed -> paid (a late confirmation). paid is final, and the
+    # conditional unique constraint allows one paid payment per prescription; a second payment
+    # confirmed for a paid prescription is kept as duplicate, for someone to refund or remove
+    PENDING, PAID, FAILED, DUPLICATE = 'pending', 'paid', 'failed', 'duplicate'
+
     prescription = models.ForeignKey(Prescription, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    status = models.CharField(max_length=20, choices=[('pending', 'Pending'), ('paid', 'Paid')], default='pending')
+    status = models.CharField(max_length=20, choices=[(PENDING, 'Pending'), (PAID, 'Paid'), (FAILED, 'Failed'), (DUPLICATE, 'Duplicate')], default=PENDING)
+    stripe_session_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # lets readers that copy the table (adminpanel.analytics) pick up status changes as well as new rows
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['prescription'], condition=models.Q(status='paid'), name='unique_paid_payment'),
+        ]
+
+    def __str__(self):
+        return f'Payment for {self.prescription.patient.user.username}'
+
+class DoctorDaySchedule(models.Model):
+    # Per-doctor, per-day index of booked intervals and daily rollups, kept in sync by doctors.signals
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='day_schedules')
+    date = models.DateField()
+    booked_slots = models.JSONField(default=list)
+    booked_count = models.PositiveIntegerField(default=0)
+    completed_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'date'], name='unique_doctor_day_schedule'),
+        ]
+
+    def __str__(self):
+        return f'Schedule of doctor #{self.doctor_id} on {self.date}'
+
+
+class CareTeamMember(models.Model):
+    # A doctor sees a patient's records once they share an appointment; one row per pair, kept in sync by doctors.signals
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='care_team')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='care_team')
+    appointment_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'patient'], name='unique_care_team_member'),
+        ]
 
     def __str__(self):
-        return f'Payment for {self.prescription.patient.user.username}'
\ No newline at end of file
+        return f'Patient #{self.patient_id} in the care of doctor #{self.doctor_id}'
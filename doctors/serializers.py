@@ -1,8 +1,11 @@
-import json
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from core.models import User
+from core.principal import get_principal
 from patients.models import Appointment 
+from .catalogue import catalogue
+from .medications import set_medications
 from .models import Doctor, Prescription
 
 user = get_user_model()
@@ -44,7 +47,7 @@ class DoctorSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Doctor
-        fields = ('id', 'user', 'specialization', 'phone', 'qualification', 'experience_years', 'license_number', 'consultation_fee', 'available_from', 'available_to')
+        fields = ('id', 'user', 'specialization', 'phone', 'qualification', 'experience_years', 'license_number', 'consultation_fee', 'available_from', 'available_to', 'slot_minutes')
 
 class AppointmentSerializer(serializers.ModelSerializer):
     patient_name = serializers.SerializerMethodField()
@@ -53,7 +56,8 @@ class AppointmentSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Appointment
-        fields = ['id', 'patient_name', 'doctor_name', 'scheduled_at', 'prescription_given', 'status']
+        fields = ['id', 'patient_name', 'doctor_name', 'scheduled_at', 'duration_minutes', 'ends_at', 'prescription_given', 'status']
+        read_only_fields = ['ends_at']
         
     def get_patient_name(self, obj):
         return obj.patient.user.get_full_name()
@@ -67,7 +71,7 @@ class AppointmentSerializer(serializers.ModelSerializer):
 class PrescriptionSerializer(serializers.ModelSerializer):
     doctor_name = serializers.CharField(source='doctor.user.get_full_name', read_only=True)
     patient_name = serializers.CharField(source='patient.user.get_full_name', read_only=True)
-    medications = serializers.JSONField()
+    medications = serializers.JSONField(source='medication_list')
     medications_details = serializers.SerializerMethodField(read_only=True)
     
     class Meta:
@@ -76,13 +80,9 @@ class PrescriptionSerializer(serializers.ModelSerializer):
         read_only_fields = ['doctor', 'created_at', 'is_paid', 'doctor_name', 'patient_name', 'patient']
 
     def get_medications_details(self, obj):
-        user = self.context['request'].user if self.context.get('request') else None
-        if hasattr(user, 'doctor') or obj.is_paid:
-            
-            try:
-                return json.loads(obj.medications)
-            except Exception:
-                return []
+        principal = get_principal(self.context['request']) if self.context.get('request') else None
+        if (principal and principal.doctor_id is not None) or obj.is_paid:
+            return obj.medication_list
         else:
             return 'Prescription available after payment'
 
@@ -102,15 +102,20 @@ class PrescriptionSerializer(serializers.ModelSerializer):
             if 'name' not in med or 'dosage' not in med:
                 raise serializers.ValidationError('Each medication must have "name" and "dosage" mentioned')
         
-        return value
+        # names found in the catalogue are stored in its spelling, so the same drug groups together
+        return [dict(med, name=catalogue.canonical(med['name'])) for med in value]
 
+    @transaction.atomic
     def create(self, validated_data):
-        medications = validated_data.pop('medications')
-        validated_data['medications'] = json.dumps(medications)
-        return super().create(validated_data)
+        medications = validated_data.pop('medication_list')
+        prescription = super().create(validated_data)
+        set_medications(prescription, medications)
+        return prescription
     
+    @transaction.atomic
     def update(self, instance, validated_data):
-        medications = validated_data.pop('medications', None)
+        medications = validated_data.pop('medication_list', None)
+        instance = super().update(instance, validated_data)
         if medications is not None:
-            validated_data['medications'] = json.dumps(medications)
-        return super().update(instance, validated_data)
\ No newline at end of file
+            set_medications(instance, medications)
+        return instance
\ No newline at end of file
@@ -0,0 +1,85 @@
+from collections import defaultdict
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from core.models import User
+from patients.models import Appointment
+from .catalogue import catalogue
+from .directory import directory
+from .interactions import interactions
+from .models import Doctor, DrugInteraction, Medication
+from patients.signals import appointments_bulk_created
+from .careteam import appointment_pairs, refresh_pairs
+from .slots import appointment_day, refresh_day, refresh_days
+
+
+def _touched_days(instance):
+    touched = {(instance.doctor_id, appointment_day(instance.scheduled_at))}
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded and 'scheduled_at' in loaded and 'doctor_id' in loaded:
+        touched.add((loaded['doctor_id'], appointment_day(loaded['scheduled_at'])))
+    return touched
+
+
+@receiver(post_save, sender=Appointment)
+def update_slot_index_on_save(sender, instance, **kwargs):
+    for doctor_id, day in _touched_days(instance):
+        refresh_day(doctor_id, day)
+
+
+@receiver(post_delete, sender=Appointment)
+def update_slot_index_on_delete(sender, instance, **kwargs):
+    for doctor_id, day in _touched_days(instance):
+        refresh_day(doctor_id, day)
+
+
+@receiver(appointments_bulk_created)
+def update_slot_index_on_bulk_create(sender, appointments, **kwargs):
+    days_by_doctor = defaultdict(set)
+    for appointment in appointments:
+        days_by_doctor[appointment.doctor_id].add(appointment_day(appointment.scheduled_at))
+    for doctor_id, days in days_by_doctor.items():
+        refresh_days(doctor_id, days)
+
+
+@receiver(post_save, sender=Appointment)
+def update_care_team_on_save(sender, instance, created, **kwargs):
+    refresh_pairs(appointment_pairs(instance, created))
+
+
+@receiver(post_delete, sender=Appointment)
+def update_care_team_on_delete(sender, instance, **kwargs):
+    refresh_pairs({(instance.doctor_id, instance.patient_id)})
+
+
+@receiver(appointments_bulk_created)
+def update_care_team_on_bulk_create(sender, appointments, **kwargs):
+    refresh_pairs({(appointment.doctor_id, appointment.patient_id) for appointment in appointments})
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+def invalidate_directory_on_doctor_change(sender, **kwargs):
+    directory.invalidate()
+
+
+@receiver(post_save, sender=User)
+def invalidate_directory_on_user_change(sender, instance, **kwargs):
+    # names and is_active of doctors are part of the directory entries
+    if instance.role == 'doctor':
+        directory.invalidate()
+
+
+@receiver(post_save, sender=Medication)
+def sync_catalogue_on_medication_save(sender, **kwargs):
+    catalogue.expire()
+
+
+@receiver(post_delete, sender=Medication)
+def reload_catalogue_on_medication_delete(sender, **kwargs):
+    catalogue.invalidate()
+
+
+@receiver(post_save, sender=DrugInteraction)
+@receiver(post_delete, sender=DrugInteraction)
+def invalidate_interactions_on_change(sender, **kwargs):
+    interactions.invalidate()
@@ -0,0 +1,116 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from patients.models import Appointment
+from .models import DoctorDaySchedule
+
+
+def slot_minutes(doctor):
+    return doctor.slot_minutes or settings.APPOINTMENT_SLOT_MINUTES
+
+
+def day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def to_local(value):
+    if timezone.is_naive(value):
+        return value
+    return timezone.localtime(value)
+
+
+def minute_of_day(value):
+    local = to_local(value)
+    return local.hour * 60 + local.minute
+
+
+def appointment_day(scheduled_at):
+    return to_local(scheduled_at).date()
+
+
+def refresh_day(doctor_id, day):
+    """Rebuild the booked intervals of a single doctor-day from its appointments."""
+    refresh_days(doctor_id, [day])
+
+
+def refresh_days(doctor_id, days):
+    """Rebuild the booked intervals of several days of one doctor with a single read and a single upsert."""
+    days = set(days)
+    if not days:
+        return
+    day_filter = Q()
+    for day in days:
+        start, end = day_bounds(day)
+        day_filter |= Q(scheduled_at__gte=start, scheduled_at__lt=end)
+    intervals = Appointment.objects.filter(day_filter, doctor_id=doctor_id).values_list('scheduled_at', 'duration_minutes', 'prescription_given')
+
+    booked = defaultdict(list)
+    completed = defaultdict(int)
+    for scheduled_at, duration, prescription_given in intervals:
+        day = appointment_day(scheduled_at)
+        start = minute_of_day(scheduled_at)
+        booked[day].append([start, start + duration])
+        completed[day] += prescription_given
+
+    if booked:
+        DoctorDaySchedule.objects.bulk_create(
+            [
+                DoctorDaySchedule(doctor_id=doctor_id, date=day, booked_slots=sorted(slots), booked_count=len(slots), completed_count=completed[day])
+                for day, slots in booked.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['doctor', 'date'],
+            update_fields=['booked_slots', 'booked_count', 'completed_count', 'updated_at'],
+        )
+    empty_days = days - booked.keys()
+    if empty_days:
+        DoctorDaySchedule.objects.filter(doctor_id=doctor_id, date__in=empty_days).delete()
+
+
+def date_range(start_date, end_date):
+    day = start_date
+    while day <= end_date:
+        yield day
+        day += timedelta(days=1)
+
+
+def open_slots(doctor, day, booked, now):
+    """Slots of the doctor's availability window on `day` that are after `now` and clear of `booked` intervals."""
+    if not doctor.available_from or not doctor.available_to or doctor.available_from >= doctor.available_to:
+        return []
+
+    length = slot_minutes(doctor)
+    # the first slot starts on the first reservation block boundary at or after opening, as bookings must
+    step = settings.APPOINTMENT_GRANULARITY_MINUTES
+    opens = doctor.available_from
+    open_at = opens.hour * 60 + opens.minute + bool(opens.second or opens.microsecond)
+    open_at = -(-open_at // step) * step
+    close_at = doctor.available_to.hour * 60 + doctor.available_to.minute
+    day_start, _ = day_bounds(day)
+
+    slots = []
+    for minute in range(open_at, close_at - length + 1, length):
+        # booked intervals are sorted by start, so stop scanning once they begin after this slot
+        taken = False
+        for booked_start, booked_end in booked:
+            if booked_start >= minute + length:
+                break
+            if booked_end > minute:
+                taken = True
+                break
+        slot_time = day_start + timedelta(minutes=minute)
+        if not taken and slot_time > now:
+            slots.append(slot_time)
+    return slots
+
+
+def free_slots(doctor, start_date, end_date):
+    """Return {date: [aware datetimes]} of open slots between start_date and end_date (inclusive)."""
+    booked_by_day = dict(
+        DoctorDaySchedule.objects.filter(doctor=doctor, date__range=(start_date, end_date)).values_list('date', 'booked_slots')
+    )
+    now = timezone.now()
+    return {day: open_slots(doctor, day, booked_by_day.get(day, []), now) for day in date_range(start_date, end_date)}
@@ -1,3 +1,206 @@
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from core.factories import QueryBudgetChecks, client_for, seed
+from patients import search
+from patients.models import Appointment, MedicalHistory, Patient
+from .catalogue import catalogue
+from .models import CareTeamMember, DrugInteraction, Medication, Prescription
+from .serializers import DoctorSerializer
 
-# Create your tests here.
+
+class DoctorQueryBudgetTests(QueryBudgetChecks, TestCase):
+    """The doctor-facing listings stay within their query budgets, also as the tables grow."""
+
+    def endpoints(self):
+        patient, doctor, admin = self.patient.user, self.doctor.user, self.admin.user
+        prescription = Prescription.objects.filter(patient=self.patient).first()
+        history = MedicalHistory.objects.filter(patient=self.patient).first()
+        return [
+            (patient, '/api/patients/prescriptions/'),
+            (patient, f'/api/patients/prescriptions/{prescription.id}/'),
+            (doctor, reverse('doctor-schedule')),
+            (doctor, reverse('doctor-calendar')),
+            (doctor, reverse('view-patients-list')),
+            (doctor, reverse('medical-history-list')),
+            (doctor, reverse('medical-history-detail', args=[history.id])),
+            (doctor, reverse('prescription-list')),
+            (doctor, reverse('prescription-list') + '?medication=paracetamol'),
+            (doctor, reverse('logged-doctor')),
+            (doctor, reverse('medication-autocomplete') + '?q=paracetmol'),
+            (admin, reverse('doctor-calendar') + f'?doctor_ids={",".join(str(d.id) for d in self.doctors)}&view=month'),
+        ]
+
+
+class PrescriptionMedicationTests(TestCase):
+    """Medications are stored as line items, served without re-parsing and filterable by name."""
+
+    def test_line_items_round_trip_and_filter(self):
+        doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=2)[0]
+        appointment = Appointment.objects.filter(doctor=doctor, prescription__isnull=True).first()
+        client = client_for(doctor.user)
+        medications = [{'name': ' Amoxicillin ', 'dosage': '250mg', 'frequency': 'twice a day'}, {'name': 'Ibuprofen', 'dosage': '200mg'}]
+        response = client.post(reverse('prescription-list'), {'appointment': appointment.id, 'diagnosis': 'Otitis', 'medications': medications}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+
+        prescription = Prescription.objects.get(id=response.data['id'])
+        self.assertEqual(list(prescription.items.values_list('position', 'name_key')), [(0, 'amoxicillin'), (1, 'ibuprofen')])
+        self.assertEqual(prescription.medication_list[0], {'name': 'Amoxicillin', 'dosage': '250mg', 'frequency': 'twice a day'})
+        self.assertEqual(MedicalHistory.objects.get(patient=appointment.patient, diagnosis='Otitis').medications, 'Amoxicillin 250mg, Ibuprofen 200mg')
+
+        listed = client.get(reverse('prescription-list'), {'medication': 'AMOXICILLIN'}).data['results']
+        self.assertEqual([row['id'] for row in listed], [prescription.id])
+        self.assertEqual(listed[0]['medications_details'][1]['name'], 'Ibuprofen')
+        self.assertEqual([hit['id'] for hit in search.get_backend().search('amoxicillin', search.Scope(), kinds=(search.PRESCRIPTION,))], [prescription.id])
+
+    def test_new_prescription_is_indexed_once(self):
+        doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=2)[0]
+        appointment = Appointment.objects.filter(doctor=doctor, prescription__isnull=True).first()
+        with mock.patch('patients.search.index_prescription', wraps=search.index_prescription) as index:
+            response = client_for(doctor.user).post(reverse('prescription-list'), {
+                'appointment': appointment.id, 'diagnosis': 'Otitis', 'medications': [{'name': 'Amoxicillin', 'dosage': '250mg'}],
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(index.call_count, 1)
+        self.assertEqual([hit['id'] for hit in search.get_backend().search('otitis amoxicillin', search.Scope(), kinds=(search.PRESCRIPTION,))], [response.data['id']])
+
+
+class DoctorSlotMinutesTests(TestCase):
+    """A doctor's slot length has to be a whole number of reservation blocks, or its listed slots could not be booked."""
+
+    def test_slot_minutes_is_a_block_multiple(self):
+        doctor = seed(doctors=1, patients_per_doctor=0)[0]
+        for minutes, valid in ((12, False), (0, False), (300, False), (15, True), (None, True)):
+            with self.subTest(minutes=minutes):
+                self.assertEqual(DoctorSerializer(doctor, data={'slot_minutes': minutes}, partial=True).is_valid(), valid)
+                doctor.slot_minutes = minutes
+                if valid:
+                    doctor.full_clean()
+                else:
+                    with self.assertRaises(ValidationError):
+                        doctor.full_clean()
+
+
+class MedicationCatalogueTests(TestCase):
+    """The formulary loads idempotently and autocomplete answers prefixes and typos from memory."""
+
+    def load(self, rows, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('name,generic_name,form,strength\n' + ''.join(f'{row}\n' for row in rows))
+        self.addCleanup(os.unlink, f.name)
+        out = StringIO()
+        call_command('load_formulary', f.name, *args, stdout=out)
+        return out.getvalue()
+
+    def test_load_autocomplete_and_canonical_names(self):
+        catalogue.invalidate()
+        formulary = ['Paracetamol,paracetamol,tablet,500 mg', 'Amoxicillin Clavulanate,amoxicillin,tablet,625 mg', 'Pantoprazole,,tablet,40 mg']
+        self.assertIn('3 added', self.load(formulary))
+        self.assertIn('3 unchanged', self.load(formulary))
+
+        doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=2)[0]
+        client = client_for(doctor.user)
+
+        def names(q):
+            response = client.get(reverse('medication-autocomplete'), {'q': q})
+            self.assertEqual(response.status_code, 200)
+            return [(row['name'], row['match']) for row in response.data['results']]
+
+        self.assertEqual(names('pa'), [('Pantoprazole', 'prefix'), ('Paracetamol', 'prefix')])
+        self.assertEqual(names('clav'), [('Amoxicillin Clavulanate', 'prefix')])
+        self.assertEqual(names('paracetmol'), [('Paracetamol', 'fuzzy')])
+        self.assertEqual(names('pracetamol'), [('Paracetamol', 'fuzzy')])
+        self.assertEqual(client.get(reverse('medication-autocomplete'), {'q': 'pa', 'limit': 0}).status_code, 400)
+
+        # a worker sees saved rows on its next sync, and retired ones drop out
+        Medication.objects.create(name='Paroxetine', name_key='paroxetine')
+        self.assertEqual(names('parox'), [('Paroxetine', 'prefix')])
+        self.assertIn('2 retired', self.load(formulary[:2], '--retire-missing'))
+        catalogue.expire()
+        self.assertEqual(names('pant'), [])
+
+        appointment = Appointment.objects.filter(doctor=doctor, prescription__isnull=True).first()
+        medications = [{'name': 'paracetamol ', 'dosage': '1 tablet'}, {'name': 'Home remedy', 'dosage': 'as needed'}]
+        response = client.post(reverse('prescription-list'), {'appointment': appointment.id, 'medications': medications}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual([row['name'] for row in response.data['medications']], ['Paracetamol', 'Home remedy'])
+
+
+class PrescriptionSafetyTests(TestCase):
+    """New prescriptions come back with warnings for recorded allergies and known interactions."""
+
+    def test_allergy_and_interaction_warnings(self):
+        catalogue.invalidate()
+        Medication.objects.create(name='Augmentin', name_key='augmentin', generic_name='Amoxicillin Clavulanate')
+        DrugInteraction.objects.create(drug_a='Warfarin', drug_b='Ibuprofen', severity=DrugInteraction.MAJOR, description='Bleeding risk')
+        DrugInteraction.objects.create(drug_a='methotrexate', drug_b='amoxicillin clavulanate', severity=DrugInteraction.MODERATE)
+
+        doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=4)[0]
+        patient = Patient.objects.filter(appointment__doctor=doctor).first()
+        MedicalHistory.objects.create(patient=patient, diagnosis='Rash', medications='', allergies='Allergic to amoxicillin; dust', recorded_by=doctor)
+        MedicalHistory.objects.create(patient=patient, diagnosis='Cold', medications='', allergies='None', recorded_by=doctor)
+        self.assertEqual(set(patient.allergies.values_list('allergen', flat=True)), {'amoxicillin', 'dust'})
+
+        client = client_for(doctor.user)
+        first, second = Appointment.objects.filter(doctor=doctor, prescription__isnull=True)[:2]
+        response = client.post(reverse('prescription-list'), {'appointment': first.id, 'medications': [{'name': 'Warfarin', 'dosage': '5mg'}]}, format='json')
+        self.assertEqual(response.data['warnings'], [])
+
+        medications = [{'name': 'Augmentin', 'dosage': '625mg'}, {'name': 'Ibuprofen', 'dosage': '400mg'}, {'name': 'Methotrexate', 'dosage': '7.5mg'}]
+        response = client.post(reverse('prescription-list'), {'appointment': second.id, 'medications': medications}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual([(warning['type'], warning['severity'], warning['medications']) for warning in response.data['warnings']], [
+            ('allergy', 'major', ['Augmentin']),
+            ('interaction', 'major', ['Ibuprofen', 'Warfarin']),
+            ('interaction', 'moderate', ['Augmentin', 'Methotrexate']),
+        ])
+        self.assertTrue(response.data['warnings'][1]['recent'])
+
+        MedicalHistory.objects.filter(patient=patient, diagnosis='Rash').delete()
+        self.assertFalse(patient.allergies.exists())
+
+
+class CareTeamTests(TestCase):
+    """The care-team table follows appointments as they are booked, moved and removed."""
+
+    def test_pairs_follow_appointments(self):
+        first, second = seed(doctors=2, patients_per_doctor=1, appointments_per_patient=1)
+        patient = Patient.objects.get(appointment__doctor=first)
+        self.assertEqual(set(CareTeamMember.objects.values_list('doctor_id', 'patient_id', 'appointment_count')), {
+            (first.id, patient.id, 1), (second.id, Patient.objects.get(appointment__doctor=second).id, 1),
+        })
+
+        appointment = Appointment.objects.create(patient=patient, doctor=first, scheduled_at=timezone.now() + timedelta(days=2))
+        self.assertEqual(CareTeamMember.objects.get(doctor=first, patient=patient).appointment_count, 2)
+
+        appointment = Appointment.objects.get(id=appointment.id)
+        appointment.doctor = second
+        appointment.save()
+        self.assertEqual(CareTeamMember.objects.get(doctor=first, patient=patient).appointment_count, 1)
+        self.assertEqual(CareTeamMember.objects.get(doctor=second, patient=patient).appointment_count, 1)
+
+        appointment.delete()
+        self.assertFalse(CareTeamMember.objects.filter(doctor=second, patient=patient).exists())
+
+
+class DoctorCalendarTests(TestCase):
+    """The calendar reads its day counts from the rollups and validates the requested date."""
+
+    def test_counts_and_invalid_dates(self):
+        doctor = seed(doctors=1, patients_per_doctor=2, appointments_per_patient=2)[0]
+        client = client_for(doctor.user)
+        appointment = Appointment.objects.filter(doctor=doctor).first()
+        day = timezone.localtime(appointment.scheduled_at).date()
+        response = client.get(reverse('doctor-calendar'), {'date': str(day), 'view': 'day'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['doctors'][0]['days'][0]['booked'], Appointment.objects.filter(doctor=doctor, scheduled_at__date=day).count())
+        for date in ('2024-02-30', 'tomorrow'):
+            with self.subTest(date=date):
+                self.assertEqual(client.get(reverse('doctor-calendar'), {'date': date}).status_code, 400)
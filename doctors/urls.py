@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DoctorRegistrationView, DoctorPatientViewSet, MedicalHistoryViewSet, PrescriptionViewSet, get_logged_in_doctor, schedule
+from .views import DoctorRegistrationView, DoctorPatientViewSet, MedicalHistoryViewSet, PrescriptionViewSet, calendar, get_logged_in_doctor, medication_autocomplete, schedule
+from patients.views import search_records
 
 
 router = DefaultRouter()
@@ -12,6 +13,9 @@ router.register(r'prescription', PrescriptionViewSet, basename='prescription')
 urlpatterns = [
     path('register/', DoctorRegistrationView.as_view(), name='register-doctor'),
     path('appointments/', schedule, name='doctor-schedule'),
+    path('calendar/', calendar, name='doctor-calendar'),
+    path('search/', search_records, name='doctor-search-records'),
+    path('medications/', medication_autocomplete, name='medication-autocomplete'),
     path('me/', get_logged_in_doctor, name='logged-doctor'),
 ]
 
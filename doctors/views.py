@@ -1,4 +1,7 @@
+from collections import defaultdict
+from datetime import timedelta
 from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from django.utils.dateparse import parse_date
 from rest_framework.exceptions import PermissionDenied
@@ -8,13 +11,22 @@ from rest_framework import serializers
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from .models import Doctor, Prescription
+from core.pagination import StableCursorPagination
+from core.principal import get_principal
+from core.querybudget import query_budget
+from . import interactions, medications
+from .catalogue import catalogue
+from .models import Doctor, DoctorDaySchedule, Prescription
+from .slots import appointment_day, date_range, day_bounds, open_slots
 from patients.models import Appointment, MedicalHistory, Patient
 from patients.serializers import MedicalHistorySerializer, PatientSerializer
 from patients.permissions import IsDoctorOrReadOnlyForPatients
 from .serializers import AppointmentSerializer, DoctorRegistrationSerializer, DoctorSerializer, PrescriptionSerializer
 # Create your views here.
 
+MAX_CALENDAR_DOCTORS = 100
+MAX_AUTOCOMPLETE_RESULTS = 50
+
 
 class DoctorRegistrationView(CreateAPIView):
     queryset = Doctor.objects.all()
@@ -25,14 +37,14 @@ class MedicalHistoryViewSet(ModelViewSet):
     queryset = MedicalHistory.objects.all()
     permission_classes = [IsAuthenticated, IsDoctorOrReadOnlyForPatients]
     serializer_class = MedicalHistorySerializer
+    query_budget = {'list': 1, 'retrieve': 1, 'patient_history': 2}
 
     def get_queryset(self):
-        user = self.request.user
-        if hasattr(user, 'doctor'):
-            patient_ids = Appointment.objects.filter(doctor__user=user).values_list('patient', flat=True).distinct()
-            return MedicalHistory.objects.filter(patient__id__in=patient_ids)
-        elif hasattr(user, 'patient'):
-            return MedicalHistory.objects.filter(patient__user=user)
+        principal = get_principal(self.request)
+        if principal.doctor_id is not None:
+            return MedicalHistory.objects.filter(patient__care_team__doctor_id=principal.doctor_id)
+        elif principal.patient_id is not None:
+            return MedicalHistory.objects.filter(patient_id=principal.patient_id)
         return MedicalHistory.objects.none()
 
     @action(detail=True, methods=['get'], url_path='patient-history')
@@ -43,14 +55,15 @@ class MedicalHistoryViewSet(ModelViewSet):
             return Response({'message': 'Patient not found'})
         
         histories = MedicalHistory.objects.filter(patient=patient)
-        serializer = self.get_serializer(histories, many=True)
-        return Response(serializer.data)
+        page = self.paginate_queryset(histories)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     def perform_create(self, serializer):
-        user = self.request.user
-        if hasattr(user, 'doctor') and 'patient_id' in self.request.data:
+        principal = get_principal(self.request)
+        if principal.doctor_id is not None and 'patient_id' in self.request.data:
             patient = Patient.objects.get(id=self.request.data['patient_id'])
-            serializer.save(recorded_by=user.doctor, patient=patient)
+            serializer.save(recorded_by_id=principal.doctor_id, patient=patient)
         else:
             return serializers.ValidationError('Only doctors can add medical history, and patient_id is required')
 
@@ -58,69 +71,185 @@ class MedicalHistoryViewSet(ModelViewSet):
 class DoctorPatientViewSet(ReadOnlyModelViewSet):
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {'list': 1, 'retrieve': 1}
 
     def get_queryset(self):
-        user = self.request.user
-        if user.role == 'doctor':
-            patient_ids = Appointment.objects.filter(doctor__user=user).values_list('patient', flat=True).distinct()
-            return Patient.objects.filter(id__in=patient_ids)
+        principal = get_principal(self.request)
+        if principal.role == 'doctor':
+            return Patient.objects.select_related('user').filter(care_team__doctor__user_id=principal.user_id)
         raise PermissionDenied("Only doctors can view patients.")
 
 
+# one query for the page, and one more when ?with_count=1 misses the cached count
+@query_budget(2)
 @api_view(['GET'])
 def schedule(request):
-    if request.user.role == 'doctor' and request.user.is_authenticated:
-        appointments = Appointment.objects.select_related('patient__user').filter(doctor__user=request.user)
+    principal = get_principal(request)
+    if principal.role == 'doctor':
+        appointments = Appointment.objects.select_related('patient__user', 'doctor__user').filter(doctor__user_id=principal.user_id).order_by('scheduled_at')
         date_str = request.GET.get('date')
         if date_str:
             filter_date = parse_date(date_str)
             if filter_date:
                 appointments = appointments.filter(scheduled_at__date=filter_date)
                 
-        serializer = AppointmentSerializer(appointments, many=True)
-        return Response(serializer.data)
+        paginator = StableCursorPagination()
+        page = paginator.paginate_queryset(appointments, request)
+        serializer = AppointmentSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
     return Response({'error': 'Unauthorized'}, status=status.HTTP_401_UNAUTHORIZED)
 
 
+@query_budget(3)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def calendar(request):
+    """
+    A day, week or month (`view`) of appointments around `date`, with per-day booked, completed and
+    free-slot counts read from the DoctorDaySchedule rollups. Admins pick doctors with `doctor_ids`
+    (comma separated); doctors always get their own calendar. `summary=1` leaves out the appointments.
+    """
+    principal = get_principal(request)
+    if principal.role not in ('doctor', 'admin'):
+        return Response({'error': 'Only doctors and admins can view calendars'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        anchor = parse_date(request.GET['date']) if request.GET.get('date') else timezone.localdate()
+    except ValueError:
+        anchor = None
+    if not anchor:
+        return Response({'message': 'date should be in YYYY-MM-DD format'}, status=status.HTTP_400_BAD_REQUEST)
+
+    view = request.GET.get('view', 'week')
+    if view == 'day':
+        start = end = anchor
+    elif view == 'week':
+        start = anchor - timedelta(days=anchor.weekday())
+        end = start + timedelta(days=6)
+    elif view == 'month':
+        start = anchor.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        return Response({'message': 'view should be day, week or month'}, status=status.HTTP_400_BAD_REQUEST)
+
+    doctors = Doctor.objects.select_related('user')
+    if principal.role == 'doctor':
+        doctors = doctors.filter(user_id=principal.user_id)
+    else:
+        try:
+            doctor_ids = [int(i) for i in request.GET.get('doctor_ids', '').split(',') if i]
+        except ValueError:
+            return Response({'message': 'doctor_ids should be comma separated ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if not doctor_ids or len(doctor_ids) > MAX_CALENDAR_DOCTORS:
+            return Response({'message': f'doctor_ids should list between 1 and {MAX_CALENDAR_DOCTORS} doctors'}, status=status.HTTP_400_BAD_REQUEST)
+        doctors = doctors.filter(id__in=doctor_ids)
+    doctors = list(doctors)
+
+    rollups = {
+        (row.doctor_id, row.date): row
+        for row in DoctorDaySchedule.objects.filter(doctor__in=doctors, date__range=(start, end)).only('doctor_id', 'date', 'booked_slots', 'booked_count', 'completed_count')
+    }
+
+    appointments = defaultdict(list)
+    if request.GET.get('summary') not in ('1', 'true'):
+        range_start, _ = day_bounds(start)
+        _, range_end = day_bounds(end)
+        queryset = Appointment.objects.select_related('patient__user', 'doctor__user').filter(
+            doctor__in=doctors, scheduled_at__gte=range_start, scheduled_at__lt=range_end
+        ).order_by('scheduled_at')
+        for appointment, data in zip(queryset, AppointmentSerializer(queryset, many=True).data):
+            appointments[(appointment.doctor_id, appointment_day(appointment.scheduled_at))].append(data)
+
+    now = timezone.now()
+    result = []
+    for doctor in doctors:
+        days = []
+        for day in date_range(start, end):
+            rollup = rollups.get((doctor.id, day))
+            day_data = {
+                'date': day,
+                'booked': rollup.booked_count if rollup else 0,
+                'completed': rollup.completed_count if rollup else 0,
+                'free_slots': len(open_slots(doctor, day, rollup.booked_slots if rollup else [], now)),
+            }
+            if request.GET.get('summary') not in ('1', 'true'):
+                day_data['appointments'] = appointments.get((doctor.id, day), [])
+            days.append(day_data)
+        result.append({'doctor_id': doctor.id, 'doctor_name': doctor.user.get_full_name(), 'days': days})
+
+    return Response({'start': start, 'end': end, 'view': view, 'doctors': result})
+
+
 class PrescriptionViewSet(ModelViewSet):
-    queryset = Prescription.objects.all()
+    queryset = Prescription.objects.select_related('doctor__user', 'patient__user').prefetch_related('items')
     serializer_class = PrescriptionSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {'list': 2, 'retrieve': 2}
     
     def get_queryset(self):
-        user = self.request.user
-        if hasattr(user, 'doctor'):
-            return Prescription.objects.filter(doctor__user=user)
-        elif hasattr(user, 'patient'):
-            return Prescription.objects.filter(patient__user=user)
+        principal = get_principal(self.request)
+        if principal.doctor_id is not None:
+            queryset = self.queryset.filter(doctor_id=principal.doctor_id)
+        elif principal.patient_id is not None:
+            queryset = self.queryset.filter(patient_id=principal.patient_id)
         else:
             raise PermissionDenied('Only doctors and patients can view prescriptions')
+        # ?medication=<name> keeps prescriptions containing that medication
+        if self.request.query_params.get('medication'):
+            queryset = medications.containing(queryset, self.request.query_params['medication'])
+        return queryset
         
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.data['warnings'] = self.warnings
+        return response
+
     def perform_create(self, serializer):
-        user = self.request.user
-        if user.role == 'doctor':
+        principal = get_principal(self.request)
+        if principal.role == 'doctor':
             appointment_id = self.request.data.get('appointment')
             appointment = get_object_or_404(Appointment, id=appointment_id)
-            if appointment.doctor != user.doctor:
+            if appointment.doctor_id != principal.doctor_id:
                 raise PermissionDenied('You are not assigned to this appointment')
-            prescription = serializer.save(doctor=user.doctor, appointment=appointment, patient=appointment.patient, diagnosis=self.request.data.get('diagnosis', 'Not specified'))
+            # allergy and interaction warnings are returned with the prescription; they do not block it
+            self.warnings = interactions.check(appointment.patient_id, serializer.validated_data['medication_list'])
+            prescription = serializer.save(doctor_id=principal.doctor_id, appointment=appointment, patient=appointment.patient, diagnosis=self.request.data.get('diagnosis', 'Not specified'))
             appointment.prescription_given = True
             appointment.status = True
             appointment.save()
             
             # creating medical history for the patient along with the creation of a presciption
             MedicalHistory.objects.create(
-                patient=appointment.patient, diagnosis=prescription.diagnosis, medications=prescription.medications, recorded_by=user.doctor, allergies='Not specified'
+                patient=appointment.patient, diagnosis=prescription.diagnosis, medications=medications.as_text(prescription.medication_list), recorded_by_id=principal.doctor_id, allergies='Not specified'
             )
             
         else:
             raise PermissionDenied('Only doctors can create Prescriptions')
 
+@query_budget(0)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def medication_autocomplete(request):
+    """
+    Catalogue medications for what has been typed into `q`: prefix matches on brand and generic
+    names, then matches one typo away (`match` is 'prefix' or 'fuzzy'). Answered from the
+    in-process catalogue (doctors.catalogue); `limit` defaults to 10.
+    """
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_AUTOCOMPLETE_RESULTS:
+        return Response({'message': f'limit should be a number from 1 to {MAX_AUTOCOMPLETE_RESULTS}'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'results': catalogue.search(request.GET.get('q', ''), limit)})
+
+
+@query_budget(1)
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_logged_in_doctor(request):
     try:
-        doctor = Doctor.objects.get(user=request.user)
+        doctor = Doctor.objects.select_related('user').get(user_id=get_principal(request).user_id)
     except Doctor.DoesNotExist:
         return Response({'error': 'Patient not found'}, status=404) 
     
@@ -0,0 +1,52 @@
+import re
+from django.db import transaction
+from doctors.medications import normalize
+
+# what doctors write when there is nothing to record
+NO_ALLERGIES = {
+    '', '-', 'na', 'n/a', 'nil', 'no', 'none', 'none known', 'not specified', 'not known', 'unknown',
+    'nka', 'nkda', 'no known allergies', 'no known allergy', 'no known drug allergies',
+}
+SEPARATORS = re.compile(r'[,;\n]|\band\b')
+PREFIXES = re.compile(r'^(?:allergic to|allergy to|allergies to|allergy:|allergies:)\s*')
+
+
+def allergens(text):
+    """The normalized allergens named in a free-text MedicalHistory.allergies value."""
+    found = set()
+    for part in SEPARATORS.split(text or ''):
+        allergen = PREFIXES.sub('', normalize(part)).strip(' .')[:200]
+        if allergen not in NO_ALLERGIES:
+            found.add(allergen)
+    return found
+
+
+def refresh_patient(patient_id):
+    """Recompute a patient's PatientAllergy rows from their whole medical history."""
+    from .models import MedicalHistory, PatientAllergy
+
+    current = set()
+    for text in MedicalHistory.objects.filter(patient_id=patient_id).values_list('allergies', flat=True).distinct():
+        current |= allergens(text)
+    with transaction.atomic():
+        stored = set(PatientAllergy.objects.filter(patient_id=patient_id).values_list('allergen', flat=True))
+        if stored - current:
+            PatientAllergy.objects.filter(patient_id=patient_id, allergen__in=stored - current).delete()
+        PatientAllergy.objects.bulk_create(
+            [PatientAllergy(patient_id=patient_id, allergen=allergen) for allergen in current - stored], ignore_conflicts=True,
+        )
+
+
+def add_allergies(patient_id, text):
+    """Record the allergens of one new history entry; adding never needs the rest of the history."""
+    from .models import PatientAllergy
+
+    PatientAllergy.objects.bulk_create(
+        [PatientAllergy(patient_id=patient_id, allergen=allergen) for allergen in allergens(text)], ignore_conflicts=True,
+    )
+
+
+def patient_allergens(patient_id):
+    from .models import PatientAllergy
+
+    return set(PatientAllergy.objects.filter(patient_id=patient_id).values_list('allergen', flat=True))
@@ -0,0 +1,213 @@
+from datetime import timedelta
+from django.conf import settings
+from functools import reduce
+from operator import or_
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from doctors.slots import slot_minutes
+from .models import Appointment, AppointmentSlot
+from .signals import appointments_bulk_created
+
+
+# What happened to each requested occurrence of a series
+BOOKED = 'booked'
+CONFLICT = 'conflict'
+DUPLICATE = 'duplicate'
+
+# How often a series is inserted again after losing reservations to concurrent bookings
+SERIES_INSERT_ATTEMPTS = 3
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+class InvalidDuration(Exception):
+    pass
+
+
+class InvalidStart(Exception):
+    pass
+
+
+def make_aware(value):
+    if timezone.is_naive(value):
+        return timezone.make_aware(value)
+    return value
+
+
+def resolve_start(scheduled_at):
+    """
+    The aware start time, which has to fall on a reservation block boundary: an unaligned start would
+    reserve the block its end runs into and block a back-to-back booking there.
+    """
+    scheduled_at = make_aware(scheduled_at)
+    step = settings.APPOINTMENT_GRANULARITY_MINUTES
+    if scheduled_at.second or scheduled_at.microsecond or scheduled_at.minute % step:
+        raise InvalidStart(f'Appointments should start on a multiple of {step} minutes past the hour')
+    return scheduled_at
+
+
+def resolve_duration(doctor, duration_minutes=None):
+    if duration_minutes in (None, ''):
+        return slot_minutes(doctor)
+    try:
+        duration_minutes = int(duration_minutes)
+    except (TypeError, ValueError):
+        raise InvalidDuration('duration_minutes should be a whole number of minutes')
+    if not settings.APPOINTMENT_GRANULARITY_MINUTES <= duration_minutes <= settings.APPOINTMENT_MAX_MINUTES:
+        raise InvalidDuration(
+            f'duration_minutes should be between {settings.APPOINTMENT_GRANULARITY_MINUTES} and {settings.APPOINTMENT_MAX_MINUTES}'
+        )
+    return duration_minutes
+
+
+def slot_blocks(start, end):
+    """Reservation blocks covering [start, end), aligned to APPOINTMENT_GRANULARITY_MINUTES."""
+    step = settings.APPOINTMENT_GRANULARITY_MINUTES
+    block = start.replace(second=0, microsecond=0)
+    block -= timedelta(minutes=block.minute % step)
+    while block < end:
+        yield block
+        block += timedelta(minutes=step)
+
+
+def reservations_for(appointment):
+    return [
+        AppointmentSlot(appointment=appointment, doctor_id=appointment.doctor_id, slot_start=block)
+        for block in slot_blocks(appointment.scheduled_at, appointment.ends_at)
+    ]
+
+
+def reserve_slots(appointment):
+    AppointmentSlot.objects.bulk_create(reservations_for(appointment))
+
+
+def _overlap_q(start, end):
+    return Q(scheduled_at__gt=start - timedelta(minutes=settings.APPOINTMENT_MAX_MINUTES), scheduled_at__lt=end, ends_at__gt=start)
+
+
+def overlapping(doctor_id, start, end, exclude_appointment=None):
+    """
+    Appointments of the doctor that intersect [start, end). Appointments last at most
+    APPOINTMENT_MAX_MINUTES, so the lookup is a bounded range scan on the (doctor, scheduled_at) index.
+    """
+    appointments = Appointment.objects.filter(_overlap_q(start, end), doctor_id=doctor_id)
+    if exclude_appointment is not None:
+        appointments = appointments.exclude(id=exclude_appointment.id)
+    return appointments
+
+
+def book_appointment(patient, doctor, scheduled_at, duration_minutes=None):
+    """Create an appointment, relying on the slot reservation constraint to reject overlapping bookings."""
+    scheduled_at = resolve_start(scheduled_at)
+    duration_minutes = resolve_duration(doctor, duration_minutes)
+    ends_at = scheduled_at + timedelta(minutes=duration_minutes)
+
+    # Cheap early exit for visible overlaps; the constraint still decides concurrent races
+    if overlapping(doctor.id, scheduled_at, ends_at).exists():
+        raise SlotUnavailable()
+    try:
+        with transaction.atomic():
+            appointment = Appointment.objects.create(patient=patient, doctor=doctor, scheduled_at=scheduled_at, duration_minutes=duration_minutes)
+            reserve_slots(appointment)
+    except IntegrityError:
+        raise SlotUnavailable()
+    return appointment
+
+
+def reschedule_appointment(appointment, scheduled_at, duration_minutes=None):
+    scheduled_at = make_aware(scheduled_at)
+    if scheduled_at != appointment.scheduled_at:
+        scheduled_at = resolve_start(scheduled_at)
+    if duration_minutes in (None, ''):
+        duration_minutes = appointment.duration_minutes
+    else:
+        duration_minutes = resolve_duration(appointment.doctor, duration_minutes)
+    ends_at = scheduled_at + timedelta(minutes=duration_minutes)
+
+    if overlapping(appointment.doctor_id, scheduled_at, ends_at, exclude_appointment=appointment).exists():
+        raise SlotUnavailable()
+
+    previous = appointment.scheduled_at, appointment.duration_minutes, appointment.ends_at
+    loaded = getattr(appointment, '_loaded_values', None)
+    try:
+        with transaction.atomic():
+            AppointmentSlot.objects.filter(appointment=appointment).delete()
+            appointment.scheduled_at = scheduled_at
+            appointment.duration_minutes = duration_minutes
+            appointment.save()
+            reserve_slots(appointment)
+    except IntegrityError:
+        appointment.scheduled_at, appointment.duration_minutes, appointment.ends_at = previous
+        appointment._loaded_values = loaded
+        raise SlotUnavailable()
+    return appointment
+
+
+def _insert_series(patient, doctor, intervals, duration_minutes):
+    if not intervals:
+        return []
+    appointments = [
+        Appointment(patient=patient, doctor=doctor, scheduled_at=start, duration_minutes=duration_minutes, ends_at=end)
+        for start, end in intervals
+    ]
+    with transaction.atomic():
+        created = Appointment.objects.bulk_create(appointments)
+        AppointmentSlot.objects.bulk_create([slot for appointment in created for slot in reservations_for(appointment)])
+        appointments_bulk_created.send(sender=Appointment, appointments=created)
+    return created
+
+
+def book_series(patient, doctor, times, duration_minutes=None):
+    """
+    Book several appointments with one doctor in a single pass. Every occurrence is checked against
+    the doctor's existing appointments with one query and against the rest of the series in memory;
+    the free ones are inserted together. If concurrent bookings took some of their blocks meanwhile,
+    those occurrences are found with one query and the rest inserted together again. Returns a
+    (scheduled_at, status, appointment or None) for every requested time in chronological order,
+    where a time asked for again is a DUPLICATE.
+    """
+    duration_minutes = resolve_duration(doctor, duration_minutes)
+    duration = timedelta(minutes=duration_minutes)
+    starts = sorted(resolve_start(t) for t in times)
+    intervals = [(start, start + duration) for start in sorted(set(starts))]
+    if not intervals:
+        return []
+
+    existing = list(
+        Appointment.objects.filter(reduce(or_, (_overlap_q(start, end) for start, end in intervals)), doctor=doctor)
+        .values_list('scheduled_at', 'ends_at')
+    )
+
+    accepted = []
+    for start, end in intervals:
+        taken = existing + accepted
+        if any(other_start < end and other_end > start for other_start, other_end in taken):
+            continue
+        accepted.append((start, end))
+
+    created = []
+    for _ in range(SERIES_INSERT_ATTEMPTS):
+        try:
+            created = _insert_series(patient, doctor, accepted, duration_minutes)
+            break
+        except IntegrityError:
+            # Lost a race for at least one slot: drop the occurrences whose blocks were reserved
+            # meanwhile, found with one query, and insert the rest together again
+            blocks = {start: list(slot_blocks(start, end)) for start, end in accepted}
+            reserved = set(
+                AppointmentSlot.objects.filter(doctor=doctor, slot_start__in=[block for starts in blocks.values() for block in starts])
+                .values_list('slot_start', flat=True)
+            )
+            accepted = [(start, end) for start, end in accepted if reserved.isdisjoint(blocks[start])]
+
+    by_time = {appointment.scheduled_at: appointment for appointment in created}
+    results = []
+    for position, start in enumerate(starts):
+        if position and start == starts[position - 1]:
+            results.append((start, DUPLICATE, None))
+        else:
+            results.append((start, BOOKED if start in by_time else CONFLICT, by_time.get(start)))
+    return results
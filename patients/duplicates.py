@@ -0,0 +1,244 @@
+import re
+import unicodedata
+from collections import defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from core.pagination import invalidate_counts
+
+# how much each field counts towards a match; a field missing on either side is left out of the score
+WEIGHTS = {'name': 0.45, 'date_of_birth': 0.35, 'phone': 0.15, 'email': 0.05}
+FIELDS = {
+    'id': 'id', 'username': 'user__username', 'first_name': 'user__first_name', 'last_name': 'user__last_name',
+    'email': 'user__email', 'date_of_birth': 'date_of_birth', 'phone': 'phone',
+}
+SOUNDEX_CODES = {
+    letter: digit
+    for digit, letters in (('1', 'bfpv'), ('2', 'cgjkqsxz'), ('3', 'dt'), ('4', 'l'), ('5', 'mn'), ('6', 'r'))
+    for letter in letters
+}
+NON_DIGITS = re.compile(r'\D')
+MIN_PHONE_DIGITS = 7
+
+
+@lru_cache(maxsize=65536)
+def _letters(name):
+    """`name` lowercased with accents and everything but the letters a-z dropped."""
+    return ''.join(c for c in unicodedata.normalize('NFKD', (name or '').lower()) if 'a' <= c <= 'z')
+
+
+@lru_cache(maxsize=65536)
+def soundex(name):
+    """American Soundex: names that sound alike (Smith, Smyth) share a four character code."""
+    letters = _letters(name)
+    if not letters:
+        return ''
+    code, last = letters[0].upper(), SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter)
+        if digit and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        # h and w do not separate two letters with the same code; vowels do
+        if letter not in 'hw':
+            last = digit
+    return code.ljust(4, '0')
+
+
+def phone_digits(phone):
+    """The last ten digits of a phone number, so '+1 (555) 010-2030' and '5550102030' agree."""
+    return NON_DIGITS.sub('', phone or '')[-10:]
+
+
+def blocking_keys(record):
+    """
+    The keys a patient record (a dict with the FIELDS names) is filed under. Only records sharing a
+    key are ever compared: the same phone number, the same email, or the same date of birth with a
+    first or last name that sounds the same, which still catches a typo in the other name or the two
+    swapped.
+    """
+    keys = set()
+    phone = phone_digits(record['phone'])
+    if len(phone) >= MIN_PHONE_DIGITS:
+        keys.add(f'phone:{phone}')
+    email = (record['email'] or '').strip().lower()
+    if email:
+        keys.add(f'email:{email}'[:100])
+    if record['date_of_birth']:
+        for name in (record['first_name'], record['last_name']):
+            code = soundex(name)
+            if code:
+                keys.add(f'dob:{record["date_of_birth"].isoformat()}:{code}')
+    return keys
+
+
+def _name_similarity(a, b, needed=0.0):
+    """Similarity of the two full names, in either order; a value below `needed` may be returned as 0."""
+    first_a, last_a, first_b, last_b = (_letters(name) for name in (a['first_name'], a['last_name'], b['first_name'], b['last_name']))
+    if not (first_a or last_a) or not (first_b or last_b):
+        return None
+    if soundex(first_a) == soundex(first_b) and soundex(last_a) == soundex(last_b):
+        needed = max(needed, 0.9)
+        similarity = 0.9
+    else:
+        similarity = 0.0
+    for other in (f'{first_b} {last_b}', f'{last_b} {first_b}'):
+        matcher = SequenceMatcher(None, f'{first_a} {last_a}', other)
+        # the quick ratios are upper bounds of ratio() and far cheaper
+        if matcher.real_quick_ratio() >= needed and matcher.quick_ratio() >= needed:
+            similarity = max(similarity, matcher.ratio())
+    return similarity
+
+
+def _date_similarity(a, b):
+    if not a or not b:
+        return None
+    if a == b:
+        return 1.0
+    if a.year == b.year and (a.day, a.month) == (b.month, b.day):
+        return 0.8
+    # one of day, month and year mistyped
+    return 0.5 if sum((a.year == b.year, a.month == b.month, a.day == b.day)) == 2 else 0.0
+
+
+def _exact(a, b):
+    return None if not a or not b else float(a == b)
+
+
+def score(a, b, at_least=0.0):
+    """
+    How likely two patient records are the same person, from 0 to 1. A pair that cannot reach
+    `at_least` may be scored 0 without comparing the names.
+    """
+    phone_a, phone_b = phone_digits(a['phone']), phone_digits(b['phone'])
+    similarities = {
+        'date_of_birth': _date_similarity(a['date_of_birth'], b['date_of_birth']),
+        'phone': _exact(phone_a if len(phone_a) >= MIN_PHONE_DIGITS else '', phone_b if len(phone_b) >= MIN_PHONE_DIGITS else ''),
+        'email': _exact((a['email'] or '').strip().lower(), (b['email'] or '').strip().lower()),
+    }
+    known = {field: similarity for field, similarity in similarities.items() if similarity is not None}
+    total = sum(WEIGHTS[field] for field in known) + WEIGHTS['name']
+    rest = sum(WEIGHTS[field] * similarity for field, similarity in known.items())
+    # the name similarity the pair needs to reach at_least, once rounded to three places
+    needed = ((at_least - 0.0005) * total - rest) / WEIGHTS['name']
+    if needed > 1:
+        return 0.0
+    name = _name_similarity(a, b, needed)
+    if name is None:
+        return 0.0
+    return round((rest + WEIGHTS['name'] * name) / total, 3)
+
+
+def records(queryset):
+    """The FIELDS of each patient in `queryset`, as dicts."""
+    return (
+        {name: row[lookup] for name, lookup in FIELDS.items()}
+        for row in queryset.values(*FIELDS.values()).iterator(chunk_size=2000)
+    )
+
+
+def record_for(patient):
+    """The record of a Patient instance whose user is loaded."""
+    return {
+        'id': patient.id, 'username': patient.user.username, 'first_name': patient.user.first_name, 'last_name': patient.user.last_name,
+        'email': patient.user.email, 'date_of_birth': patient.date_of_birth, 'phone': patient.phone,
+    }
+
+
+def refresh_patient(patient):
+    """Bring a patient's PatientMatchKey rows in line with their current details."""
+    from .models import PatientMatchKey
+
+    current = blocking_keys(record_for(patient))
+    with transaction.atomic():
+        stored = set(PatientMatchKey.objects.filter(patient_id=patient.id).values_list('key', flat=True))
+        if stored - current:
+            PatientMatchKey.objects.filter(patient_id=patient.id, key__in=stored - current).delete()
+        if current - stored:
+            PatientMatchKey.objects.bulk_create(
+                [PatientMatchKey(patient_id=patient.id, key=key) for key in current - stored], ignore_conflicts=True,
+            )
+
+
+def add_keys(patients):
+    """File new patients (each with its user) under their keys, with one insert."""
+    from .models import PatientMatchKey
+
+    PatientMatchKey.objects.bulk_create(
+        [PatientMatchKey(patient_id=patient.id, key=key) for patient in patients for key in blocking_keys(record_for(patient))],
+        batch_size=2000, ignore_conflicts=True,
+    )
+
+
+def record_pairs(pairs):
+    """Store (id, id, score) pairs as PossibleDuplicate rows, updating the score of known pairs."""
+    from .models import PossibleDuplicate
+
+    PossibleDuplicate.objects.bulk_create(
+        [PossibleDuplicate(patient_id=min(a, b), other_id=max(a, b), score=value) for a, b, value in pairs],
+        batch_size=2000, update_conflicts=True, unique_fields=['patient', 'other'], update_fields=['score', 'detected_at'],
+    )
+    invalidate_counts(PossibleDuplicate)
+
+
+def possible_duplicates(patient, threshold=None):
+    """
+    The patients that `patient` (with its user loaded) may duplicate, as (id, score) pairs, best first,
+    also stored for review. Only the patients sharing one of its keys are scored, and a key shared by
+    more than DUPLICATE_PATIENT_MAX_BLOCK patients is ignored, so this is a few indexed queries however
+    many patients there are.
+    """
+    from .models import Patient, PatientMatchKey
+
+    threshold = settings.DUPLICATE_PATIENT_THRESHOLD if threshold is None else threshold
+    record = record_for(patient)
+    keys = blocking_keys(record)
+    if not keys:
+        return []
+    sizes = PatientMatchKey.objects.filter(key__in=keys).values('key').annotate(size=Count('id'))
+    keys = [row['key'] for row in sizes if 1 < row['size'] <= settings.DUPLICATE_PATIENT_MAX_BLOCK]
+    if not keys:
+        return []
+    candidates = Patient.objects.filter(id__in=PatientMatchKey.objects.filter(key__in=keys).exclude(patient_id=patient.id).values('patient_id'))
+    found = sorted(
+        ((other['id'], value) for other in records(candidates) if (value := score(record, other, threshold)) >= threshold),
+        key=lambda pair: (-pair[1], pair[0]),
+    )
+    record_pairs([(patient.id, other_id, value) for other_id, value in found])
+    return found
+
+
+def find_duplicates(patients, threshold=None, max_block=None):
+    """
+    Every pair among `patients` (an iterable of records) scoring at least `threshold`, as
+    (id, id, score) with the lower id first, plus the keys skipped for being shared by more than
+    `max_block` records. Each record is filed under its keys and compared only within them, so the
+    work grows with the number of patients rather than its square.
+    """
+    threshold = settings.DUPLICATE_PATIENT_THRESHOLD if threshold is None else threshold
+    max_block = settings.DUPLICATE_PATIENT_MAX_BLOCK if max_block is None else max_block
+    by_id, blocks = {}, defaultdict(list)
+    for record in patients:
+        by_id[record['id']] = record
+        for key in blocking_keys(record):
+            blocks[key].append(record['id'])
+
+    compared, pairs, skipped = set(), [], {}
+    for key, ids in blocks.items():
+        if len(ids) > max_block:
+            skipped[key] = len(ids)
+            continue
+        for position, a in enumerate(ids):
+            for b in ids[position + 1:]:
+                pair = (min(a, b), max(a, b))
+                if pair in compared:
+                    continue
+                compared.add(pair)
+                value = score(by_id[a], by_id[b], threshold)
+                if value >= threshold:
+                    pairs.append((*pair, value))
+    pairs.sort(key=lambda pair: (-pair[2], pair[0], pair[1]))
+    return pairs, skipped
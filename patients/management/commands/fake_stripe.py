@@ -0,0 +1,202 @@
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlsplit
+from urllib.request import Request, urlopen
+from django.core.management.base import BaseCommand, CommandError
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """
+    The slice of the Stripe API that checkout uses: create and retrieve checkout sessions, and list
+    events. Replays the stored response for a repeated Idempotency-Key like Stripe does, and can add
+    latency and random 500s so timeouts, retries and the circuit breaker can be exercised offline.
+    `POST /pay/<session id>` (with `?outcome=expired` to let it lapse instead) stands in for the
+    customer finishing checkout: it records the event and, if a webhook URL is set, delivers it signed.
+    """
+    server_version = 'FakeStripe/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _degrade(self):
+        """Apply the configured latency; True if this request should fail with a server error."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self._send(500, {'error': {'type': 'api_error', 'message': 'Simulated failure'}})
+            return True
+        return False
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        match = re.fullmatch(r'/pay/([\w-]+)/?', url.path)
+        if match:
+            return self._complete(match.group(1), parse_qs(url.query).get('outcome', ['paid'])[0])
+        if url.path.rstrip('/') != '/v1/checkout/sessions':
+            return self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL (POST: {self.path})'}})
+        form = dict(parse_qsl(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()))
+        if self._degrade():
+            return
+        key = self.headers.get('Idempotency-Key')
+        with self.server.lock:
+            if key and key in self.server.idempotent:
+                return self._send(200, self.server.idempotent[key])
+
+        session_id = f'cs_test_{uuid.uuid4().hex}'
+        unit_amount = int(form.get('line_items[0][price_data][unit_amount]', 0))
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'http://{self.server.server_address[0]}:{self.server.server_address[1]}/pay/{session_id}',
+            'status': 'open',
+            'payment_status': 'unpaid',
+            'mode': form.get('mode', 'payment'),
+            'currency': form.get('line_items[0][price_data][currency]', 'inr'),
+            'amount_total': unit_amount * int(form.get('line_items[0][quantity]', 1)),
+            'success_url': form.get('success_url'),
+            'cancel_url': form.get('cancel_url'),
+            'metadata': {match.group(1): value for name, value in form.items() if (match := re.fullmatch(r'metadata\[(.+)\]', name))},
+            'created': int(time.time()),
+            'expires_at': int(time.time()) + 24 * 60 * 60,
+        }
+        with self.server.lock:
+            self.server.sessions[session_id] = session
+            if key:
+                self.server.idempotent[key] = session
+            self.server.created += 1
+        self._send(200, session)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') == '/v1/events':
+            if self._degrade():
+                return
+            return self._send(200, self.server.list_events(parse_qs(url.query)))
+        match = re.fullmatch(r'/v1/checkout/sessions/([\w-]+)/?', url.path)
+        if not match:
+            return self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL (GET: {self.path})'}})
+        if self._degrade():
+            return
+        session = self.server.sessions.get(match.group(1))
+        if session is None:
+            return self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'No such checkout.session: {match.group(1)}'}})
+        self._send(200, session)
+
+    def _complete(self, session_id, outcome):
+        with self.server.lock:
+            session = self.server.sessions.get(session_id)
+            if session is None:
+                return self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'No such checkout.session: {session_id}'}})
+            if outcome == 'expired':
+                session.update(status='expired')
+                event_type = 'checkout.session.expired'
+            else:
+                session.update(status='complete', payment_status='paid')
+                event_type = 'checkout.session.completed'
+            event = self.server.add_event(event_type, session)
+        self.server.deliver(event)
+        self._send(200, session)
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, webhook_url=None, webhook_secret=None, verbose=False):
+        super().__init__(address, FakeStripeHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.idempotent = {}
+        self.events = []
+        self.created = 0
+
+    def add_event(self, event_type, session):
+        event = {
+            'id': f'evt_{uuid.uuid4().hex}', 'object': 'event', 'type': event_type, 'created': int(time.time()),
+            'livemode': False, 'data': {'object': dict(session)},
+        }
+        self.events.append(event)
+        return event
+
+    def list_events(self, query):
+        """Events newest first, filtered like Stripe's list endpoint by types[], created[gte], starting_after and limit."""
+        types = {value for name, values in query.items() if re.fullmatch(r'types\[\d*\]|type', name) for value in values}
+        created_since = int(query.get('created[gte]', [0])[0])
+        limit = min(int(query.get('limit', [10])[0]), 100)
+        with self.lock:
+            events = [event for event in reversed(self.events) if (not types or event['type'] in types) and event['created'] >= created_since]
+        if 'starting_after' in query:
+            ids = [event['id'] for event in events]
+            after = query['starting_after'][0]
+            events = events[ids.index(after) + 1:] if after in ids else []
+        return {'object': 'list', 'url': '/v1/events', 'data': events[:limit], 'has_more': len(events) > limit}
+
+    def deliver(self, event):
+        if not self.webhook_url:
+            return
+        payload = json.dumps(event).encode()
+        timestamp = int(time.time())
+        signature = hmac.new(self.webhook_secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+        request = Request(self.webhook_url, data=payload, headers={'Content-Type': 'application/json', 'Stripe-Signature': f't={timestamp},v1={signature}'})
+        try:
+            urlopen(request, timeout=10).close()
+        except OSError as e:
+            # the reconcile job is there for exactly this case
+            if self.verbose:
+                print(f'Webhook delivery of {event["id"]} failed: {e}')
+
+
+def make_server(host='127.0.0.1', port=12111, **options):
+    return FakeStripeServer((host, port), **options)
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a local stand-in for the Stripe checkout API. Set STRIPE_API_BASE=http://HOST:PORT (and any '
+        'STRIPE_SECRET_KEY) to send checkouts to it, e.g. to load-test the checkout endpoint offline.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each request')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 500')
+        parser.add_argument('--webhook-url', help='Deliver events here, e.g. http://127.0.0.1:8000/api/patients/payments/webhook/')
+        parser.add_argument('--webhook-secret', default='whsec_local', help='Secret to sign webhooks with (STRIPE_WEBHOOK_SECRET)')
+        parser.add_argument('--verbose', action='store_true', help='Log every request')
+
+    def handle(self, *args, **options):
+        if options['latency'] < 0 or not 0 <= options['error_rate'] <= 1:
+            raise CommandError('latency must not be negative and error-rate must be between 0 and 1')
+        server = make_server(
+            options['host'], options['port'], latency=options['latency'], error_rate=options['error_rate'],
+            webhook_url=options['webhook_url'], webhook_secret=options['webhook_secret'], verbose=options['verbose'],
+        )
+        self.stdout.write(f'Fake Stripe listening on http://{options["host"]}:{options["port"]} (Ctrl+C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f'Created {server.created} checkout sessions')
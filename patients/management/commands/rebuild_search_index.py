@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from doctors.models import Prescription, PrescriptionMedication
+from patients import search
+from patients.models import MedicalHistory
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text index over medical history and prescriptions from the source tables.'
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                backend.create(cursor)
+            backend.rebuild(search.documents(MedicalHistory, Prescription, PrescriptionMedication))
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the search index with {type(backend).__name__}'))
@@ -0,0 +1,58 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from doctors.models import Payment
+from patients.payments import FAILED_EVENTS, PAID_EVENTS, GatewayUnavailable, apply_sessions, get_gateway, settled_sessions
+
+
+class Command(BaseCommand):
+    help = (
+        'Pull checkout events from Stripe (or `fake_stripe`) and apply any the webhook missed, one page per '
+        'transaction. By default starts an hour before the oldest pending payment.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='ISO datetime to read events from')
+        parser.add_argument('--page-size', type=int, default=100, help='Events per request, at most 100')
+
+    def handle(self, *args, **options):
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError('--since should be an ISO datetime')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        else:
+            oldest = Payment.objects.filter(status=Payment.PENDING).aggregate(oldest=Min('created_at'))['oldest']
+            if oldest is None:
+                self.stdout.write(self.style.SUCCESS('No pending payments to reconcile'))
+                return
+            since = oldest - timedelta(hours=1)
+        if not 1 <= options['page_size'] <= 100:
+            raise CommandError('--page-size should be between 1 and 100')
+
+        totals = dict.fromkeys(('confirmed', 'failed', 'unchanged', 'duplicate', 'unknown'), 0)
+        pages = events = 0
+        starting_after = None
+        try:
+            gateway = get_gateway()
+            while True:
+                page = gateway.list_events((*PAID_EVENTS, *FAILED_EVENTS), since.timestamp(), starting_after, options['page_size'])
+                if not page.data:
+                    break
+                for outcome, count in apply_sessions(settled_sessions(page.data)).items():
+                    totals[outcome] += count
+                pages += 1
+                events += len(page.data)
+                if not page.has_more:
+                    break
+                starting_after = page.data[-1].id
+        except GatewayUnavailable as e:
+            raise CommandError(f'{e} (applied {pages} pages before stopping)')
+
+        self.stdout.write(f'Read {events} events in {pages} pages since {since.isoformat()}')
+        for outcome, count in totals.items():
+            self.stdout.write(f'{outcome}: {count}')
+        self.stdout.write(self.style.SUCCESS('Payments reconciled'))
@@ -0,0 +1,48 @@
+import csv
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from patients import duplicates
+from patients.models import Patient
+
+COLUMNS = ['score', 'patient_id', 'username', 'name', 'date_of_birth', 'phone', 'other_id', 'other_username', 'other_name', 'other_date_of_birth', 'other_phone']
+
+
+class Command(BaseCommand):
+    help = (
+        'List the pairs of patients that are probably the same person, best matches first. Patients are '
+        'only compared with those sharing a phone number, an email, or a date of birth and a similar '
+        'sounding name, so this runs over the whole patient table in close to linear time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=float, help=f'Lowest score reported (DUPLICATE_PATIENT_THRESHOLD, {settings.DUPLICATE_PATIENT_THRESHOLD})')
+        parser.add_argument('--max-block', type=int, help='Skip keys shared by more patients than this (DUPLICATE_PATIENT_MAX_BLOCK)')
+        parser.add_argument('--file', help='Write the CSV to this path instead of stdout')
+        parser.add_argument('--save', action='store_true', help='Also store the pairs for review at /api/admin/patient/duplicates/')
+
+    def handle(self, *args, **options):
+        if options['threshold'] is not None and not 0 <= options['threshold'] <= 1:
+            raise CommandError('--threshold should be between 0 and 1')
+        if options['max_block'] is not None and options['max_block'] < 2:
+            raise CommandError('--max-block should be at least 2')
+
+        records = {record['id']: record for record in duplicates.records(Patient.objects.all())}
+        pairs, skipped = duplicates.find_duplicates(records.values(), options['threshold'], options['max_block'])
+        for key, size in sorted(skipped.items(), key=lambda item: -item[1]):
+            self.stderr.write(f'Skipped {key}, shared by {size} patients')
+
+        out = open(options['file'], 'w', newline='') if options['file'] else self.stdout
+        try:
+            writer = csv.writer(out)
+            writer.writerow(COLUMNS)
+            for patient_id, other_id, score in pairs:
+                row = [score]
+                for record in (records[patient_id], records[other_id]):
+                    row += [record['id'], record['username'], f'{record["first_name"]} {record["last_name"]}'.strip(), record['date_of_birth'] or '', record['phone']]
+                writer.writerow(row)
+        finally:
+            if options['file']:
+                out.close()
+        if options['save']:
+            duplicates.record_pairs(pairs)
+        self.stderr.write(self.style.SUCCESS(f'Found {len(pairs)} possible duplicates among {len(records)} patients'))
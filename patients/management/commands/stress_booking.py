@@ -0,0 +1,135 @@
+import multiprocessing
+import random
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.utils import timezone
+from core.models import User
+from doctors.models import Doctor
+from patients.booking import SlotUnavailable, book_appointment
+from patients.models import Appointment, Patient
+
+PREFIX = 'stress_'
+
+
+def _worker(doctor_id, patient_ids, slot_times, attempts, seed, results):
+    # Each process needs its own connection; the parent closed its connections before forking
+    connections.close_all()
+    rng = random.Random(seed)
+    doctor = Doctor.objects.get(id=doctor_id)
+    patients = list(Patient.objects.filter(id__in=patient_ids))
+    booked = conflicts = errors = 0
+
+    for _ in range(attempts):
+        try:
+            book_appointment(rng.choice(patients), doctor, rng.choice(slot_times))
+            booked += 1
+        except SlotUnavailable:
+            conflicts += 1
+        except OperationalError:
+            errors += 1
+
+    connections.close_all()
+    results.put((booked, conflicts, errors))
+
+
+class Command(BaseCommand):
+    help = (
+        'Fire concurrent, deliberately conflicting bookings from several processes and report throughput and double bookings. '
+        f'Runs on a throwaway copy of the test database unless --use-configured-database is given; there it '
+        f'creates its own "{PREFIX}" doctor and patients and removes them afterwards unless --keep is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive', help='Replace a leftover test database without asking')
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--bookings', type=int, default=4000, help='Total booking attempts across all processes')
+        parser.add_argument('--slots', type=int, default=50, help='Number of distinct slots competed for')
+        parser.add_argument('--patients', type=int, default=20)
+        parser.add_argument('--keep', action='store_true', help='Keep the generated doctor, patients and appointments')
+        parser.add_argument(
+            '--use-configured-database', action='store_true',
+            help='Write to the configured database instead of a freshly created test database',
+        )
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1 or options['bookings'] < 1 or options['slots'] < 1 or options['patients'] < 1:
+            raise CommandError('processes, bookings, slots and patients must be positive')
+        if options['use_configured_database']:
+            return self._run(options)
+        # the forked workers inherit the switched connection settings, so they use the test database too
+        configured_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'], serialize=False)
+        try:
+            self._run(options)
+        finally:
+            connection.creation.destroy_test_db(configured_name, verbosity=0)
+
+    def _run(self, options):
+        processes, bookings = options['processes'], options['bookings']
+
+        doctor, patients = self._create_fixtures(options['patients'])
+        start = (timezone.now() + timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+        # Candidate start times are 15 minutes apart while appointments last 30, so neighbours overlap too
+        slot_times = [start + timedelta(minutes=15 * i) for i in range(options['slots'])]
+
+        try:
+            connections.close_all()
+            context = multiprocessing.get_context('fork')
+            results = context.Queue()
+            share, extra = divmod(bookings, processes)
+            workers = [
+                context.Process(target=_worker, args=(doctor.id, [p.id for p in patients], slot_times, share + (i < extra), i, results))
+                for i in range(processes)
+            ]
+
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            totals = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+
+            booked = sum(t[0] for t in totals)
+            conflicts = sum(t[1] for t in totals)
+            errors = sum(t[2] for t in totals)
+            # Any appointment that starts before the latest end seen so far overlaps an earlier booking
+            double_bookings = 0
+            latest_end = None
+            for scheduled_at, ends_at in Appointment.objects.filter(doctor=doctor).order_by('scheduled_at').values_list('scheduled_at', 'ends_at'):
+                if latest_end and scheduled_at < latest_end:
+                    double_bookings += 1
+                latest_end = max(latest_end, ends_at) if latest_end else ends_at
+
+            self.stdout.write(f'Attempts:        {bookings} from {processes} processes over {len(slot_times)} slots')
+            self.stdout.write(f'Elapsed:         {elapsed:.2f}s ({bookings / elapsed:.0f} attempts/s)')
+            self.stdout.write(f'Booked:          {booked}')
+            self.stdout.write(f'Conflicts (409): {conflicts}')
+            self.stdout.write(f'DB errors:       {errors}')
+            if double_bookings:
+                self.stdout.write(self.style.ERROR(f'Double bookings: {double_bookings}'))
+            else:
+                self.stdout.write(self.style.SUCCESS('Double bookings: 0'))
+        finally:
+            if not options['keep']:
+                User.objects.filter(username__startswith=PREFIX).delete()
+
+        if double_bookings:
+            raise CommandError('Double bookings detected')
+
+    def _create_fixtures(self, patient_count):
+        if User.objects.filter(username__startswith=PREFIX).exists():
+            raise CommandError(f'Users prefixed "{PREFIX}" already exist; remove them or finish the previous run first')
+
+        doctor_user = User.objects.create_user(username=f'{PREFIX}doctor', password=None, role='doctor')
+        doctor = Doctor.objects.create(user=doctor_user, specialization='Stress', phone='0', license_number=f'{PREFIX}license', slot_minutes=30)
+        patients = [
+            Patient.objects.create(
+                user=User.objects.create_user(username=f'{PREFIX}patient_{i}', password=None, role='patient'),
+                gender='other', address='-', phone='0',
+            )
+            for i in range(patient_count)
+        ]
+        return doctor, patients
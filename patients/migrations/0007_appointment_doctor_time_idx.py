@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0007_remove_doctor_is_active'),
+        ('patients', '0006_remove_patient_is_active_appointment_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['doctor', 'scheduled_at'], name='appointment_doctor_time_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def reserve_existing_slots(apps, schema_editor):
+    Appointment = apps.get_model('patients', 'Appointment')
+    AppointmentSlot = apps.get_model('patients', 'AppointmentSlot')
+
+    # Earlier double bookings keep their appointments; only the first one holds the slot
+    slots = (
+        AppointmentSlot(appointment_id=appointment_id, doctor_id=doctor_id, slot_start=scheduled_at)
+        for appointment_id, doctor_id, scheduled_at in Appointment.objects.order_by('id').values_list('id', 'doctor_id', 'scheduled_at').iterator()
+    )
+    AppointmentSlot.objects.bulk_create(slots, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0008_doctordayschedule'),
+        ('patients', '0007_appointment_doctor_time_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot_start', models.DateTimeField()),
+                ('appointment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='patients.appointment')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='doctors.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'slot_start'), name='unique_doctor_slot')],
+            },
+        ),
+        migrations.RunPython(reserve_existing_slots, migrations.RunPython.noop),
+    ]
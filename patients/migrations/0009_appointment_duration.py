@@ -0,0 +1,52 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:20
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_ends_at_and_reserve_blocks(apps, schema_editor):
+    Appointment = apps.get_model('patients', 'Appointment')
+    AppointmentSlot = apps.get_model('patients', 'AppointmentSlot')
+    step = settings.APPOINTMENT_GRANULARITY_MINUTES
+
+    appointments = list(Appointment.objects.order_by('id').only('id', 'doctor_id', 'scheduled_at', 'duration_minutes'))
+    slots = []
+    for appointment in appointments:
+        appointment.ends_at = appointment.scheduled_at + timedelta(minutes=appointment.duration_minutes)
+        block = appointment.scheduled_at.replace(second=0, microsecond=0)
+        block -= timedelta(minutes=block.minute % step)
+        while block < appointment.ends_at:
+            slots.append(AppointmentSlot(appointment_id=appointment.id, doctor_id=appointment.doctor_id, slot_start=block))
+            block += timedelta(minutes=step)
+    Appointment.objects.bulk_update(appointments, ['ends_at'], batch_size=1000)
+
+    # Reservations now cover every block of an appointment; existing overlaps keep the earlier booking's blocks
+    AppointmentSlot.objects.all().delete()
+    AppointmentSlot.objects.bulk_create(slots, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_appointmentslot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='duration_minutes',
+            field=models.PositiveSmallIntegerField(default=30),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='ends_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fill_ends_at_and_reserve_blocks, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='appointment',
+            name='ends_at',
+            field=models.DateTimeField(),
+        ),
+    ]
@@ -0,0 +1,66 @@
+import json
+from django.db import migrations
+
+# The table, columns and tokenizer of patients.search.SQLiteFTSBackend as of this migration
+TABLE = 'patients_medical_search'
+INSERT_SQL = f'INSERT INTO {TABLE} (diagnosis, medications, allergies, kind, object_id, patient_id) VALUES (%s, %s, %s, %s, %s, %s)'
+
+
+def medication_text(medications):
+    """Flatten the medications JSON text prescriptions stored at this point into plain words."""
+    try:
+        items = json.loads(medications)
+    except (TypeError, ValueError):
+        return medications or ''
+    if not isinstance(items, list):
+        return str(items)
+    return ' '.join(f'{item.get("name", "")} {item.get("dosage", "")}' if isinstance(item, dict) else str(item) for item in items)
+
+
+def rows(apps):
+    MedicalHistory = apps.get_model('patients', 'MedicalHistory')
+    Prescription = apps.get_model('doctors', 'Prescription')
+    for object_id, patient_id, diagnosis, medications, allergies in MedicalHistory.objects.values_list(
+            'id', 'patient_id', 'diagnosis', 'medications', 'allergies').iterator(chunk_size=2000):
+        yield [diagnosis, medications, allergies, 'history', object_id, patient_id]
+    for object_id, patient_id, diagnosis, medications in Prescription.objects.values_list(
+            'id', 'patient_id', 'diagnosis', 'medications').iterator(chunk_size=2000):
+        yield [diagnosis, medication_text(medications), '', 'prescription', object_id, patient_id]
+
+
+def build_index(apps, schema_editor):
+    # other databases search the source tables (patients.search.DatabaseSearchBackend) and need no index
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5('
+            'diagnosis, medications, allergies, kind UNINDEXED, object_id UNINDEXED, patient_id UNINDEXED, '
+            "tokenize = 'porter unicode61')"
+        )
+        cursor.execute(f'DELETE FROM {TABLE}')
+        batch = []
+        for row in rows(apps):
+            batch.append(row)
+            if len(batch) >= 2000:
+                cursor.executemany(INSERT_SQL, batch)
+                batch = []
+        if batch:
+            cursor.executemany(INSERT_SQL, batch)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0010_dayschedule_rollups'),
+        ('patients', '0009_appointment_duration'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_index, drop_index),
+    ]
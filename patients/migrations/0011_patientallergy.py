@@ -0,0 +1,57 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:52
+
+import re
+import django.db.models.deletion
+from django.db import migrations, models
+
+# patients.allergies as of this migration
+NO_ALLERGIES = {
+    '', '-', 'na', 'n/a', 'nil', 'no', 'none', 'none known', 'not specified', 'not known', 'unknown',
+    'nka', 'nkda', 'no known allergies', 'no known allergy', 'no known drug allergies',
+}
+SEPARATORS = re.compile(r'[,;\n]|\band\b')
+PREFIXES = re.compile(r'^(?:allergic to|allergy to|allergies to|allergy:|allergies:)\s*')
+
+
+def allergens(text):
+    found = set()
+    for part in SEPARATORS.split(text or ''):
+        allergen = PREFIXES.sub('', ' '.join(part.split()).lower()).strip(' .')[:200]
+        if allergen not in NO_ALLERGIES:
+            found.add(allergen)
+    return found
+
+
+def collect_allergies(apps, schema_editor):
+    MedicalHistory = apps.get_model('patients', 'MedicalHistory')
+    PatientAllergy = apps.get_model('patients', 'PatientAllergy')
+    batch = []
+    rows = MedicalHistory.objects.values_list('patient_id', 'allergies').distinct().order_by('patient_id')
+    for patient_id, text in rows.iterator(chunk_size=2000):
+        batch.extend(PatientAllergy(patient_id=patient_id, allergen=allergen) for allergen in allergens(text))
+        if len(batch) >= 2000:
+            PatientAllergy.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    PatientAllergy.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0010_medical_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientAllergy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('allergen', models.CharField(max_length=200)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allergies', to='patients.patient')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('patient', 'allergen'), name='unique_patient_allergen')],
+            },
+        ),
+        migrations.RunPython(collect_allergies, migrations.RunPython.noop),
+    ]
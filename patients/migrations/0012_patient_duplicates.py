@@ -0,0 +1,95 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:03
+
+import re
+import unicodedata
+import django.db.models.deletion
+from django.db import migrations, models
+
+# the blocking keys of patients.duplicates as of this migration
+SOUNDEX_CODES = {
+    letter: digit
+    for digit, letters in (('1', 'bfpv'), ('2', 'cgjkqsxz'), ('3', 'dt'), ('4', 'l'), ('5', 'mn'), ('6', 'r'))
+    for letter in letters
+}
+NON_DIGITS = re.compile(r'\D')
+MIN_PHONE_DIGITS = 7
+
+
+def soundex(name):
+    letters = ''.join(c for c in unicodedata.normalize('NFKD', (name or '').lower()) if 'a' <= c <= 'z')
+    if not letters:
+        return ''
+    code, last = letters[0].upper(), SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter)
+        if digit and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in 'hw':
+            last = digit
+    return code.ljust(4, '0')
+
+
+def blocking_keys(phone, email, date_of_birth, first_name, last_name):
+    keys = set()
+    phone = NON_DIGITS.sub('', phone or '')[-10:]
+    if len(phone) >= MIN_PHONE_DIGITS:
+        keys.add(f'phone:{phone}')
+    email = (email or '').strip().lower()
+    if email:
+        keys.add(f'email:{email}'[:100])
+    if date_of_birth:
+        for name in (first_name, last_name):
+            code = soundex(name)
+            if code:
+                keys.add(f'dob:{date_of_birth.isoformat()}:{code}')
+    return keys
+
+
+def file_match_keys(apps, schema_editor):
+    Patient = apps.get_model('patients', 'Patient')
+    PatientMatchKey = apps.get_model('patients', 'PatientMatchKey')
+    batch = []
+    rows = Patient.objects.values_list('id', 'phone', 'user__email', 'date_of_birth', 'user__first_name', 'user__last_name').order_by('id')
+    for patient_id, *details in rows.iterator(chunk_size=2000):
+        batch.extend(PatientMatchKey(patient_id=patient_id, key=key) for key in blocking_keys(*details))
+        if len(batch) >= 2000:
+            PatientMatchKey.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    PatientMatchKey.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0011_patientallergy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientMatchKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(db_index=True, max_length=100)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_keys', to='patients.patient')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('patient', 'key'), name='unique_patient_match_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PossibleDuplicate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('detected_at', models.DateTimeField(auto_now=True)),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='patients.patient')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='patients.patient')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('patient', 'other'), name='unique_possible_duplicate'), models.CheckConstraint(condition=models.Q(('patient__lt', models.F('other'))), name='possible_duplicate_ordered')],
+            },
+        ),
+        migrations.RunPython(file_match_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,89 @@
+from django.db import migrations
+
+# The tables of patients.search.SQLiteFTSBackend as of this migration: one per kind, keyed by rowid = object id
+TABLES = {'history': 'patients_history_search', 'prescription': 'patients_prescription_search'}
+INSERT_SQL = 'INSERT INTO {table} (rowid, diagnosis, medications, allergies, patient_id) VALUES (%s, %s, %s, %s, %s)'
+# The single table it replaces, from 0010_medical_search_index
+OLD_TABLE = 'patients_medical_search'
+OLD_INSERT_SQL = f'INSERT INTO {OLD_TABLE} (diagnosis, medications, allergies, kind, object_id, patient_id) VALUES (%s, %s, %s, %s, %s, %s)'
+
+
+def item_texts(apps):
+    """{prescription id: 'name dosage ...'} from the line items."""
+    PrescriptionMedication = apps.get_model('doctors', 'PrescriptionMedication')
+    texts = {}
+    for prescription_id, name, dosage in PrescriptionMedication.objects.order_by('prescription_id', 'position').values_list(
+            'prescription_id', 'name', 'dosage').iterator(chunk_size=2000):
+        texts[prescription_id] = f'{texts[prescription_id]} {name} {dosage}' if prescription_id in texts else f'{name} {dosage}'
+    return texts
+
+
+def rows(apps):
+    """(kind, object_id, patient_id, diagnosis, medications, allergies) for every indexed row."""
+    MedicalHistory = apps.get_model('patients', 'MedicalHistory')
+    Prescription = apps.get_model('doctors', 'Prescription')
+    for object_id, patient_id, diagnosis, medications, allergies in MedicalHistory.objects.values_list(
+            'id', 'patient_id', 'diagnosis', 'medications', 'allergies').iterator(chunk_size=2000):
+        yield 'history', object_id, patient_id, diagnosis, medications, allergies
+    texts = item_texts(apps)
+    for object_id, patient_id, diagnosis in Prescription.objects.values_list('id', 'patient_id', 'diagnosis').iterator(chunk_size=2000):
+        yield 'prescription', object_id, patient_id, diagnosis, texts.get(object_id, ''), ''
+
+
+def insert(cursor, sql, batch):
+    if batch:
+        cursor.executemany(sql, batch)
+        batch.clear()
+
+
+def split_tables(apps, schema_editor):
+    # other databases search the source tables (patients.search.DatabaseSearchBackend) and need no index
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {OLD_TABLE}')
+        for table in TABLES.values():
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5('
+                "diagnosis, medications, allergies, patient_id UNINDEXED, tokenize = 'porter unicode61')"
+            )
+            cursor.execute(f'DELETE FROM {table}')
+        batches = {kind: [] for kind in TABLES}
+        for kind, object_id, patient_id, diagnosis, medications, allergies in rows(apps):
+            batches[kind].append([object_id, diagnosis, medications, allergies, patient_id])
+            if len(batches[kind]) >= 2000:
+                insert(cursor, INSERT_SQL.format(table=TABLES[kind]), batches[kind])
+        for kind, batch in batches.items():
+            insert(cursor, INSERT_SQL.format(table=TABLES[kind]), batch)
+
+
+def merge_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in TABLES.values():
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {OLD_TABLE} USING fts5('
+            'diagnosis, medications, allergies, kind UNINDEXED, object_id UNINDEXED, patient_id UNINDEXED, '
+            "tokenize = 'porter unicode61')"
+        )
+        cursor.execute(f'DELETE FROM {OLD_TABLE}')
+        batch = []
+        for kind, object_id, patient_id, diagnosis, medications, allergies in rows(apps):
+            batch.append([diagnosis, medications, allergies, kind, object_id, patient_id])
+            if len(batch) >= 2000:
+                insert(cursor, OLD_INSERT_SQL, batch)
+        insert(cursor, OLD_INSERT_SQL, batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0013_prescription_medications'),
+        ('patients', '0012_patient_duplicates'),
+    ]
+
+    operations = [
+        migrations.RunPython(split_tables, merge_tables),
+    ]
@@ -1,8 +1,9 @@
+from datetime import timedelta
 from django.db import models
-from core.models import User
+from core.models import LoadedValuesMixin, User
 # Create your models here.
 
-class Patient(models.Model):
+class Patient(LoadedValuesMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     date_of_birth = models.DateField(null=True, blank=True)
     gender = models.CharField(max_length=10, choices=[('male', 'Male'), ('female', 'Female'), ('other', 'Other')])
@@ -34,18 +35,102 @@ class MedicalHistory(models.Model):
 
     class Meta:
         ordering = ['-recorded_at']
+        # cursor pages walk (recorded_at, id), over everyone's records or one patient's
+        indexes = [
+            models.Index(fields=['recorded_at', 'id'], name='history_recorded_idx'),
+            models.Index(fields=['patient', 'recorded_at', 'id'], name='history_patient_recorded_idx'),
+        ]
 
     def __str__(self):
         return f'Medical History of patient - {self.patient.user.username}'
 
-class Appointment(models.Model):
+class PatientAllergy(models.Model):
+    # One row per allergen named in a patient's medical history (normalized by patients.allergies), kept
+    # in sync by patients.signals so prescribing checks do not re-read the whole history
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='allergies')
+    allergen = models.CharField(max_length=200)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'allergen'], name='unique_patient_allergen'),
+        ]
+
+    def __str__(self):
+        return f'Patient #{self.patient_id} is allergic to {self.allergen}'
+
+class AppointmentQuerySet(models.QuerySet):
+    def with_prescription_flag(self):
+        from doctors.models import Prescription
+        return self.annotate(has_prescription=models.Exists(Prescription.objects.filter(appointment=models.OuterRef('pk'))))
+
+
+class Appointment(LoadedValuesMixin, models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     doctor = models.ForeignKey('doctors.Doctor', on_delete=models.CASCADE)
     scheduled_at = models.DateTimeField()
+    duration_minutes = models.PositiveSmallIntegerField(default=30)
+    ends_at = models.DateTimeField()
     prescription_given = models.BooleanField(default=False)
     status = models.BooleanField(default=True)
 
+    objects = AppointmentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # a doctor's schedule is paged by (scheduled_at, id); overlap checks use the prefix
+            models.Index(fields=['doctor', 'scheduled_at', 'id'], name='appointment_doctor_time_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.ends_at = self.scheduled_at + timedelta(minutes=self.duration_minutes)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f'{self.patient.user.get_full_name()} - {self.doctor.user.get_full_name()}'
-    
-    
\ No newline at end of file
+
+
+class AppointmentSlot(models.Model):
+    # One row per reserved doctor slot; the unique constraint is what rules out double bookings
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='slots')
+    doctor = models.ForeignKey('doctors.Doctor', on_delete=models.CASCADE)
+    slot_start = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'slot_start'], name='unique_doctor_slot'),
+        ]
+
+    def __str__(self):
+        return f'Slot of doctor #{self.doctor_id} at {self.slot_start}'
+
+class PatientMatchKey(models.Model):
+    # Blocking keys of a patient (phone digits, phonetic name plus date of birth, ...) from
+    # patients.duplicates, kept in sync by patients.signals: a new registration is compared only
+    # with the patients sharing one of its keys
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='match_keys')
+    key = models.CharField(max_length=100, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'key'], name='unique_patient_match_key'),
+        ]
+
+    def __str__(self):
+        return f'Patient #{self.patient_id} matches on {self.key}'
+
+class PossibleDuplicate(models.Model):
+    # A pair of patients that scored at least DUPLICATE_PATIENT_THRESHOLD, stored with the lower id
+    # first for an administrator to review
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    detected_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'other'], name='unique_possible_duplicate'),
+            models.CheckConstraint(condition=models.Q(patient__lt=models.F('other')), name='possible_duplicate_ordered'),
+        ]
+
+    def __str__(self):
+        return f'Patients #{self.patient_id} and #{self.other_id} may be the same person ({self.score:.2f})'
@@ -0,0 +1,333 @@
+import hashlib
+import logging
+import threading
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from decimal import Decimal
+import requests
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from doctors.models import Payment, Prescription
+
+logger = logging.getLogger(__name__)
+
+# provider events that settle a checkout session one way or the other
+PAID_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+FAILED_EVENTS = ('checkout.session.expired', 'checkout.session.async_payment_failed')
+
+
+class GatewayUnavailable(Exception):
+    """The payment provider cannot take the request right now; the client should retry later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderTimeout(GatewayUnavailable):
+    """The provider did not answer in time. The call carries on, and a poll under the same idempotency key gets its result."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing provider. After `threshold` consecutive failures the circuit opens and
+    calls are refused at once for `reset_seconds`; then a single trial call is let through, which
+    closes the circuit if it succeeds and opens it again if it fails.
+    """
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_seconds - (time_module.monotonic() - self.opened_at))
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.retry_after() > 0 or self.trial_running:
+                return False
+            self.trial_running = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time_module.monotonic()
+            self.trial_running = False
+
+
+# errors that say the provider (or the network to it) is in trouble, as opposed to a bad request
+PROVIDER_ERRORS = (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError)
+
+
+class CheckoutGateway:
+    """
+    Talks to Stripe without letting a slow provider hold web workers. Calls share a pooled HTTP
+    client with connect/read timeouts and run on a small bounded thread pool. A web worker waits for
+    the answer for at most STRIPE_CHECKOUT_WAIT_SECONDS (a couple of seconds, enough for a healthy
+    provider) and then answers "pending" while the call carries on in the pool; it is turned away at
+    once when every pool slot is busy or the circuit breaker is open. Each session is created under
+    an idempotency key made of the checkout attempt (its pending payment) and the session contents,
+    so Stripe's own retries and a client polling after a timeout get the same session back, while
+    a new attempt never has an expired session replayed to it. A poll reaching the worker whose call
+    is still running waits on that call instead of sending another.
+    """
+
+    def __init__(self):
+        if not settings.STRIPE_SECRET_KEY:
+            raise GatewayUnavailable('Payments are not configured')
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        http_client = stripe.RequestsClient(timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT), session=session)
+        self.client = stripe.StripeClient(
+            settings.STRIPE_SECRET_KEY,
+            http_client=http_client,
+            max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+            base_addresses={'api': settings.STRIPE_API_BASE},
+        )
+        self.executor = ThreadPoolExecutor(max_workers=settings.STRIPE_POOL_SIZE, thread_name_prefix='stripe-checkout')
+        self.slots = threading.BoundedSemaphore(settings.STRIPE_POOL_SIZE)
+        self.breaker = CircuitBreaker(settings.STRIPE_BREAKER_FAILURES, settings.STRIPE_BREAKER_RESET_SECONDS)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    @staticmethod
+    def idempotency_key(params, attempt):
+        return f'checkout-{attempt}-' + hashlib.sha256(repr(sorted(params.items())).encode()).hexdigest()[:40]
+
+    def _run(self, func, kwargs):
+        try:
+            result = func(**kwargs)
+        except PROVIDER_ERRORS:
+            self.breaker.failed()
+            raise
+        except BaseException:
+            self.breaker.succeeded()
+            raise
+        else:
+            self.breaker.succeeded()
+            return result
+        finally:
+            self.slots.release()
+
+    def _submit(self, func, kwargs, key):
+        with self._in_flight_lock:
+            future = self._in_flight.get(key) if key is not None else None
+        if future is not None:
+            return future
+        if not self.breaker.allow():
+            raise GatewayUnavailable('The payment provider is unavailable', retry_after=self.breaker.retry_after())
+        if not self.slots.acquire(blocking=False):
+            raise GatewayUnavailable('Too many payment requests in progress', retry_after=1)
+        future = self.executor.submit(self._run, func, kwargs)
+        if key is not None:
+            with self._in_flight_lock:
+                self._in_flight[key] = future
+            # runs at once if the call is already over
+            future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._in_flight_lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def call(self, func, key=None, **kwargs):
+        """
+        Run one StripeClient call on the pool, behind the circuit breaker and the wait limit. A call
+        made with the `key` of one still running waits for that one.
+        """
+        future = self._submit(func, kwargs, key)
+        try:
+            return future.result(timeout=settings.STRIPE_CHECKOUT_WAIT_SECONDS)
+        except FutureTimeout:
+            # the call carries on in the pool; a poll with the same idempotency key picks up its result
+            raise ProviderTimeout('The payment provider is slow to respond', retry_after=1)
+        except PROVIDER_ERRORS as e:
+            raise GatewayUnavailable(f'The payment provider failed: {e.user_message or e.__class__.__name__}', retry_after=1)
+
+    def create_session(self, params, attempt):
+        key = self.idempotency_key(params, attempt)
+        return self.call(self.client.checkout.sessions.create, key=key, params=params, options={'idempotency_key': key})
+
+    def retrieve_session(self, session_id):
+        return self.call(self.client.checkout.sessions.retrieve, session=session_id)
+
+    def list_events(self, types, created_since, starting_after=None, limit=100):
+        params = {'types': list(types), 'created': {'gte': int(created_since)}, 'limit': limit}
+        if starting_after:
+            params['starting_after'] = starting_after
+        return self.call(self.client.events.list, params=params)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = CheckoutGateway()
+    return _gateway
+
+
+def reset_gateway():
+    """Drop the process gateway so the next call is built from the current settings."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is not None:
+            _gateway.executor.shutdown(wait=False)
+        _gateway = None
+
+
+# Open checkout sessions per prescription, in the default cache. That cache may be local to the
+# worker, where the signals that forget an entry do not reach, so an entry is only served after the
+# database confirms its payment is still pending at the doctor's current fee
+def _checkout_key(prescription_id):
+    return f'checkout-session:{prescription_id}'
+
+
+def cached_checkout(prescription_id, patient_id):
+    """The {'id', 'url'} of the patient's open checkout session for a prescription, if one is cached and still priced right."""
+    entry = cache.get(_checkout_key(prescription_id))
+    if entry is None:
+        return None
+    payment = Payment.objects.filter(stripe_session_id=entry['id']).values(
+        'status', 'amount', 'prescription__is_paid', 'prescription__patient_id', 'prescription__doctor__consultation_fee',
+    ).first()
+    if payment is None or payment['status'] != Payment.PENDING or payment['prescription__is_paid'] or payment['amount'] != payment['prescription__doctor__consultation_fee']:
+        forget_checkout(prescription_id)
+        return None
+    # someone else's prescription: not theirs to see, but still open for its patient
+    return entry if payment['prescription__patient_id'] == patient_id else None
+
+
+def cache_checkout(prescription, session):
+    """Keep an open session until shortly before the provider expires it, and at most CHECKOUT_SESSION_CACHE_SECONDS."""
+    timeout = settings.CHECKOUT_SESSION_CACHE_SECONDS
+    if session.get('expires_at'):
+        timeout = min(timeout, session['expires_at'] - time_module.time() - settings.CHECKOUT_SESSION_EXPIRY_MARGIN)
+    if timeout <= 0:
+        return
+    cache.set(_checkout_key(prescription.id), {'id': session['id'], 'url': session['url']}, int(timeout))
+
+
+def forget_checkout(prescription_id):
+    cache.delete(_checkout_key(prescription_id))
+
+
+def start_checkout(prescription, amount):
+    """
+    The pending payment a checkout attempt is made under; its id goes into the idempotency key. An
+    attempt still waiting for its session (the provider was slow) is taken up again, so the retry
+    gets that session; otherwise this is a new attempt with a key of its own.
+    """
+    payment = Payment.objects.filter(prescription=prescription, status=Payment.PENDING, stripe_session_id=None, amount=amount).order_by('-id').first()
+    return payment or Payment.objects.create(prescription=prescription, amount=amount)
+
+
+def record_checkout(payment, session):
+    payment.stripe_session_id = session['id']
+    payment.save(update_fields=['stripe_session_id', 'updated_at'])
+
+
+def abandon_checkout(payment):
+    """Drop an attempt the provider refused or never received, so the next one gets a fresh key."""
+    payment.delete()
+
+
+def _confirm(session, payment):
+    if payment is None:
+        # a session opened before payments were recorded at checkout
+        prescription = Prescription.objects.filter(id=(session.get('metadata') or {}).get('prescription_id')).first()
+        if prescription is None:
+            return 'unknown'
+        amount = Decimal(session['amount_total']) / 100 if session.get('amount_total') is not None else prescription.doctor.consultation_fee
+        payment = Payment(prescription=prescription, amount=amount, stripe_session_id=session['id'])
+    payment.status = Payment.PAID
+    try:
+        with transaction.atomic():
+            payment.save()
+    except IntegrityError:
+        logger.error('Checkout session %s paid for prescription %s, which was already paid; it needs a refund', session['id'], payment.prescription_id)
+        payment.status = Payment.DUPLICATE
+        payment.save()
+        return 'duplicate'
+    prescription = payment.prescription
+    if not prescription.is_paid:
+        prescription.is_paid = True
+        prescription.save(update_fields=['is_paid'])
+    return 'confirmed'
+
+
+def _fail(session, payment):
+    if payment is None:
+        return 'unknown'
+    if payment.status == Payment.FAILED:
+        return 'unchanged'
+    payment.status = Payment.FAILED
+    payment.save(update_fields=['status', 'updated_at'])
+    return 'failed'
+
+
+def apply_sessions(settled):
+    """
+    Move payments along the state machine from (checkout session, 'paid' or 'failed') pairs: a paid
+    session confirms its payment and the prescription, a failed or expired one fails a pending
+    payment. Payments are looked up with one indexed query for the whole batch and changed in one
+    transaction; a session whose payment is already paid (or flagged duplicate) costs nothing more,
+    so repeated confirmations write nothing. Returns a count per outcome.
+    """
+    outcomes = dict.fromkeys(('confirmed', 'failed', 'unchanged', 'duplicate', 'unknown'), 0)
+    if not settled:
+        return outcomes
+    payments = {
+        payment.stripe_session_id: payment
+        for payment in Payment.objects.select_related('prescription').filter(stripe_session_id__in=[session['id'] for session, _ in settled])
+    }
+    work, seen = [], set()
+    for session, result in settled:
+        payment = payments.get(session['id'])
+        if session['id'] in seen or (payment is not None and payment.status in (Payment.PAID, Payment.DUPLICATE)):
+            outcomes['unchanged'] += 1
+        else:
+            work.append((_confirm if result == Payment.PAID else _fail, session, payment))
+            seen.add(session['id'])
+    if work:
+        with transaction.atomic():
+            for action, session, payment in work:
+                outcomes[action(session, payment)] += 1
+    return outcomes
+
+
+def settled_sessions(events):
+    """(session, 'paid' or 'failed') for the provider events that settle a checkout session."""
+    settled = []
+    for event in events:
+        session = event['data']['object']
+        if event['type'] in PAID_EVENTS and session.get('payment_status') == 'paid':
+            settled.append((session, Payment.PAID))
+        elif event['type'] in FAILED_EVENTS:
+            settled.append((session, Payment.FAILED))
+    return settled
@@ -1,22 +1,23 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
+from core.principal import get_principal
 
 
 class IsPatient(BasePermission):
     def has_permission(self, request, view):
-        return request.user.is_authenticated and request.user.role == 'patient'
+        return get_principal(request).role == 'patient'
 
 
 class IsDoctorOrReadOnlyForPatients(BasePermission):
     def has_object_permission(self, request, view, obj):
-        user = request.user
-        if user.role == 'doctor':
+        principal = get_principal(request)
+        if principal.role == 'doctor':
             return True
 
-        elif user.role == 'admin':
+        elif principal.role == 'admin':
             return True
         
-        elif user.role == 'patient' and request.method in SAFE_METHODS:
-            return obj.patient.user == user
+        elif principal.role == 'patient' and request.method in SAFE_METHODS:
+            return obj.patient_id == principal.patient_id
         
         return False
         
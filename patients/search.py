@@ -0,0 +1,209 @@
+import re
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+HISTORY = 'history'
+PRESCRIPTION = 'prescription'
+KINDS = (HISTORY, PRESCRIPTION)
+# one FTS5 table per kind, each row keyed by rowid = the object's id so updates and deletes are point lookups
+TABLES = {HISTORY: 'patients_history_search', PRESCRIPTION: 'patients_prescription_search'}
+
+
+def _item_texts(item_model):
+    """(prescription id, 'name dosage ...') for every prescription with line items, in prescription id order."""
+    current, words = None, []
+    for prescription_id, name, dosage in item_model.objects.order_by('prescription_id', 'position').values_list(
+            'prescription_id', 'name', 'dosage').iterator(chunk_size=2000):
+        if prescription_id != current:
+            if current is not None:
+                yield current, ' '.join(words)
+            current, words = prescription_id, []
+        words.append(f'{name} {dosage}')
+    if current is not None:
+        yield current, ' '.join(words)
+
+
+def documents(history_model, prescription_model, item_model):
+    """
+    Yield (kind, object_id, patient_id, document) for every indexed row, for rebuilds. Prescription
+    medications come from `item_model` line items, merged in id order.
+    """
+    for object_id, patient_id, diagnosis, medications, allergies in history_model.objects.values_list(
+            'id', 'patient_id', 'diagnosis', 'medications', 'allergies').iterator(chunk_size=2000):
+        yield HISTORY, object_id, patient_id, {'diagnosis': diagnosis, 'medications': medications, 'allergies': allergies}
+    texts = _item_texts(item_model)
+    pending = next(texts, None)
+    for object_id, patient_id, diagnosis in prescription_model.objects.order_by('id').values_list('id', 'patient_id', 'diagnosis').iterator(chunk_size=2000):
+        while pending is not None and pending[0] < object_id:
+            pending = next(texts, None)
+        text = pending[1] if pending is not None and pending[0] == object_id else ''
+        yield PRESCRIPTION, object_id, patient_id, {'diagnosis': diagnosis, 'medications': text, 'allergies': ''}
+
+
+class Scope:
+    """Which patients' records a search may return: one patient, a doctor's patients, or (neither set) everyone."""
+
+    def __init__(self, patient_id=None, doctor_id=None):
+        self.patient_id = patient_id
+        self.doctor_id = doctor_id
+
+
+class BaseSearchBackend(ABC):
+    """What MEDICAL_SEARCH_BACKEND must provide; index() and remove() are called from the model signals."""
+
+    def create(self, cursor):
+        """Create whatever storage the backend needs; called by rebuild_search_index."""
+        pass
+
+    def rebuild(self, rows):
+        """Replace the whole index with `rows` as yielded by documents()."""
+        for kind, object_id, patient_id, document in rows:
+            self.index(kind, object_id, patient_id, document)
+
+    @abstractmethod
+    def index(self, kind, object_id, patient_id, document):
+        """Add or replace the document of one row."""
+
+    @abstractmethod
+    def remove(self, kind, object_id):
+        """Drop one row from the index."""
+
+    @abstractmethod
+    def search(self, query, scope, kinds=KINDS, limit=20, offset=0):
+        """Return a list of {'kind', 'id', 'patient_id', 'rank', 'snippet'} dicts, best match first."""
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """Ranked search over FTS5 tables kept in sync with MedicalHistory and Prescription rows."""
+    insert_sql = 'INSERT INTO {table} (rowid, diagnosis, medications, allergies, patient_id) VALUES (%s, %s, %s, %s, %s)'
+
+    def create(self, cursor):
+        for table in TABLES.values():
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5('
+                "diagnosis, medications, allergies, patient_id UNINDEXED, tokenize = 'porter unicode61')"
+            )
+
+    def rebuild(self, rows):
+        with connection.cursor() as cursor:
+            for table in TABLES.values():
+                cursor.execute(f'DELETE FROM {table}')
+            batches = {kind: [] for kind in KINDS}
+            for kind, object_id, patient_id, document in rows:
+                batch = batches[kind]
+                batch.append([object_id, document['diagnosis'], document['medications'], document['allergies'], patient_id])
+                if len(batch) >= 2000:
+                    cursor.executemany(self.insert_sql.format(table=TABLES[kind]), batch)
+                    batch.clear()
+            for kind, batch in batches.items():
+                if batch:
+                    cursor.executemany(self.insert_sql.format(table=TABLES[kind]), batch)
+
+    def index(self, kind, object_id, patient_id, document):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLES[kind]} WHERE rowid = %s', [object_id])
+            cursor.execute(self.insert_sql.format(table=TABLES[kind]), [
+                object_id, document['diagnosis'], document['medications'], document['allergies'], patient_id,
+            ])
+
+    def remove(self, kind, object_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLES[kind]} WHERE rowid = %s', [object_id])
+
+    def search(self, query, scope, kinds=KINDS, limit=20, offset=0):
+        match = self.match_expression(query)
+        if not match:
+            return []
+
+        selects, params = [], []
+        for kind in kinds:
+            table = TABLES[kind]
+            where = [f'{table} MATCH %s']
+            params += [kind, match]
+            if scope.patient_id is not None:
+                where.append('patient_id = %s')
+                params.append(scope.patient_id)
+            if scope.doctor_id is not None:
+                where.append('patient_id IN (SELECT patient_id FROM doctors_careteammember WHERE doctor_id = %s)')
+                params.append(scope.doctor_id)
+            selects.append(
+                f"SELECT %s AS kind, rowid AS object_id, patient_id, bm25({table}) AS rank, snippet({table}, -1, '[', ']', '...', 12) "
+                f'FROM {table} WHERE {" AND ".join(where)}'
+            )
+
+        sql = f'{" UNION ALL ".join(selects)} ORDER BY rank LIMIT %s OFFSET %s'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*params, limit, offset])
+            return [
+                {'kind': kind, 'id': object_id, 'patient_id': patient_id, 'rank': round(-rank, 4), 'snippet': snippet}
+                for kind, object_id, patient_id, rank, snippet in cursor.fetchall()
+            ]
+
+    @staticmethod
+    def match_expression(query):
+        # Quote every word so user input can never be read as FTS5 syntax; the last word matches as a prefix
+        words = re.findall(r'\w+', query)
+        if not words:
+            return ''
+        return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """Unranked fallback for databases without a full-text index: substring matches on the source tables."""
+
+    def rebuild(self, rows):
+        pass
+
+    def index(self, kind, object_id, patient_id, document):
+        pass
+
+    def remove(self, kind, object_id):
+        pass
+
+    def search(self, query, scope, kinds=KINDS, limit=20, offset=0):
+        from doctors.models import Prescription
+        from .models import MedicalHistory
+
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
+        sources = {
+            HISTORY: (MedicalHistory, ('diagnosis', 'medications', 'allergies')),
+            PRESCRIPTION: (Prescription, ('diagnosis', 'items__name', 'items__dosage')),
+        }
+        results = []
+        for kind in kinds:
+            model, fields = sources[kind]
+            queryset = model.objects.all()
+            for word in words:
+                word_filter = Q()
+                for field in fields:
+                    word_filter |= Q(**{f'{field}__icontains': word})
+                queryset = queryset.filter(word_filter)
+            if scope.patient_id is not None:
+                queryset = queryset.filter(patient_id=scope.patient_id)
+            if scope.doctor_id is not None:
+                queryset = queryset.filter(patient__care_team__doctor_id=scope.doctor_id)
+            for object_id, patient_id, diagnosis in queryset.distinct().order_by('-id').values_list('id', 'patient_id', 'diagnosis')[:offset + limit]:
+                results.append({'kind': kind, 'id': object_id, 'patient_id': patient_id, 'rank': None, 'snippet': diagnosis})
+        return results[offset:offset + limit]
+
+
+def get_backend():
+    return import_string(settings.MEDICAL_SEARCH_BACKEND)()
+
+
+def index_history(history):
+    get_backend().index(HISTORY, history.id, history.patient_id, {
+        'diagnosis': history.diagnosis, 'medications': history.medications, 'allergies': history.allergies,
+    })
+
+
+def index_prescription(prescription):
+    words = ' '.join(f'{name} {dosage}' for name, dosage in prescription.items.values_list('name', 'dosage'))
+    get_backend().index(PRESCRIPTION, prescription.id, prescription.patient_id, {
+        'diagnosis': prescription.diagnosis, 'medications': words, 'allergies': '',
+    })
@@ -2,7 +2,7 @@ from rest_framework import serializers
 from doctors.serializers import PrescriptionSerializer
 from core.models import User
 from doctors.models import Doctor, Payment, Prescription
-from .models import Appointment, MedicalHistory, Patient
+from .models import Appointment, MedicalHistory, Patient, PossibleDuplicate
 from django.contrib.auth import get_user_model
 
 user = get_user_model()
@@ -52,6 +52,14 @@ class PatientSerializer(serializers.ModelSerializer):
         model = Patient
         fields = ['id', 'email', 'user', 'username', 'full_name', 'date_of_birth', 'gender', 'address', 'phone', 'emergency_contact', 'blood_group', 'insurance_provider', 'insurance_number', 'date_registered']   
 
+class PossibleDuplicateSerializer(serializers.ModelSerializer):
+    patient = PatientSerializer(read_only=True)
+    other = PatientSerializer(read_only=True)
+
+    class Meta:
+        model = PossibleDuplicate
+        fields = ['id', 'patient', 'other', 'score', 'detected_at']
+
 class AppointmentSerializer(serializers.ModelSerializer):
     doctor_id = serializers.PrimaryKeyRelatedField(
         queryset=Doctor.objects.all(),
@@ -65,9 +73,13 @@ class AppointmentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Appointment
-        fields = ['id', 'doctor_id', 'patient', 'doctor', 'scheduled_at', 'prescription_given']
+        fields = ['id', 'doctor_id', 'patient', 'doctor', 'scheduled_at', 'duration_minutes', 'ends_at', 'prescription_given']
+        read_only_fields = ['ends_at']
         
     def get_prescription_given(self, obj):
+        # Querysets annotate has_prescription (see with_prescription_flag) to avoid a query per row
+        if hasattr(obj, 'has_prescription'):
+            return obj.has_prescription
         return Prescription.objects.filter(appointment=obj).exists()
         
 class MedicalHistorySerializer(serializers.ModelSerializer):
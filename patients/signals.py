@@ -0,0 +1,102 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from core.models import User
+from core.pagination import invalidate_counts
+from doctors.medications import medications_changed
+from doctors.models import Payment, Prescription
+from .models import MedicalHistory, Patient
+from . import allergies, duplicates, payments, search
+
+# Sent with `appointments` (a list of Appointment) after a batched insert, which bypasses post_save
+appointments_bulk_created = Signal()
+# Sent with `patients` (a list of Patient, each with its user) after a bulk import
+patients_bulk_created = Signal()
+
+
+def _changed(instance, fields):
+    loaded = getattr(instance, '_loaded_values', None)
+    return not loaded or any(loaded.get(field) != getattr(instance, field) for field in fields)
+
+
+@receiver(post_save, sender=Patient)
+def update_match_keys_on_patient_save(sender, instance, created, **kwargs):
+    # _loaded_values is replaced after the signals run, so it still holds the previous values here
+    if created or _changed(instance, ('date_of_birth', 'phone')):
+        duplicates.refresh_patient(instance)
+
+
+@receiver(post_save, sender=User)
+def update_match_keys_on_user_save(sender, instance, created, **kwargs):
+    # a registration saves the user before its patient, which files the keys itself
+    if created or instance.role != 'patient' or not _changed(instance, ('first_name', 'last_name', 'email')):
+        return
+    patient = Patient.objects.filter(user=instance).first()
+    if patient is not None:
+        patient.user = instance
+        duplicates.refresh_patient(patient)
+
+
+@receiver(patients_bulk_created)
+def add_match_keys_on_import(sender, patients, **kwargs):
+    duplicates.add_keys(patients)
+
+
+@receiver(appointments_bulk_created)
+@receiver(patients_bulk_created)
+def invalidate_counts_on_bulk_create(sender, **kwargs):
+    invalidate_counts(sender)
+
+
+@receiver(post_save, sender=MedicalHistory)
+def index_history_on_save(sender, instance, **kwargs):
+    search.index_history(instance)
+
+
+@receiver(post_delete, sender=MedicalHistory)
+def index_history_on_delete(sender, instance, **kwargs):
+    search.get_backend().remove(search.HISTORY, instance.id)
+
+
+@receiver(post_save, sender=MedicalHistory)
+def update_allergies_on_history_save(sender, instance, created, **kwargs):
+    if created:
+        allergies.add_allergies(instance.patient_id, instance.allergies)
+    else:
+        allergies.refresh_patient(instance.patient_id)
+
+
+@receiver(post_delete, sender=MedicalHistory)
+def update_allergies_on_history_delete(sender, instance, **kwargs):
+    allergies.refresh_patient(instance.patient_id)
+
+
+@receiver(post_save, sender=Prescription)
+def index_prescription_on_save(sender, instance, created, update_fields=None, **kwargs):
+    # a new prescription is indexed once, by medications_changed when its line items are written;
+    # marking a prescription paid leaves its indexed text alone
+    if created or update_fields is not None and set(update_fields) <= {'is_paid'}:
+        return
+    search.index_prescription(instance)
+
+
+@receiver(medications_changed)
+def index_prescription_on_medications_change(sender, prescription, **kwargs):
+    search.index_prescription(prescription)
+
+
+@receiver(post_delete, sender=Prescription)
+def index_prescription_on_delete(sender, instance, **kwargs):
+    search.get_backend().remove(search.PRESCRIPTION, instance.id)
+
+
+@receiver(post_save, sender=Prescription)
+@receiver(post_delete, sender=Prescription)
+def forget_checkout_on_prescription_change(sender, instance, **kwargs):
+    # paid, edited or gone: the cached session no longer applies
+    payments.forget_checkout(instance.id)
+
+
+@receiver(post_save, sender=Payment)
+def forget_checkout_on_settled_payment(sender, instance, **kwargs):
+    if instance.status != Payment.PENDING:
+        payments.forget_checkout(instance.prescription_id)
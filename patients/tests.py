@@ -1,3 +1,494 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from urllib.request import urlopen
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from adminpanel import stats
+from core.factories import QueryBudgetChecks, client_for, seed
+from doctors.directory import directory
+from doctors.models import Doctor, DoctorDaySchedule, Payment, Prescription
+from . import payments
+from .booking import SlotUnavailable, book_appointment
+from .management.commands.fake_stripe import make_server
+from .models import Appointment, AppointmentSlot, MedicalHistory, Patient, PatientMatchKey, PossibleDuplicate
 
-# Create your tests here.
+
+class PatientQueryBudgetTests(QueryBudgetChecks, TestCase):
+    """The patient-facing listings stay within their query budgets, also as the tables grow."""
+
+    def endpoints(self):
+        patient, doctor, admin = self.patient.user, self.doctor.user, self.admin.user
+        return [
+            (patient, reverse('doctors-list')),
+            (patient, reverse('doctors-detail', args=[self.doctor.id])),
+            (patient, reverse('doctors-slots', args=[self.doctor.id])),
+            (patient, reverse('admin-appointment-list')),
+            # patients and adminpanel register some routes under the same names, so use their paths
+            (patient, '/api/patients/medicalhistory/'),
+            (patient, reverse('get-payments')),
+            (patient, reverse('logged-patient')),
+            (patient, reverse('search-records') + '?q=flu'),
+            (doctor, reverse('doctor-search-records') + '?q=paracet'),
+            (admin, '/api/admin/medicalhistory/'),
+            (admin, reverse('admin-search-records') + '?q=flu&kind=prescription'),
+        ]
+
+
+class DoctorSlotsTests(TestCase):
+    """Free slots are listed per day, can all be booked, and date parameters that are not real dates are rejected."""
+
+    def setUp(self):
+        self.doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=1)[0]
+        self.patient = Patient.objects.get(appointment__doctor=self.doctor)
+        self.client = client_for(self.patient.user)
+        self.day = timezone.localdate() + timedelta(days=1)
+
+    def slots(self):
+        response = self.client.get(reverse('doctors-slots', args=[self.doctor.id]), {'start': self.day, 'end': self.day})
+        self.assertEqual(response.status_code, 200)
+        return response.data['days'][0]['slots']
+
+    def booked(self):
+        return DoctorDaySchedule.objects.filter(doctor=self.doctor, date=self.day).values_list('booked_slots', flat=True).first()
+
+    def test_slots_start_on_block_boundaries_and_can_be_booked(self):
+        Doctor.objects.filter(id=self.doctor.id).update(available_from='09:07', available_to='10:00', slot_minutes=15)
+        slots = self.slots()
+        self.assertEqual(slots, [f'{self.day} {at}:00' for at in ('09:10', '09:25', '09:40')])
+
+        response = self.client.post(reverse('admin-appointment-list'), {'doctor_id': self.doctor.id, 'appointment_time': slots[1]}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.slots(), [slots[0], slots[2]])
+
+    def test_invalid_dates_are_rejected(self):
+        client = client_for(self.doctor.user)
+        url = reverse('doctors-slots', args=[self.doctor.id])
+        self.assertEqual(client.get(url).status_code, 200)
+        for params in ({'start': '2024-02-30'}, {'start': 'soon'}, {'end': '2024-13-01'}):
+            with self.subTest(params=params):
+                self.assertEqual(client.get(url, params).status_code, 400)
+
+    def test_day_index_follows_create_reschedule_and_cancel(self):
+        at = f'{self.day} 10:00:00'
+        response = self.client.post(reverse('admin-appointment-list'), {'doctor_id': self.doctor.id, 'appointment_time': at}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.booked(), [[600, 630]])
+        self.assertNotIn(at, self.slots())
+
+        url = reverse('admin-appointment-detail', args=[response.data['id']])
+        response = self.client.put(url, {'scheduled_at': f'{self.day} 11:00:00', 'duration_minutes': 45}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.booked(), [[660, 705]])
+        self.assertIn(at, self.slots())
+
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertIsNone(self.booked())
+        self.assertIn(f'{self.day} 11:00:00', self.slots())
+
+
+class DoctorDirectoryTests(TestCase):
+    """The directory is paged, tags its responses by content and rejects fees that are not numbers."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctors = seed(doctors=5, patients_per_doctor=1, appointments_per_patient=1)
+
+    def setUp(self):
+        # the snapshot outlives the rollback of other tests' changes
+        directory.invalidate()
+        self.client = client_for(self.doctors[0].user)
+        self.url = reverse('doctors-list')
+
+    def test_list_is_paged(self):
+        first = self.client.get(self.url, {'limit': 2})
+        self.assertEqual(first.data['count'], 5)
+        self.assertEqual(len(first.data['results']), 2)
+        rest = self.client.get(first.data['next'])
+        self.assertEqual(len(rest.data['results']), 2)
+        self.assertFalse({d['id'] for d in first.data['results']} & {d['id'] for d in rest.data['results']})
+
+    def test_etag_follows_the_data_not_the_worker(self):
+        etag = self.client.get(self.url)['ETag']
+        # a worker rebuilding its snapshot from the same rows hands out the same tag
+        directory.invalidate()
+        self.assertEqual(self.client.get(self.url)['ETag'], etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Doctor.objects.filter(id=self.doctors[0].id).update(consultation_fee=750)
+        directory.invalidate()
+        self.assertNotEqual(self.client.get(self.url)['ETag'], etag)
+
+    def test_fees_that_are_not_finite_are_rejected(self):
+        for value in ('NaN', 'sNaN', 'Infinity', '-inf', 'cheap'):
+            with self.subTest(value=value):
+                self.assertEqual(self.client.get(self.url, {'min_fee': value}).status_code, 400)
+                self.assertEqual(self.client.get(self.url, {'max_fee': value}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'min_fee': '100', 'max_fee': '600'}).data['count'], 5)
+
+
+class BookingTests(TestCase):
+    """Bookings reserve the doctor's time in aligned blocks, so only real overlaps are refused."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = seed(doctors=1, patients_per_doctor=1, appointments_per_patient=0)[0]
+        cls.patient = Patient.objects.get()
+        cls.start = (timezone.localtime() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+
+    def book(self, minutes, duration=30):
+        return client_for(self.patient.user).post(reverse('admin-appointment-list'), {
+            'doctor_id': self.doctor.id, 'appointment_time': (self.start + timedelta(minutes=minutes)).isoformat(), 'duration_minutes': duration,
+        }, format='json')
+
+    def test_adjacent_overlapping_and_unaligned_bookings(self):
+        self.assertEqual(self.book(0).status_code, 201)
+        # back to back on either side
+        self.assertEqual(self.book(30).status_code, 201)
+        self.assertEqual(self.book(-20, duration=20).status_code, 201)
+        self.assertEqual(self.book(15).status_code, 409)
+        self.assertEqual(self.book(55).status_code, 409)
+        response = self.book(63)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('multiple of 5 minutes', response.data['message'])
+        self.assertEqual(self.book(60).status_code, 201)
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor).count(), 4)
+
+    def test_reschedule_to_an_unaligned_time_is_refused(self):
+        appointment_id = self.book(0).data['id']
+        url = reverse('admin-appointment-detail', args=[appointment_id])
+        client = client_for(self.patient.user)
+        self.assertEqual(client.patch(url, {'scheduled_at': (self.start + timedelta(minutes=33)).isoformat()}, format='json').status_code, 400)
+        self.assertEqual(client.patch(url, {'scheduled_at': (self.start + timedelta(minutes=35)).isoformat()}, format='json').status_code, 200)
+        self.assertEqual(Appointment.objects.get(id=appointment_id).scheduled_at, self.start + timedelta(minutes=35))
+
+
+    def book_series(self, minutes):
+        times = [(self.start + timedelta(minutes=m)).isoformat() for m in minutes]
+        return client_for(self.patient.user).post(reverse('admin-appointment-bulk'), {
+            'doctor_id': self.doctor.id, 'appointment_times': times, 'duration_minutes': 30,
+        }, format='json')
+
+    def test_series_reports_conflicts_and_duplicates(self):
+        self.assertEqual(self.book(60).status_code, 201)
+        # 10:00 twice, 10:15 overlaps the series itself, 10:45 overlaps the 11:00 booking
+        response = self.book_series([0, 0, 15, 45, 120])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['booked'], response.data['conflicts'], response.data['duplicates']), (2, 2, 1))
+        self.assertEqual([occurrence['status'] for occurrence in response.data['occurrences']], ['booked', 'duplicate', 'conflict', 'conflict', 'booked'])
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor).count(), 3)
+        self.assertEqual(self.book_series([0, 15]).status_code, 409)
+
+    def test_series_falls_back_to_single_bookings_after_losing_a_race(self):
+        # a booking committed after the series read the schedule: its reservation is not visible to the overlap check
+        rival = Appointment.objects.create(patient=self.patient, doctor=self.doctor, scheduled_at=self.start + timedelta(days=30))
+        AppointmentSlot.objects.create(appointment=rival, doctor=self.doctor, slot_start=self.start + timedelta(minutes=30))
+        response = self.book_series([0, 30, 90])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([occurrence['status'] for occurrence in response.data['occurrences']], ['booked', 'conflict', 'booked'])
+        self.assertEqual(AppointmentSlot.objects.filter(doctor=self.doctor).exclude(appointment=rival).count(), 12)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    """Bookings racing for overlapping times from several threads never double-book the doctor."""
+
+    def test_reservation_constraint_decides_races(self):
+        doctor = seed(doctors=1, patients_per_doctor=4, appointments_per_patient=0)[0]
+        patients = list(Patient.objects.all())
+        start = (timezone.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+        # 30 minute visits every 15 minutes between 10:00 and 11:15, so neighbours overlap as well
+        times = [start + timedelta(minutes=15 * i) for i in range(6)]
+        barrier = threading.Barrier(len(patients))
+        outcomes = []
+
+        def book(patient, offset):
+            try:
+                barrier.wait()
+                for i in range(len(times)):
+                    try:
+                        book_appointment(patient, doctor, times[(offset + i) % len(times)], 30)
+                        outcomes.append('booked')
+                    except SlotUnavailable:
+                        outcomes.append('conflict')
+            finally:
+                connection.close()
+
+        # without the early overlap check every attempt reaches the insert, leaving the race to the constraint
+        with patch('patients.booking.overlapping', return_value=Appointment.objects.none()):
+            threads = [threading.Thread(target=book, args=(patient, offset)) for offset, patient in enumerate(patients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(outcomes), len(patients) * len(times))
+        booked = list(Appointment.objects.filter(doctor=doctor).order_by('scheduled_at').values_list('scheduled_at', 'ends_at'))
+        self.assertEqual(outcomes.count('booked'), len(booked))
+        self.assertEqual(len(booked), 3)
+        for (_, previous_end), (next_start, _) in zip(booked, booked[1:]):
+            self.assertLessEqual(previous_end, next_start)
+
+
+class MedicalSearchTests(TestCase):
+    """Search results follow the same role scoping as the medical history viewsets."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctors = seed(doctors=2, patients_per_doctor=2)
+        cls.patient = Patient.objects.filter(appointment__doctor=cls.doctors[0]).first()
+
+    def search(self, user, query):
+        client = client_for(user)
+        response = client.get(reverse('search-records'), {'q': query, 'limit': 100})
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    def test_results_are_scoped_to_role(self):
+        patient_ids = {hit['patient_id'] for hit in self.search(self.patient.user, 'flu')}
+        self.assertEqual(patient_ids, {self.patient.id})
+
+        own_patients = set(Appointment.objects.filter(doctor=self.doctors[0]).values_list('patient_id', flat=True))
+        patient_ids = {hit['patient_id'] for hit in self.search(self.doctors[0].user, 'paracetamol')}
+        self.assertEqual(patient_ids, own_patients)
+
+    def test_index_follows_saves_and_deletes(self):
+        history = MedicalHistory.objects.create(patient=self.patient, diagnosis='Migraine', medications='Sumatriptan', allergies='Penicillin')
+        self.assertEqual([hit['id'] for hit in self.search(self.patient.user, 'penicil')], [history.id])
+
+        history.allergies = 'Latex'
+        history.save()
+        self.assertEqual(self.search(self.patient.user, 'penicillin'), [])
+        history.delete()
+        self.assertEqual(self.search(self.patient.user, 'latex'), [])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class DuplicatePatientTests(TestCase):
+    """Registrations are compared with the patients sharing a blocking key, and the report covers the whole table."""
+
+    def register(self, username, first_name, last_name, date_of_birth, phone):
+        return APIClient().post(reverse('register_patient'), {
+            'username': username, 'password': 'pass', 'email': f'{username}@example.com', 'first_name': first_name,
+            'last_name': last_name, 'date_of_birth': date_of_birth, 'gender': 'male', 'address': 'Street', 'phone': phone,
+        }, format='json')
+
+    def test_registration_flags_and_report_lists_duplicates(self):
+        self.assertFalse(self.register('jon', 'Jon', 'Smith', '1990-04-12', '+1 555 010 2030').data['possible_duplicate'])
+        response = self.register('john', 'John', 'Smyth', '1990-04-12', '555-010-2030')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertTrue(response.data['possible_duplicate'])
+        # same date of birth and phone but another name: a relative, not the same person
+        self.assertFalse(self.register('mia', 'Mia', 'Stone', '1990-04-12', '5550102030').data['possible_duplicate'])
+        jon, john, mia = (Patient.objects.get(user__username=username) for username in ('jon', 'john', 'mia'))
+        self.assertEqual(list(PossibleDuplicate.objects.values_list('patient', 'other')), [(jon.id, john.id)])
+
+        # keys follow changes to the patient and their name
+        mia.phone = '555 777 8888'
+        mia.save()
+        mia.user.first_name = 'Jonny'
+        mia.user.save()
+        self.assertEqual(set(PatientMatchKey.objects.filter(patient=mia).values_list('key', flat=True)), {
+            'phone:5557778888', 'email:mia@example.com', 'dob:1990-04-12:J500', 'dob:1990-04-12:S350',
+        })
+
+        out, err = StringIO(), StringIO()
+        call_command('report_duplicate_patients', stdout=out, stderr=err)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith(f'{jon.id},jon,Jon Smith,1990-04-12,+1 555 010 2030,{john.id},john,John Smyth,1990-04-12,555-010-2030'))
+        call_command('report_duplicate_patients', max_block=2, stdout=StringIO(), stderr=err)
+        self.assertIn('Skipped dob:1990-04-12:J500, shared by 3 patients', err.getvalue())
+
+
+class CheckoutGatewayTests(TestCase):
+    """Checkout goes through the pooled gateway: idempotent sessions, and a breaker that fails fast."""
+
+    def setUp(self):
+        self.server = make_server(port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        host, port = self.server.server_address
+        overrides = override_settings(
+            STRIPE_SECRET_KEY='sk_test_local', STRIPE_API_BASE=f'http://{host}:{port}',
+            STRIPE_MAX_NETWORK_RETRIES=0, STRIPE_BREAKER_FAILURES=2,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        payments.reset_gateway()
+        self.addCleanup(payments.reset_gateway)
+        cache.clear()
+        seed(doctors=1, patients_per_doctor=2)
+        self.prescription = Prescription.objects.select_related('patient__user').filter(is_paid=False).first()
+        self.client = client_for(self.prescription.patient.user)
+        self.url = reverse('checkout-prescription', args=[self.prescription.id])
+
+    def test_repeated_checkout_reuses_the_session(self):
+        first, second = self.client.get(self.url), self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['checkout_session_id'], second.json()['checkout_session_id'])
+        self.assertEqual(self.server.created, 1)
+
+    def test_open_session_is_cached_until_paid_or_repriced(self):
+        first = self.client.get(self.url).json()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url).json(), first)
+
+        doctor = Doctor.objects.get()
+        doctor.consultation_fee = 650
+        doctor.save()
+        repriced = self.client.get(self.url).json()
+        self.assertNotEqual(repriced['checkout_session_id'], first['checkout_session_id'])
+        self.assertEqual(self.server.created, 2)
+
+        urlopen(f'{settings.STRIPE_API_BASE}/pay/{repriced["checkout_session_id"]}', data=b'').close()
+        call_command('reconcile_payments', stdout=StringIO())
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+
+    def test_cached_session_is_checked_against_the_database(self):
+        # changes made by another worker, whose signals never reach this worker's cache
+        first = self.client.get(self.url).json()
+        Doctor.objects.update(consultation_fee=650)
+        repriced = self.client.get(self.url).json()
+        self.assertNotEqual(repriced['checkout_session_id'], first['checkout_session_id'])
+        Prescription.objects.filter(payment__stripe_session_id=repriced['checkout_session_id']).update(is_paid=True)
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+
+    def test_new_attempt_after_expiry_gets_a_new_session(self):
+        expired = self.client.get(self.url).json()['checkout_session_id']
+        urlopen(f'{settings.STRIPE_API_BASE}/pay/{expired}?outcome=expired', data=b'').close()
+        call_command('reconcile_payments', stdout=StringIO())
+        fresh = self.client.get(self.url).json()['checkout_session_id']
+        self.assertNotEqual(fresh, expired)
+        self.assertEqual(self.server.created, 2)
+
+    def test_checkout_is_for_the_owner_only(self):
+        other = Patient.objects.exclude(id=self.prescription.patient_id).select_related('user').first()
+        self.assertEqual(APIClient().get(self.url).status_code, 401)
+        self.assertEqual(client_for(other.user).get(self.url).status_code, 404)
+        self.assertEqual(client_for(self.prescription.doctor.user).get(self.url).status_code, 403)
+        # a session the owner opened is not handed to anyone else either
+        self.client.get(self.url)
+        self.assertEqual(client_for(other.user).get(self.url).status_code, 404)
+        self.assertEqual(self.server.created, 1)
+        self.assertEqual(Payment.objects.filter(prescription=self.prescription).count(), 1)
+
+    def test_slow_provider_answers_pending_and_the_poll_gets_the_session(self):
+        self.server.latency = 0.5
+        with override_settings(STRIPE_CHECKOUT_WAIT_SECONDS=0.1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], 'pending')
+        self.assertIn('Retry-After', response)
+        self.server.latency = 0
+        session_id = self.client.get(response.json()['poll_url']).json()['checkout_session_id']
+        self.assertEqual(self.server.created, 1)
+        self.assertEqual(Payment.objects.filter(stripe_session_id=session_id).count(), 1)
+        self.assertFalse(Payment.objects.filter(status=Payment.PENDING, stripe_session_id=None).exists())
+
+    def test_breaker_opens_after_provider_failures(self):
+        self.server.error_rate = 1.0
+        self.assertEqual(self.client.get(self.url).status_code, 503)
+        self.assertEqual(self.client.get(self.url).status_code, 503)
+        self.server.error_rate = 0.0
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.server.created, 0)
+        # the refused attempts leave no pending payments behind
+        self.assertFalse(Payment.objects.filter(status=Payment.PENDING).exists())
+
+    def test_confirmed_by_success_redirect_then_reconcile_is_a_no_op(self):
+        session_id = self.client.get(self.url).json()['checkout_session_id']
+        prescription = Prescription.objects.select_related('patient__user').get(payment__stripe_session_id=session_id)
+        patient, url = client_for(prescription.patient.user), reverse('payment-success', args=[prescription.id])
+        self.assertEqual(patient.get(url).status_code, 202)
+
+        urlopen(f'{settings.STRIPE_API_BASE}/pay/{session_id}', data=b'').close()
+        self.assertEqual(patient.get(url).status_code, 200)
+        self.assertEqual(Payment.objects.get(stripe_session_id=session_id).status, Payment.PAID)
+        with self.assertNumQueries(1):
+            patient.get(url)
+        call_command('reconcile_payments', '--since', '2000-01-01T00:00:00', stdout=StringIO())
+        self.assertEqual(Payment.objects.filter(prescription=prescription, status=Payment.PAID).count(), 1)
+
+    def test_success_check_is_for_the_owner_only_and_rate_limited(self):
+        prescription = Prescription.objects.select_related('patient__user').filter(is_paid=False).first()
+        url = reverse('payment-success', args=[prescription.id])
+        other = Patient.objects.exclude(id=prescription.patient_id).select_related('user').first()
+        self.assertEqual(APIClient().get(url).status_code, 401)
+        self.assertEqual(client_for(other.user).get(url).status_code, 404)
+
+        owner = client_for(prescription.patient.user)
+        responses = [owner.get(url).status_code for _ in range(11)]
+        self.assertEqual(responses[:10], [202] * 10)
+        self.assertEqual(responses[10], 429)
+
+    def test_unknown_session_is_a_bad_gateway(self):
+        prescription = Prescription.objects.select_related('patient__user').filter(is_paid=False).first()
+        Payment.objects.create(prescription=prescription, amount=500, stripe_session_id='cs_test_unknown')
+        response = client_for(prescription.patient.user).get(reverse('payment-success', args=[prescription.id]))
+        self.assertEqual(response.status_code, 502)
+
+    def test_reconcile_applies_missed_events(self):
+        paid_id = self.client.get(self.url).json()['checkout_session_id']
+        other = Prescription.objects.select_related('patient__user').filter(is_paid=False).exclude(payment__stripe_session_id=paid_id).first()
+        expired_id = client_for(other.patient.user).get(reverse('checkout-prescription', args=[other.id])).json()['checkout_session_id']
+        urlopen(f'{settings.STRIPE_API_BASE}/pay/{paid_id}', data=b'').close()
+        urlopen(f'{settings.STRIPE_API_BASE}/pay/{expired_id}?outcome=expired', data=b'').close()
+
+        call_command('reconcile_payments', '--page-size', '1', stdout=StringIO())
+        self.assertEqual(Payment.objects.get(stripe_session_id=paid_id).status, Payment.PAID)
+        self.assertTrue(Payment.objects.get(stripe_session_id=paid_id).prescription.is_paid)
+        self.assertEqual(Payment.objects.get(stripe_session_id=expired_id).status, Payment.FAILED)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(TestCase):
+    """Webhook confirmations are verified, move the payment once, and write nothing when repeated."""
+
+    def post_event(self, event, secret='whsec_test'):
+        payload = json.dumps(event).encode()
+        timestamp = int(timezone.now().timestamp())
+        signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+        return self.client.post(reverse('stripe-webhook'), payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    def test_completed_session_confirms_once(self):
+        seed(doctors=1, patients_per_doctor=1)
+        prescription = Prescription.objects.filter(is_paid=False).first()
+        Payment.objects.create(prescription=prescription, amount=500, stripe_session_id='cs_test_1')
+        event = {
+            'id': 'evt_1', 'object': 'event', 'type': 'checkout.session.completed',
+            'data': {'object': {'id': 'cs_test_1', 'object': 'checkout.session', 'payment_status': 'paid', 'metadata': {'prescription_id': str(prescription.id)}}},
+        }
+
+        self.assertEqual(self.post_event(event, secret='whsec_wrong').status_code, 400)
+        self.assertEqual(self.post_event(event).status_code, 200)
+        prescription.refresh_from_db()
+        self.assertTrue(prescription.is_paid)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(Payment.objects.filter(prescription=prescription, status=Payment.PAID).count(), 1)
+        self.assertEqual(stats.reconcile(dry_run=True), [])
+
+    def test_second_payment_for_a_paid_prescription_is_flagged(self):
+        seed(doctors=1, patients_per_doctor=1)
+        prescription = Prescription.objects.filter(is_paid=True).first()
+        Payment.objects.create(prescription=prescription, amount=500, stripe_session_id='cs_test_2')
+        event = {
+            'id': 'evt_2', 'object': 'event', 'type': 'checkout.session.completed',
+            'data': {'object': {'id': 'cs_test_2', 'object': 'checkout.session', 'payment_status': 'paid'}},
+        }
+        self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(Payment.objects.get(stripe_session_id='cs_test_2').status, Payment.DUPLICATE)
+        self.assertEqual(Payment.objects.filter(prescription=prescription, status=Payment.PAID).count(), 1)
+        self.assertEqual(stats.reconcile(dry_run=True), [])
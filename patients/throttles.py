@@ -0,0 +1,11 @@
+from rest_framework.throttling import UserRateThrottle
+
+
+class CheckoutThrottle(UserRateThrottle):
+    # an uncached checkout opens a session with the payment provider and holds a pool slot meanwhile
+    scope = 'checkout'
+
+
+class PaymentStatusThrottle(UserRateThrottle):
+    # each uncached check can cost several calls to the payment provider
+    scope = 'payment-status'
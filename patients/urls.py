@@ -1,5 +1,5 @@
 from django.urls import path, include
-from patients.views import AppointmentViewSet, RegisterPatientView, PatientViewSet, MedicalHistoryViewSet, ViewDoctorsViewset, create_checkout_session, get_logged_in_patient, get_payments, payment_cancel, payment_success
+from patients.views import AppointmentViewSet, RegisterPatientView, PatientViewSet, MedicalHistoryViewSet, ViewDoctorsViewset, create_checkout_session, get_logged_in_patient, get_payments, payment_cancel, payment_success, search_records, set_initial_password, stripe_webhook
 from rest_framework.routers import DefaultRouter
 from doctors.views import PrescriptionViewSet
 
@@ -14,11 +14,14 @@ router.register(r'prescriptions', PrescriptionViewSet, basename='admin-prescript
 
 urlpatterns = [
     path('register/', RegisterPatientView.as_view(), name='register_patient'),
+    path('set-password/', set_initial_password, name='set-initial-password'),
     path('pay/prescription/<int:prescription_id>/', create_checkout_session, name='checkout-prescription'),
     path('payment-success/<int:prescription_id>/', payment_success, name='payment-success'),
     path('payment-cancel/<int:prescription_id>/', payment_cancel, name='payment-cancel'),
     path('payments/', get_payments, name='get-payments'),
-    path('me/', get_logged_in_patient, name='logged-patient')
+    path('payments/webhook/', stripe_webhook, name='stripe-webhook'),
+    path('me/', get_logged_in_patient, name='logged-patient'),
+    path('search/', search_records, name='search-records'),
 ]
 
 urlpatterns += router.urls
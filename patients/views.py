@@ -1,52 +1,152 @@
-import json
+import math
+from collections import Counter
+from datetime import timedelta
+from django.contrib.auth.password_validation import validate_password
+from django.contrib.auth.tokens import default_token_generator
+from django.core.exceptions import ValidationError
 from django.http import JsonResponse
 from django.shortcuts import render, get_object_or_404
-from django.utils.dateparse import parse_datetime
+from django.utils.dateparse import parse_date, parse_datetime
 from rest_framework.viewsets import ModelViewSet, GenericViewSet, ReadOnlyModelViewSet
 from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.decorators import action, api_view, permission_classes, throttle_classes
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework import mixins
-from doctors.models import Doctor, Payment, Prescription
+from core.models import User
+from doctors.models import CareTeamMember, Doctor, Payment, Prescription
 from doctors.serializers import DoctorSerializer
+from doctors.directory import DirectoryFilterError, directory
+from doctors.slots import free_slots, slot_minutes
+from core.pagination import ListPagination, StableCursorPagination
+from core.principal import get_principal
+from core.querybudget import query_budget
 from patients.permissions import IsDoctorOrReadOnlyForPatients, IsPatient
 from .serializers import AppointmentSerializer, MedicalHistorySerializer, PatientSerializer, PaymentSerializer, RegisterPatientSerializer
+from .booking import BOOKED, CONFLICT, DUPLICATE, InvalidDuration, InvalidStart, SlotUnavailable, book_appointment, book_series, reschedule_appointment
 from .models import Appointment, MedicalHistory, Patient
+from .payments import GatewayUnavailable, ProviderTimeout, abandon_checkout, apply_sessions, cache_checkout, cached_checkout, get_gateway, record_checkout, settled_sessions, start_checkout
+from .throttles import CheckoutThrottle, PaymentStatusThrottle
+from . import duplicates, search
 from rest_framework import serializers
 import stripe
 from django.conf import settings
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 # Create your views here.
 
+MAX_SERIES_LENGTH = 52
+
 
 class RegisterPatientView(CreateAPIView):
+    """
+    Registration does not stop on a likely duplicate, as the match may be wrong; the response says
+    `possible_duplicate` and the pairs are kept for an administrator. The other records are not shown
+    to the (unauthenticated) caller.
+    """
     queryset = Patient.objects.all()
     serializer_class = RegisterPatientSerializer
     permission_classes = [AllowAny]
 
+    def perform_create(self, serializer):
+        patient = serializer.save()
+        self.duplicates = duplicates.possible_duplicates(patient)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.data['possible_duplicate'] = bool(self.duplicates)
+        return response
+
+@query_budget(2)
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def set_initial_password(request):
+    """
+    First password of a patient imported without one, with the `token` listed for them by
+    `manage.py patient_invitations`. The token stops working once a password is set.
+    """
+    user = User.objects.filter(username=request.data.get('username', ''), role='patient').first()
+    if user is None or user.has_usable_password() or not default_token_generator.check_token(user, request.data.get('token', '')):
+        return Response({'message': 'This invitation is not valid or has expired'}, status=status.HTTP_400_BAD_REQUEST)
+    password = request.data.get('password', '')
+    try:
+        validate_password(password, user)
+    except ValidationError as e:
+        return Response({'message': ' '.join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+    user.set_password(password)
+    user.save(update_fields=['password'])
+    return Response({'message': 'Password set'})
+
 class ViewDoctorsViewset(ReadOnlyModelViewSet):
-    queryset = Doctor.objects.all()
+    queryset = Doctor.objects.select_related('user')
     serializer_class = DoctorSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {'list': 1, 'retrieve': 1, 'slots': 2}
+
+    def list(self, request, *args, **kwargs):
+        """
+        Served from the in-process doctor directory, `limit` doctors at a time from `offset`. Filters:
+        `specialization`, `min_fee`, `max_fee`, `min_experience`, `available_from`/`available_to`
+        (HH:MM) and `q` (name prefix).
+        """
+        try:
+            snapshot, results = directory.search(request.GET)
+        except DirectoryFilterError as e:
+            return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        headers = directory.headers(snapshot, request.GET.urlencode())
+        if headers['ETag'] in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        paginator = ListPagination()
+        page = paginator.paginate_queryset(results, request, view=self)
+        return Response(paginator.get_paginated_response(page).data, headers=headers)
+
+    @action(detail=True, methods=['get'], url_path='slots')
+    def slots(self, request, pk=None):
+        doctor = self.get_object()
+        try:
+            start = parse_date(request.GET.get('start', '')) if request.GET.get('start') else timezone.localdate()
+            end = parse_date(request.GET.get('end', '')) if request.GET.get('end') else (start and start + timedelta(days=6))
+        except ValueError:
+            start = end = None
+
+        if not start or not end:
+            return Response({'message': 'start and end should be dates in YYYY-MM-DD format'}, status=status.HTTP_400_BAD_REQUEST)
+        if end < start or (end - start).days > 31:
+            return Response({'message': 'end should be on or after start and at most 31 days later'}, status=status.HTTP_400_BAD_REQUEST)
+
+        days = free_slots(doctor, start, end)
+        return Response({
+            'doctor_id': doctor.id,
+            'slot_minutes': slot_minutes(doctor),
+            'days': [
+                {'date': day, 'slots': [timezone.localtime(slot).strftime('%Y-%m-%d %H:%M:%S') for slot in slots]}
+                for day, slots in days.items()
+            ],
+        })
 
 class PatientViewSet(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, GenericViewSet):
-    queryset = Patient.objects.all()
+    queryset = Patient.objects.select_related('user')
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {'retrieve': 1, 'update': 2, 'partial_update': 2}
     
     def get_object(self):
-        return get_object_or_404(Patient, user=self.request.user)
+        return get_object_or_404(self.queryset, user_id=get_principal(self.request).user_id)
     
 
 class AppointmentViewSet(ModelViewSet):
-    queryset = Appointment.objects.all()
+    queryset = Appointment.objects.select_related('doctor__user', 'patient__user')
     serializer_class = AppointmentSerializer
     permission_classes = [IsAuthenticated, IsPatient]
+    # a series costs the same whatever its length; losing a race to concurrent bookings adds one read and a second insert
+    query_budget = {'list': 1, 'retrieve': 1, 'bulk': 19}
 
     def get_queryset(self):
-        return self.queryset.filter(patient__user=self.request.user).exclude(prescription__isnull=False)
+        return self.queryset.filter(patient__user_id=get_principal(self.request).user_id).exclude(prescription__isnull=False).with_prescription_flag()
 
     def create(self, request, *args, **kwargs):
         doctor_id = request.data.get('doctor_id')
@@ -60,7 +160,7 @@ class AppointmentViewSet(ModelViewSet):
             return Response({'message': 'Invalid appointment_time format'}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            patient = Patient.objects.get(user=request.user)
+            patient = Patient.objects.get(user_id=get_principal(request).user_id)
         except Patient.DoesNotExist:
             return Response({'message': 'User is not a patient'}, status=status.HTTP_400_BAD_REQUEST)
         
@@ -69,34 +169,103 @@ class AppointmentViewSet(ModelViewSet):
         except Doctor.DoesNotExist:
             return Response({'message': 'Doctor not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Prevent scheduling conflicts
-        if Appointment.objects.filter(doctor=doctor, scheduled_at=parsed_time).exists():
+        # The slot reservation constraint rejects conflicting bookings, including concurrent ones
+        try:
+            appointment = book_appointment(patient, doctor, parsed_time, request.data.get('duration_minutes'))
+        except (InvalidDuration, InvalidStart) as e:
+            return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except SlotUnavailable:
             return Response({'message': 'Appointment already exists at that time'}, status=409)
         
-        appointment = Appointment.objects.create(
-            patient = patient,
-            doctor = doctor,
-            scheduled_at = parsed_time
-        )
-        
+        appointment.has_prescription = False
         serializer = self.get_serializer(appointment)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
         
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        """
+        Book a series of visits with one doctor in one request, either as explicit `appointment_times`
+        or as a `recurrence` of `count` visits `every_days` apart from `start`.
+        """
+        doctor_id = request.data.get('doctor_id')
+        times = request.data.get('appointment_times')
+        recurrence = request.data.get('recurrence')
+
+        if not doctor_id or not (times or recurrence):
+            return Response({'message': 'doctor_id and either appointment_times or recurrence should be provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if recurrence:
+            if not isinstance(recurrence, dict):
+                return Response({'message': 'recurrence should be an object with start, every_days and count'}, status=status.HTTP_400_BAD_REQUEST)
+            first = parse_datetime(str(recurrence.get('start', '')))
+            try:
+                every_days = int(recurrence.get('every_days', 7))
+                count = int(recurrence.get('count', 0))
+            except (TypeError, ValueError):
+                return Response({'message': 'every_days and count should be whole numbers'}, status=status.HTTP_400_BAD_REQUEST)
+            if not first or every_days < 1 or count < 1:
+                return Response({'message': 'recurrence needs a valid start, every_days >= 1 and count >= 1'}, status=status.HTTP_400_BAD_REQUEST)
+            parsed_times = [first + timedelta(days=every_days * i) for i in range(count)]
+        else:
+            if not isinstance(times, list):
+                return Response({'message': 'appointment_times should be a list'}, status=status.HTTP_400_BAD_REQUEST)
+            parsed_times = [parse_datetime(str(t)) for t in times]
+            if not all(parsed_times):
+                return Response({'message': 'Invalid appointment_time format'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(parsed_times) > MAX_SERIES_LENGTH:
+            return Response({'message': f'At most {MAX_SERIES_LENGTH} appointments can be booked at once'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            patient = Patient.objects.select_related('user').get(user_id=get_principal(request).user_id)
+        except Patient.DoesNotExist:
+            return Response({'message': 'User is not a patient'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            doctor = Doctor.objects.select_related('user').get(id=doctor_id)
+        except (Doctor.DoesNotExist, ValueError):
+            return Response({'message': 'Doctor not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            results = book_series(patient, doctor, parsed_times, request.data.get('duration_minutes'))
+        except (InvalidDuration, InvalidStart) as e:
+            return Response({'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        booked = [appointment for _, _, appointment in results if appointment]
+        for appointment in booked:
+            appointment.has_prescription = False
+        data = dict(zip((a.id for a in booked), self.get_serializer(booked, many=True).data))
+        occurrences = [
+            {
+                'scheduled_at': timezone.localtime(scheduled_at).strftime('%Y-%m-%d %H:%M:%S'),
+                'status': outcome,
+                'appointment': data[appointment.id] if appointment else None,
+            }
+            for scheduled_at, outcome, appointment in results
+        ]
+        counts = Counter(outcome for _, outcome, _ in results)
+        return Response(
+            {'booked': counts[BOOKED], 'conflicts': counts[CONFLICT], 'duplicates': counts[DUPLICATE], 'occurrences': occurrences},
+            status=status.HTTP_201_CREATED if booked else 409,
+        )
+
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
         new_time = request.data.get('scheduled_at')
+        new_duration = request.data.get('duration_minutes')
         
-        if new_time:
-            parsed_time = parse_datetime(new_time)
+        if new_time or new_duration:
+            parsed_time = parse_datetime(new_time) if new_time else instance.scheduled_at
             if not parsed_time:
                 return Response({"message": "Invalid datetime format"}, status=400)
             
             # Prevent rescheduling conflicts
-            if Appointment.objects.filter(doctor=instance.doctor, scheduled_at=parsed_time).exclude(id=instance.id).exists():
+            try:
+                reschedule_appointment(instance, parsed_time, new_duration)
+            except (InvalidDuration, InvalidStart) as e:
+                return Response({'message': str(e)}, status=400)
+            except SlotUnavailable:
                 return Response({'message': 'Doctor unavailable at that time'}, status=409)
-            
-            instance.scheduled_at = parsed_time
-            instance.save()
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
@@ -104,37 +273,34 @@ class MedicalHistoryViewSet(ModelViewSet):
     queryset = MedicalHistory.objects.all()
     permission_classes = [IsAuthenticated, IsDoctorOrReadOnlyForPatients]
     serializer_class = MedicalHistorySerializer
+    query_budget = {'list': 1, 'retrieve': 1, 'get_by_patient': 2}
 
     @action(detail=False, methods=['get'], url_path='patient/(?P<patient_id>[^/.]+)')
     def get_by_patient(self, request, patient_id=None):
-        user = request.user
-        if not hasattr(user, 'admin'):
+        if get_principal(request).admin_id is None:
             return Response({'detail': 'Only admins can access this endpoint.'}, status=403)
         queryset = MedicalHistory.objects.filter(patient__id=patient_id)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
     
     def get_queryset(self):
-        user = self.request.user
-        if hasattr(user, 'doctor'):
-            patient_ids = Appointment.objects.filter(doctor__user=user).values_list('patient', flat=True).distinct()
-            
-            patients = Patient.objects.filter(id__in=patient_ids)
-            
-            return MedicalHistory.objects.filter(patient__in=patients)
-        elif hasattr(user, 'patient'):
+        principal = get_principal(self.request)
+        if principal.doctor_id is not None:
+            return MedicalHistory.objects.filter(patient__care_team__doctor_id=principal.doctor_id)
+        elif principal.patient_id is not None:
             # Users can only access their own medical history
-            return MedicalHistory.objects.filter(patient__user=user)
+            return MedicalHistory.objects.filter(patient_id=principal.patient_id)
         
-        elif hasattr(user, 'admin'):
+        elif principal.admin_id is not None:
             return MedicalHistory.objects.all()
         
         return MedicalHistory.objects.none()
 
     def perform_create(self, serializer):
-        user = self.request.user
+        principal = get_principal(self.request)
 
-        if not hasattr(user, 'doctor'):
+        if principal.doctor_id is None:
             raise serializers.ValidationError('Only doctors can add medical history')
         
         patient_id = self.request.data.get('patient_id')
@@ -144,8 +310,8 @@ class MedicalHistoryViewSet(ModelViewSet):
         # Only doctors that had previous appointments with the patient can create medical history for that patient
         try:
             patient = Patient.objects.get(id=patient_id)
-            if Appointment.objects.filter(doctor=user.doctor, patient=patient).exists():
-                serializer.save(recorded_by=user.doctor, patient=patient)
+            if CareTeamMember.objects.filter(doctor_id=principal.doctor_id, patient=patient).exists():
+                serializer.save(recorded_by_id=principal.doctor_id, patient=patient)
             else:
                 raise serializers.ValidationError('The patient is not affiliated with the doctor')                
         except Patient.DoesNotExist:
@@ -153,30 +319,71 @@ class MedicalHistoryViewSet(ModelViewSet):
         
         
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
-@csrf_exempt
-def create_checkout_session(request, prescription_id):
-    prescription = get_object_or_404(Prescription, id=prescription_id)
+MAX_SEARCH_RESULTS = 100
 
-    total_cost_paise = 0
-    description = []
 
+@query_budget(1)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_records(request):
+    """Ranked full-text search over medical history and prescriptions, limited to what the user may see."""
+    principal = get_principal(request)
+    if principal.doctor_id is not None:
+        scope = search.Scope(doctor_id=principal.doctor_id)
+    elif principal.patient_id is not None:
+        scope = search.Scope(patient_id=principal.patient_id)
+    elif principal.admin_id is not None:
+        scope = search.Scope()
+    else:
+        return Response({'message': 'You do not have access to medical records'}, status=status.HTTP_403_FORBIDDEN)
+
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({'message': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+    kind = request.query_params.get('kind')
+    if kind and kind not in search.KINDS:
+        return Response({'message': f'kind should be one of {", ".join(search.KINDS)}'}, status=status.HTTP_400_BAD_REQUEST)
     try:
-        meds = json.loads(prescription.medications)
-    except Exception:
-        return JsonResponse({"error": "Invalid medications format"}, status=400)
-    
-    for med in meds:
-        name = med.get('name', 'Unknown Medication')
-        description.append(f'{name}')
+        limit = min(int(request.query_params.get('limit', 20)), MAX_SEARCH_RESULTS)
+        offset = int(request.query_params.get('offset', 0))
+    except ValueError:
+        return Response({'message': 'limit and offset should be whole numbers'}, status=status.HTTP_400_BAD_REQUEST)
+    if limit < 1 or offset < 0:
+        return Response({'message': 'limit should be positive and offset should not be negative'}, status=status.HTTP_400_BAD_REQUEST)
+
+    results = search.get_backend().search(query, scope, kinds=(kind,) if kind else search.KINDS, limit=limit, offset=offset)
+    return Response({'results': results, 'next_offset': offset + limit if len(results) == limit else None})
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated, IsPatient])
+@throttle_classes([CheckoutThrottle])
+def create_checkout_session(request, prescription_id):
+    """
+    Open (or reuse) a checkout session for one of the patient's prescriptions. When the provider is
+    slow this answers 202 with a `poll_url` instead of holding the worker; polling it continues the
+    same attempt, so the session created in the meantime is the one returned.
+    """
+    patient_id = get_principal(request).patient_id
+    # repeated clicks reuse the open session with one indexed query and no provider call
+    cached = cached_checkout(prescription_id, patient_id)
+    if cached is not None:
+        return Response({'checkout_session_id': cached['id'], 'checkout_url': cached['url']})
+
+    prescription = get_object_or_404(Prescription.objects.select_related('doctor'), id=prescription_id, patient_id=patient_id)
+    if prescription.is_paid:
+        return Response({"error": "This prescription has already been paid"}, status=400)
+
+    total_cost_paise = 0
+    description = [name or 'Unknown Medication' for name in prescription.items.values_list('name', flat=True)]
 
     total_cost_paise = int(prescription.doctor.consultation_fee * 100)
     description.append(f'Consultation fee: ${prescription.doctor.consultation_fee}')
 
     if total_cost_paise == 0:
-        return JsonResponse({"error": "Consultation fee has not been provided for the doctor"}, status=400)
+        return Response({"error": "Consultation fee has not been provided for the doctor"}, status=400)
     
-    session = stripe.checkout.Session.create(
+    params = dict(
         payment_method_types=['card'],
         line_items=[{
             'price_data': {
@@ -194,45 +401,96 @@ def create_checkout_session(request, prescription_id):
         cancel_url=f'http://localhost:3000/patient/payment-cancel/?prescription_id={prescription_id}/',
         metadata={
             'prescription_id': str(prescription_id),
-            'patient_id': str(prescription.patient.id),
+            'patient_id': str(prescription.patient_id),
         }
     )
-    
-    return JsonResponse({'checkout_session_id': session.id, 'checkout_url': session.url})
+    payment = start_checkout(prescription, prescription.doctor.consultation_fee)
+    try:
+        session = get_gateway().create_session(params, attempt=payment.id)
+    except ProviderTimeout as e:
+        # the attempt stays open; polling it gets the session the provider is still creating
+        return Response(
+            {'status': 'pending', 'poll_url': request.build_absolute_uri(), 'message': str(e)},
+            status=status.HTTP_202_ACCEPTED, headers={'Retry-After': str(math.ceil(e.retry_after))},
+        )
+    except GatewayUnavailable as e:
+        abandon_checkout(payment)
+        headers = {'Retry-After': str(math.ceil(e.retry_after))} if e.retry_after is not None else None
+        return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers=headers)
+    except stripe.StripeError as e:
+        abandon_checkout(payment)
+        return Response({'error': e.user_message or 'Could not start the checkout'}, status=status.HTTP_502_BAD_GATEWAY)
+
+    record_checkout(payment, session)
+    cache_checkout(prescription, session)
+    return Response({'checkout_session_id': session.id, 'checkout_url': session.url})
+
 
 @api_view(['GET'])
-@permission_classes([AllowAny])
+@permission_classes([IsAuthenticated, IsPatient])
+@throttle_classes([PaymentStatusThrottle])
 def payment_success(request, prescription_id):
-    prescription = get_object_or_404(Prescription, id=prescription_id)
-    prescription.is_paid = True
-    prescription.save()
-    amount = prescription.doctor.consultation_fee
-    Payment.objects.create(prescription=prescription, amount=amount, status='Paid')
-    return Response({'message': 'Payment completed successfully'}, status=200)
+    """
+    Where the patient's browser lands after checkout. Payments are confirmed by the provider's
+    webhook (or reconcile_payments); if that has not happened yet, the prescription's open sessions
+    are checked with the provider. Repeated calls for a paid prescription only read it.
+    """
+    prescription = get_object_or_404(Prescription, id=prescription_id, patient_id=get_principal(request).patient_id)
+    if prescription.is_paid:
+        return Response({'message': 'Payment completed successfully'}, status=200)
+
+    session_ids = Payment.objects.filter(prescription=prescription, status=Payment.PENDING).exclude(stripe_session_id=None).order_by('-id').values_list('stripe_session_id', flat=True)[:5]
+    try:
+        sessions = [get_gateway().retrieve_session(session_id) for session_id in session_ids]
+    except GatewayUnavailable as e:
+        return Response({'message': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except stripe.StripeError as e:
+        return Response({'message': e.user_message or 'The payment provider could not look up the checkout'}, status=status.HTTP_502_BAD_GATEWAY)
+    outcomes = apply_sessions([(session, Payment.PAID) for session in sessions if session.get('payment_status') == 'paid'])
+    if outcomes['confirmed']:
+        return Response({'message': 'Payment completed successfully'}, status=200)
+    return Response({'message': 'Payment has not been confirmed yet'}, status=status.HTTP_202_ACCEPTED)
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    """Checkout events pushed by Stripe, verified against STRIPE_WEBHOOK_SECRET."""
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        return JsonResponse({'error': 'Webhooks are not configured'}, status=503)
+    try:
+        event = stripe.Webhook.construct_event(request.body, request.headers.get('Stripe-Signature', ''), settings.STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        return JsonResponse({'error': 'Invalid payload or signature'}, status=400)
+    apply_sessions(settled_sessions([event]))
+    return JsonResponse({'received': True})
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def payment_cancel(request, prescription_id):
     return JsonResponse({'status': 'cancelled', 'message': f'Payment was cancelled by the user for prescription_id: {prescription_id}'}, status=200)
 
+@query_budget(2)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsPatient])
 def get_payments(request):
-    try:
-        patient = request.user.patient
-    except AttributeError:
+    patient_id = get_principal(request).patient_id
+    if patient_id is None:
         return Response({'detail': 'Patient profile not found'}, status=400)
     
-    payments = Payment.objects.filter(prescription__patient=patient).select_related('prescription')
-    serializer = PaymentSerializer(payments, many=True)
-    return Response(serializer.data)
+    payments = Payment.objects.filter(prescription__patient_id=patient_id).select_related('prescription__doctor__user', 'prescription__patient__user').prefetch_related('prescription__items')
+    paginator = StableCursorPagination()
+    page = paginator.paginate_queryset(payments, request)
+    serializer = PaymentSerializer(page, many=True)
+    return paginator.get_paginated_response(serializer.data)
         
 
+@query_budget(1)
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_logged_in_patient(request):
     try:
-        patient = Patient.objects.get(user=request.user)
+        patient = Patient.objects.select_related('user').get(user_id=get_principal(request).user_id)
     except Patient.DoesNotExist:
         return Response({'error': 'Patient not found'}, status=404) 
 